@@ -0,0 +1,432 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+from log_config import setup_logging
+
+try:
+    import fcntl
+except ImportError:  # Windows: a job is only kept from running twice within one process
+    fcntl = None
+
+import metrics
+import identity
+import embedding_backends
+from query import perform_batch_query, open_dataset
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Route on the packman API for each pack type
+PACK_ROUTES = {
+    'pack': 'pack/details',
+    'code_pack': 'code/details',
+}
+
+# Folder holding the input, output and status files of jobs submitted through the API
+BATCH_JOBS_FOLDER = os.getenv('BATCH_JOBS_FOLDER', 'batch_jobs')
+
+DEFAULT_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 4))
+# Upper bound on the `concurrency` a /batch-chat request can ask for
+MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', 16))
+
+# How long a submission waits for a status check, which holds a job's run lock for an instant
+RUN_LOCK_WAIT_SECONDS = 1.0
+
+
+def _app():
+    """
+    Import the Flask application module lazily.
+
+    app.py imports this module to register the batch endpoint, so importing it at
+    module level would be circular. By the time a batch runs, app is fully loaded.
+    """
+    import app
+    return app
+
+
+def read_records(input_path):
+    """
+    Read `{pack_id, user_message}` records from a JSONL file.
+
+    Returns:
+    List[dict]: Records with a `line` key holding their zero-based line number in the input,
+    which is used as the checkpoint key. Blank lines are skipped but still counted.
+    """
+    records = []
+    with open(input_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"Invalid JSON on line {line_number + 1} of {input_path}: {e}")
+            if not isinstance(record, dict):
+                raise ValueError(f"Line {line_number + 1} of {input_path} is not a JSON object")
+            record['line'] = line_number
+            records.append(record)
+    return records
+
+
+def load_checkpoint(output_path):
+    """
+    Load the completed lines from a previous, possibly interrupted, run.
+
+    Entries that recorded an error are dropped and the output file is compacted so the
+    failed records are retried. Returns the set of input line numbers already completed.
+    """
+    if not os.path.exists(output_path):
+        return set()
+
+    completed = {}
+    had_errors = False
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A partially written last line from an interrupted run
+                had_errors = True
+                continue
+            if entry.get('error') or 'line' not in entry:
+                had_errors = True
+                continue
+            completed[entry['line']] = entry
+
+    if had_errors:
+        temp_path = f"{output_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for line_number in sorted(completed):
+                f.write(json.dumps(completed[line_number]) + "\n")
+        os.replace(temp_path, output_path)
+        logger.info("Compacted checkpoint %s to %d completed entries", output_path, len(completed))
+
+    return set(completed)
+
+
+def validate_record(record):
+    """Return an error message for an invalid record, or None if it is valid."""
+    user_message = record.get('user_message')
+    if not isinstance(user_message, str) or not user_message.strip():
+        return "Invalid user_message provided"
+    if record.get('pack_type', 'pack') not in PACK_ROUTES:
+        return f"Invalid pack_type provided: {record.get('pack_type')}"
+    return None
+
+
+def fetch_user_id(access_token):
+    """Fetch the user ID for the access token from the central auth API (cached, see identity.py)."""
+    return identity.user_ids.lookup(access_token)
+
+
+def retrieve_for_records(records, user_id, access_token):
+    """
+    Run vector retrieval for every record that has a pack_id.
+
+    Records are grouped by (pack_type, pack_id) so each pack is processed and opened once,
+    and all of a pack's messages are embedded and searched as one batch.
+
+    A pack that cannot be processed or opened fails only the records that use it.
+
+    Returns:
+    Tuple[Dict[int, dict], Dict[int, str]]: Vector results and retrieval errors, both keyed
+    by input line number.
+    """
+    app = _app()
+    groups = {}
+    for record in records:
+        if record.get('pack_id'):
+            key = (record.get('pack_type', 'pack'), str(record['pack_id']))
+            groups.setdefault(key, []).append(record)
+
+    vector_results = {}
+    errors = {}
+    for (pack_type, pack_id), group in groups.items():
+        logger.info("Retrieving for %d records on %s %s", len(group), pack_type, pack_id)
+        try:
+            app.upload_and_process_pack(user_id, pack_id, PACK_ROUTES[pack_type], pack_type, access_token)
+
+            deeplake_folder_path = os.path.join("my_deeplake", user_id, pack_type, pack_id, "actual_deeplake_name")
+            embedding_function = embedding_backends.for_dataset(deeplake_folder_path, app.client)
+            with metrics.span('deeplake_open'):
+                db = open_dataset(deeplake_folder_path, embedding_function)
+
+            results = perform_batch_query(db, [record['user_message'] for record in group])
+        except Exception as e:
+            logger.error("Error retrieving for %d records on %s %s: %s", len(group), pack_type, pack_id, str(e))
+            for record in group:
+                errors[record['line']] = f"Error processing {pack_type} {pack_id}: {str(e)}"
+            continue
+
+        for record, result in zip(group, results):
+            vector_results[record['line']] = result
+
+    return vector_results, errors
+
+
+def run_batch(input_path, output_path, access_token, concurrency=DEFAULT_CONCURRENCY, progress=None, user_id=None):
+    """
+    Run chat completions for every record in `input_path` and append results to `output_path`.
+
+    Each output line holds the input `line` number, the original record fields and either a
+    `message` or an `error`. Lines already completed in `output_path` are skipped, so an
+    interrupted run resumes where it stopped when called again with the same paths.
+
+    Args:
+    input_path (str): JSONL file of `{pack_id, user_message}` records. Optional fields are
+        `pack_type` ('pack' or 'code_pack', default 'pack'), `history` and `id`.
+    output_path (str): JSONL file the results are appended to; doubles as the checkpoint.
+    access_token (str): Bearer token of the user the batch runs for.
+    concurrency (int): Maximum number of completions in flight at once.
+    progress (callable, optional): Called with (completed, total) after each record.
+    user_id (str, optional): The token's user, when the caller has already looked it up.
+
+    Returns:
+    dict: Summary counts for the run.
+    """
+    app = _app()
+
+    records = read_records(input_path)
+    completed = load_checkpoint(output_path)
+    pending = [record for record in records if record['line'] not in completed]
+    logger.info("Batch %s: %d records, %d already completed, %d pending",
+                input_path, len(records), len(completed), len(pending))
+
+    summary = {"total": len(records), "skipped": len(completed), "succeeded": 0, "failed": 0}
+    if not pending:
+        return summary
+
+    if app.max_token_flag(access_token):
+        raise ValueError("Token limit exceeded, buy premium or request more tokens")
+
+    if user_id is None:
+        user_id = fetch_user_id(access_token)
+
+    write_lock = threading.Lock()
+    output_file = open(output_path, 'a', encoding='utf-8')
+
+    def write_result(record, message=None, error=None):
+        entry = dict(record)
+        if error:
+            entry['error'] = error
+        else:
+            entry['message'] = message
+        with write_lock:
+            summary['failed' if error else 'succeeded'] += 1
+            output_file.write(json.dumps(entry) + "\n")
+            output_file.flush()
+            if progress:
+                progress(summary['skipped'] + summary['succeeded'] + summary['failed'], summary['total'])
+
+    try:
+        valid = []
+        for record in pending:
+            error = validate_record(record)
+            if error:
+                write_result(record, error=error)
+            else:
+                valid.append(record)
+
+        vector_results, retrieval_errors = retrieve_for_records(valid, user_id, access_token)
+        for record in valid:
+            if record['line'] in retrieval_errors:
+                write_result(record, error=retrieval_errors[record['line']])
+        valid = [record for record in valid if record['line'] not in retrieval_errors]
+
+        def complete(record):
+            results = vector_results.get(record['line'])
+            if record.get('pack_id') and not results:
+                return None, "No vector results found"
+            message = app.chatgpt_response(access_token, record['user_message'],
+                                           history=record.get('history', ''), vector_results=results)
+            # chatgpt_response reports failures in-band rather than raising
+            if isinstance(message, str) and message.startswith("Error:"):
+                return None, message
+            return message, None
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = {executor.submit(complete, record): record for record in valid}
+            for future in as_completed(futures):
+                record = futures[future]
+                try:
+                    message, error = future.result()
+                except Exception as e:
+                    logger.error("Error completing batch record on line %d: %s", record['line'], str(e))
+                    message, error = None, str(e)
+                write_result(record, message=message, error=error)
+    finally:
+        output_file.close()
+
+    logger.info("Batch %s finished: %s", input_path, summary)
+    return summary
+
+
+# _____________batch jobs submitted through the API_______________
+
+def job_id_for(user_id, content):
+    """
+    Jobs are keyed by a digest of their owner and input, so a user resubmitting the same
+    input resumes the same job, and the same input from another user is a separate job.
+    """
+    return hashlib.sha256(f"{user_id}\n".encode('utf-8') + content).hexdigest()
+
+
+def job_paths(job_id):
+    job_folder = os.path.join(BATCH_JOBS_FOLDER, job_id)
+    return {
+        "folder": job_folder,
+        "input": os.path.join(job_folder, 'input.jsonl'),
+        "output": os.path.join(job_folder, 'output.jsonl'),
+        "status": os.path.join(job_folder, 'status.json'),
+    }
+
+
+def write_status(job_id, status):
+    paths = job_paths(job_id)
+    temp_path = f"{paths['status']}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(status, f)
+    os.replace(temp_path, paths['status'])
+
+
+def read_status(job_id, user_id):
+    """
+    Status of the job, or None if it does not exist or belongs to another user.
+
+    A job left "running" by a worker that stopped (restarted by max_requests, crashed or
+    redeployed) is reported as "interrupted"; submitting it again resumes it.
+    """
+    paths = job_paths(job_id)
+    if not os.path.exists(paths['status']):
+        return None
+    with open(paths['status'], 'r', encoding='utf-8') as f:
+        status = json.load(f)
+    if status.get('owner') != user_id:
+        return None
+    if status.get('state') == 'running' and not _is_running(job_id):
+        status['state'] = 'interrupted'
+    return status
+
+
+# Jobs running in this process. Across processes, the process running a job holds an
+# exclusive lock on its run.lock file, which the OS releases if the process dies.
+_running_jobs = set()
+_running_jobs_lock = threading.Lock()
+
+
+def _lock_path(job_id):
+    return os.path.join(job_paths(job_id)['folder'], 'run.lock')
+
+
+def _take_run_lock(job_id):
+    """The job's run lock as an open file, or None if another process is running the job."""
+    lock_file = open(_lock_path(job_id), 'a')
+    deadline = time.time() + RUN_LOCK_WAIT_SECONDS
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except BlockingIOError:
+            if time.time() >= deadline:
+                lock_file.close()
+                return None
+            time.sleep(0.05)
+
+
+def _is_running(job_id):
+    """Whether a live process is running the job; without fcntl, only this process is known."""
+    if job_id in _running_jobs:
+        return True
+    if fcntl is None:
+        return True
+    with open(_lock_path(job_id), 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return False
+
+
+def submit_job(content, access_token, user_id, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Store a JSONL batch of `user_id`'s and run it in a background thread of this worker.
+
+    Returns the job ID and whether a new run was started (False if the job is already
+    running in this or another worker process).
+    """
+    job_id = job_id_for(user_id, content)
+    paths = job_paths(job_id)
+    os.makedirs(paths['folder'], exist_ok=True)
+    if not os.path.exists(paths['input']):
+        with open(paths['input'], 'wb') as f:
+            f.write(content)
+
+    with _running_jobs_lock:
+        if job_id in _running_jobs:
+            return job_id, False
+        _running_jobs.add(job_id)
+    lock_file = _take_run_lock(job_id) if fcntl else None
+    if fcntl and lock_file is None:
+        with _running_jobs_lock:
+            _running_jobs.discard(job_id)
+        return job_id, False
+
+    def progress(completed, total):
+        write_status(job_id, {"state": "running", "completed": completed, "total": total,
+                              "owner": user_id, "pid": os.getpid()})
+
+    def run():
+        try:
+            summary = run_batch(paths['input'], paths['output'], access_token, concurrency,
+                                progress=progress, user_id=user_id)
+            write_status(job_id, dict(summary, state="finished", owner=user_id))
+        except Exception as e:
+            logger.error("Batch job %s failed: %s", job_id, str(e), exc_info=True)
+            write_status(job_id, {"state": "failed", "error": str(e), "owner": user_id})
+        finally:
+            # The final status is written before the lock is released
+            with _running_jobs_lock:
+                _running_jobs.discard(job_id)
+            if lock_file:
+                lock_file.close()
+
+    # Written before the job starts, so its status can be read as soon as its ID is returned
+    progress(0, None)
+    threading.Thread(target=run, name=f"batch-{job_id[:12]}", daemon=True).start()
+    return job_id, True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run chat completions for a JSONL file of {pack_id, user_message} records.")
+    parser.add_argument('input', help="Input JSONL file")
+    parser.add_argument('output', help="Output JSONL file; an existing file is treated as a checkpoint and resumed")
+    parser.add_argument('--token', default=os.getenv('SOURCEBOX_ACCESS_TOKEN'),
+                        help="Access token (defaults to the SOURCEBOX_ACCESS_TOKEN environment variable)")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help="Maximum number of completions in flight")
+    args = parser.parse_args()
+    setup_logging()
+
+    if not args.token:
+        parser.error("an access token is required (--token or SOURCEBOX_ACCESS_TOKEN)")
+
+    def progress(completed, total):
+        print(f"\r{completed}/{total} records completed", end="", flush=True)
+
+    summary = run_batch(args.input, args.output, args.token, args.concurrency, progress=progress)
+    print()
+    print(json.dumps(summary))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+
+import pytest
+
+import batch
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CONTENT = b'{"user_message": "hello"}\n'
+
+
+def start_worker(jobs_folder):
+    """A worker process that submits CONTENT for alice with a run_batch that never finishes."""
+    code = textwrap.dedent(f"""
+        import threading
+        import batch
+        batch.BATCH_JOBS_FOLDER = {str(jobs_folder)!r}
+        batch.run_batch = lambda *args, **kwargs: threading.Event().wait()
+        job_id, started = batch.submit_job({CONTENT!r}, 'token', 'alice')
+        print(started, flush=True)
+        threading.Event().wait()
+    """)
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT, stdout=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+
+@pytest.fixture
+def jobs_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, 'BATCH_JOBS_FOLDER', str(tmp_path))
+    return tmp_path
+
+
+def test_a_job_runs_in_one_worker_at_a_time(jobs_folder):
+    first, first_started = start_worker(jobs_folder)
+    second, second_started = start_worker(jobs_folder)
+    try:
+        assert (first_started, second_started) == ('True', 'False')
+        status = batch.read_status(batch.job_id_for('alice', CONTENT), 'alice')
+        assert status['state'] == 'running' and status['pid'] == first.pid
+    finally:
+        first.kill()
+        second.kill()
+        first.wait()
+        second.wait()
+
+
+def test_job_of_a_dead_worker_is_interrupted_and_resumes(jobs_folder, monkeypatch):
+    worker, started = start_worker(jobs_folder)
+    assert started == 'True'
+    job_id = batch.job_id_for('alice', CONTENT)
+    worker.kill()
+    worker.wait()
+
+    assert batch.read_status(job_id, 'alice')['state'] == 'interrupted'
+    assert batch.read_status(job_id, 'bob') is None
+
+    runs = []
+    monkeypatch.setattr(batch, 'run_batch', lambda *args, **kwargs: runs.append(args) or {"total": 1})
+    assert batch.submit_job(CONTENT, 'token', 'alice') == (job_id, True)
+    for thread in [t for t in threading.enumerate() if t.name == f"batch-{job_id[:12]}"]:
+        thread.join(5)
+    assert len(runs) == 1
+    assert batch.read_status(job_id, 'alice')['state'] == 'finished'
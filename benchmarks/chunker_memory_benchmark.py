@@ -0,0 +1,132 @@
+"""
+Chunking memory benchmark: peak RSS of chunking one large text file.
+
+Generates a log-like text file of --size-mb megabytes and chunks it in a fresh interpreter
+with each path of vector.load_documents, consuming the chunks in batches of
+VECTOR_ADD_BATCH_SIZE like ingestion does (without embedding them):
+
+- textloader: TextLoader reads the whole file, CharacterTextSplitter splits it
+- streaming:  text_chunker memory-maps the file and yields token-budgeted chunks
+
+For each path it reports the RSS after imports, the peak RSS while chunking, their
+difference, the wall time and the number of chunks.
+
+    python benchmarks/chunker_memory_benchmark.py --size-mb 256 --output chunker.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import REPO_ROOT, git_revision  # noqa: E402
+
+# Runs in a fresh interpreter per path; prints one JSON line
+MEASURE = r"""
+import json, os, resource, sys, time
+sys.path.insert(0, os.getcwd())
+import vector
+
+def rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+# Load the lazily imported dependencies and the BPE ranks before measuring
+vector.count_tokens(["warm up"])
+vector.load_documents('warmup.txt', text="warm up")
+baseline = rss_bytes()
+
+started = time.perf_counter()
+chunks = tokens = 0
+for batch in vector._batched(vector.load_documents(os.path.basename(sys.argv[1]), sys.argv[1]),
+                             vector.ADD_BATCH_SIZE):
+    chunks += len(batch)
+    tokens += vector.count_tokens(doc.page_content for doc in batch)
+seconds = time.perf_counter() - started
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+print(json.dumps({"baseline_rss_bytes": baseline, "peak_rss_bytes": peak, "chunking_rss_bytes": peak - baseline,
+                  "seconds": round(seconds, 3), "chunks": chunks, "tokens": tokens}))
+"""
+
+WORDS = ("request", "response", "user", "pack", "query", "error", "timeout", "retry", "cache", "vector",
+         "dataset", "worker", "token", "embedding", "upload", "connection", "latency", "status")
+
+
+def write_log(path, size_bytes, seed=0):
+    """A log-like file of about `size_bytes`: timestamped lines of words, with the odd long line."""
+    rng = random.Random(seed)
+    written = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        while written < size_bytes:
+            lines = []
+            for _ in range(1000):
+                words = rng.randint(60, 400) if rng.random() < 0.01 else rng.randint(4, 20)
+                lines.append(f"2024-01-{rng.randint(1, 28):02d} {rng.choice(('INFO', 'WARN', 'ERROR'))} "
+                             + " ".join(rng.choice(WORDS) for _ in range(words)) + "\n")
+            block = "".join(lines)
+            f.write(block)
+            written += len(block)
+
+
+def measure(path, name, env):
+    completed = subprocess.run([sys.executable, '-c', MEASURE, path], cwd=REPO_ROOT, env=env,
+                               capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Chunking with the {name} path failed:\n{completed.stderr[-2000:]}")
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["path"] = name
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=float, default=256, help="Size of the generated text file")
+    parser.add_argument('--file', help="Chunk this file instead of a generated one")
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sourcebox-chunker-')
+    try:
+        path = args.file
+        if not path:
+            path = os.path.join(workdir, 'large.log')
+            write_log(path, int(args.size_mb * 1024 * 1024))
+        size = os.path.getsize(path)
+        print(f"Chunking {path} ({size / 1024 / 1024:.0f} MB)", file=sys.stderr)
+
+        runs = []
+        for name, min_mb in (('textloader', '1e12'), ('streaming', '0')):
+            env = dict(os.environ, STREAM_CHUNK_MIN_MB=min_mb)
+            runs.append(measure(path, name, env))
+            print(f"{name}: peak RSS {runs[-1]['peak_rss_bytes'] / 1024 / 1024:.0f} MB "
+                  f"(+{runs[-1]['chunking_rss_bytes'] / 1024 / 1024:.0f} MB for chunking), "
+                  f"{runs[-1]['seconds']:.1f}s, {runs[-1]['chunks']} chunks", file=sys.stderr)
+
+        results = {
+            "environment": {
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+            },
+            "file_bytes": size,
+            "runs": runs,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Multi-node benchmark for consistent-hash routing.
+
+Starts several API nodes (separate processes and working directories, like separate
+machines) behind a round-robin client, queries each pack on every node in turn, and
+compares routing off and on:
+
+- pack downloads and embedding calls (how often the same pack was built on several nodes),
+- p50/p95/p99 latency and errors,
+- local/forwarded/fallback counts from each node's /metrics.
+
+With --kill-node the last node is stopped after the main load and every pack is queried
+again, to show its keys moving to the remaining nodes.
+
+    python benchmarks/cluster_benchmark.py --nodes 3 --packs 6 --rounds 3
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import AppServer, git_revision, summarize  # noqa: E402
+from run_benchmarks import HEADERS, QUESTIONS  # noqa: E402
+from stub_servers import FakeCentralAuth, FakeOpenAI  # noqa: E402
+from synthetic_packs import text_pack  # noqa: E402
+
+
+def routing_counts(nodes):
+    counts = {}
+    for node in nodes:
+        try:
+            text = requests.get(f"{node.url}/metrics", timeout=10).text
+        except requests.RequestException:
+            continue
+        for line in text.splitlines():
+            if line.startswith('routing_requests_total{'):
+                result = line.split('result="', 1)[1].split('"', 1)[0]
+                counts[result] = counts.get(result, 0) + int(float(line.rsplit(' ', 1)[1]))
+    return counts
+
+
+def query_round(nodes, packs, latencies, offset=0):
+    errors = 0
+    for index, pack_id in enumerate(packs):
+        node = nodes[(index + offset) % len(nodes)]
+        start = time.perf_counter()
+        try:
+            response = requests.post(f"{node.url}/deepquery-raw", headers=HEADERS, timeout=600,
+                                     json={"user_message": QUESTIONS[index % len(QUESTIONS)], "pack_id": pack_id})
+            ok = response.status_code == 200 and 'error' not in response.json()
+        except (requests.RequestException, ValueError):
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors += 1
+    return errors
+
+
+def run_mode(routing, args, env, packs, openai_stub, auth_stub):
+    nodes = [AppServer(env=dict(env)) for _ in range(args.nodes)]
+    if routing:
+        cluster = ','.join(node.url for node in nodes)
+        for node in nodes:
+            node.env.update({'NODE_URL': node.url, 'CLUSTER_NODES': cluster, 'NODE_RETRY_SECONDS': '5'})
+
+    openai_stub.reset_stats()
+    auth_stub.reset_stats()
+    result = {}
+    try:
+        for node in nodes:
+            node.start()
+
+        latencies, errors = [], 0
+        for round_index in range(args.rounds):
+            # Shift the node order every round so each pack reaches several nodes
+            errors += query_round(nodes, packs, latencies, offset=round_index)
+        result["load"] = summarize(latencies, errors)
+        result["pack_downloads"] = auth_stub.stats.get('packman_pack', 0) - auth_stub.stats.get('packman_not_modified', 0)
+        result["pack_not_modified"] = auth_stub.stats.get('packman_not_modified', 0)
+        result["embedding_calls"] = openai_stub.stats.get('embeddings', 0)
+        result["routing"] = routing_counts(nodes)
+
+        if args.kill_node and len(nodes) > 1:
+            nodes[-1].stop()
+            latencies = []
+            errors = query_round(nodes[:-1], packs, latencies)
+            result["after_node_loss"] = summarize(latencies, errors)
+            result["routing_after_node_loss"] = routing_counts(nodes[:-1])
+    finally:
+        for node in nodes:
+            node.stop()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--packs', type=int, default=6)
+    parser.add_argument('--rounds', type=int, default=3, help="Times every pack is queried (on a different node)")
+    parser.add_argument('--openai-latency-ms', type=float, default=50.0)
+    parser.add_argument('--auth-latency-ms', type=float, default=20.0)
+    parser.add_argument('--kill-node', action='store_true', help="Stop one node and query every pack again")
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    openai_stub = FakeOpenAI(latency_ms=args.openai_latency_ms).start()
+    auth_stub = FakeCentralAuth(latency_ms=args.auth_latency_ms).start()
+    packs = [f"text-{index}" for index in range(args.packs)]
+    for index, pack_id in enumerate(packs):
+        auth_stub.add_pack('pack', pack_id, text_pack(seed=index))
+
+    env = {
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': openai_stub.base_url,
+        'CENTRAL_AUTH_URL': auth_stub.url,
+        'AUTH_API': auth_stub.url,
+        'WEB_CONCURRENCY': '1',
+    }
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": vars(args),
+        },
+    }
+    try:
+        for name, routing in (("routing_off", False), ("routing_on", True)):
+            results[name] = run_mode(routing, args, env, packs, openai_stub, auth_stub)
+            print(f"{name}: downloads={results[name]['pack_downloads']} embeddings={results[name]['embedding_calls']} "
+                  f"p50={results[name]['load'].get('p50_ms')}ms routing={results[name]['routing']}", file=sys.stderr)
+    finally:
+        openai_stub.stop()
+        auth_stub.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
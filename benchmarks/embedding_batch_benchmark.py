@@ -0,0 +1,129 @@
+"""
+Query embedding micro-batching benchmark.
+
+Runs the app against the fake OpenAI server (with --openai-latency-ms per call) once with
+query embedding batching disabled (EMBED_BATCH_WINDOW_MS=0) and once for each batching
+window in --windows, and drives /deepquery-raw on an ingested text pack with
+--concurrency clients. Every request asks a distinct question, so the savings come from
+batching rather than from identical queries sharing a call.
+
+For each run it reports p50/p95/p99 latency, throughput, errors and the number of
+embeddings calls the fake OpenAI server received during the load.
+
+    python benchmarks/embedding_batch_benchmark.py --requests 400 --concurrency 32 --output batch.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import REPO_ROOT, AppServer, git_revision, run_load, summarize  # noqa: E402
+from run_benchmarks import HEADERS, QUESTIONS, make_call  # noqa: E402
+from stub_servers import FakeCentralAuth, FakeOpenAI  # noqa: E402
+from synthetic_packs import text_pack  # noqa: E402
+
+CONFIG_FILE = os.path.join(REPO_ROOT, 'gunicorn.conf.py')
+PACK_ID = 'text-0'
+
+
+def run(name, window_ms, args, base_env, openai_stub):
+    env = dict(base_env, EMBED_BATCH_WINDOW_MS=str(window_ms))
+    command = [sys.executable, '-m', 'gunicorn', '--bind', '{bind}', '-c', CONFIG_FILE, 'app:app']
+    server = AppServer(env=env, command=command)
+    try:
+        server.start()
+        # Ingest the pack first so only query embeddings are measured
+        requests.post(f"{server.url}/deepquery-raw", headers=HEADERS, timeout=600,
+                      json={"user_message": QUESTIONS[0], "pack_id": PACK_ID})
+
+        sessions = {}
+
+        def session_per_thread():
+            key = threading.get_ident()
+            if key not in sessions:
+                sessions[key] = requests.Session()
+            return sessions[key]
+
+        def payload(i):
+            return {"user_message": f"{QUESTIONS[i % len(QUESTIONS)]} (#{i})", "pack_id": PACK_ID}
+
+        openai_stub.reset_stats()
+        latencies, errors, wall = run_load(make_call(server, 'POST', '/deepquery-raw', payload, session_per_thread),
+                                           args.requests, args.concurrency)
+        summary = summarize(latencies, errors)
+        summary["window_ms"] = window_ms
+        summary["throughput_rps"] = round(len(latencies) / wall, 2) if wall else None
+        summary["upstream_embedding_calls"] = openai_stub.stats.get('embeddings', 0)
+        print(f"{name}: p50={summary.get('p50_ms')}ms p99={summary.get('p99_ms')}ms "
+              f"rps={summary['throughput_rps']} embedding calls={summary['upstream_embedding_calls']} "
+              f"errors={errors}", file=sys.stderr)
+        return summary
+    except RuntimeError as e:
+        return {"window_ms": window_ms, "error": str(e)}
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=400, help="Queries per run")
+    parser.add_argument('--concurrency', type=int, default=32, help="Concurrent clients")
+    parser.add_argument('--workers', type=int, default=1, help="WEB_CONCURRENCY (batches form within a worker)")
+    parser.add_argument('--threads', type=int, default=32, help="GUNICORN_THREADS")
+    parser.add_argument('--windows', default='2,5,10', help="Comma-separated batching windows in milliseconds")
+    parser.add_argument('--openai-latency-ms', type=float, default=100.0)
+    parser.add_argument('--auth-latency-ms', type=float, default=5.0)
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    openai_stub = FakeOpenAI(latency_ms=args.openai_latency_ms).start()
+    auth_stub = FakeCentralAuth(latency_ms=args.auth_latency_ms).start()
+    auth_stub.add_pack('pack', PACK_ID, text_pack())
+
+    base_env = {
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': openai_stub.base_url,
+        'CENTRAL_AUTH_URL': auth_stub.url,
+        'AUTH_API': auth_stub.url,
+        'WEB_CONCURRENCY': str(args.workers),
+        'GUNICORN_THREADS': str(args.threads),
+    }
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": vars(args),
+        },
+        "runs": {},
+    }
+    try:
+        results["runs"]["unbatched"] = run("unbatched", 0, args, base_env, openai_stub)
+        for window in args.windows.split(','):
+            window_ms = float(window)
+            name = f"window-{window_ms:g}ms"
+            results["runs"][name] = run(name, window_ms, args, base_env, openai_stub)
+    finally:
+        openai_stub.stop()
+        auth_stub.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""
+Shared pieces of the benchmark scripts: running the app as a subprocess against the
+local stubs, measuring process memory, and summarizing latencies.
+"""
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# sitecustomize.py there patches out DeepLake's calls to Activeloop and PyPI in server processes
+OFFLINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'offline')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _children(pid):
+    children = []
+    task_dir = f"/proc/{pid}/task"
+    try:
+        for task in os.listdir(task_dir):
+            with open(os.path.join(task_dir, task, 'children')) as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def process_rss(pid):
+    """Resident set size of one process in bytes (Linux /proc), or None if unavailable."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def process_tree_rss(pid):
+    """RSS of a process and all its descendants, keyed by pid."""
+    result = {}
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        rss = process_rss(current)
+        if rss is not None:
+            result[current] = rss
+        pending.extend(_children(current))
+    return result
+
+
+class MemorySampler:
+    """Samples the RSS of a process tree on a background thread and keeps the peak."""
+
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, sum(process_tree_rss(self.pid).values()))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.peak
+
+
+def summarize(latencies, errors=0):
+    """
+    p50/p95/p99/mean/max in milliseconds for the latencies in seconds of successful calls;
+    "requests" counts those calls and the `errors` that failed.
+    """
+    if not latencies:
+        return {"requests": errors, "errors": errors}
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        # Nearest-rank percentile
+        index = min(len(ordered) - 1, max(0, math.ceil(p / 100.0 * len(ordered)) - 1))
+        return round(ordered[index] * 1000, 2)
+
+    return {
+        "requests": len(ordered) + errors,
+        "errors": errors,
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+
+def run_load(call, count, concurrency):
+    """
+    Invoke `call(i)` `count` times with `concurrency` threads.
+
+    `call` returns True on success. Returns (latencies in seconds of the successful calls,
+    error count, wall time); a failed call, which may have timed out or been rejected at
+    once, is only counted.
+    """
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def timed_call(i):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            ok = call(i)
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        list(executor.map(timed_call, range(count)))
+    return latencies, errors, time.perf_counter() - wall_start
+
+
+class AppServer:
+    """
+    Run the API in a subprocess inside a scratch working directory.
+
+    The working directory gets a copy of landing-examples/ so the app's relative paths
+    (uploads/, my_deeplake/, app.log) stay out of the repository; server output goes to
+    server.log there. `command` is the server
+    command line with `{bind}` substituted; by default the production gunicorn entry point.
+    The server runs offline/sitecustomize.py and BUGGER_OFF is set, so DeepLake makes no
+    calls to Activeloop or PyPI and results do not depend on the network.
+    """
+
+    def __init__(self, env=None, command=None, workdir=None, startup_timeout=120):
+        self.port = free_port()
+        self.bind = f"127.0.0.1:{self.port}"
+        self.url = f"http://{self.bind}"
+        self.command = command or [sys.executable, '-m', 'gunicorn', '--bind', '{bind}', 'app:app']
+        self.owns_workdir = workdir is None
+        self.workdir = workdir or tempfile.mkdtemp(prefix='sourcebox-bench-')
+        self.startup_timeout = startup_timeout
+        self.env = dict(os.environ)
+        self.env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_ROOT, OFFLINE_DIR, os.environ.get('PYTHONPATH')]))
+        self.env.setdefault('LOG_LEVEL', 'WARNING')
+        self.env.setdefault('BUGGER_OFF', 'true')
+        self.env.update(env or {})
+        self.process = None
+        self.startup_seconds = None
+
+    def start(self):
+        examples = os.path.join(REPO_ROOT, 'landing-examples')
+        target = os.path.join(self.workdir, 'landing-examples')
+        if not os.path.exists(target):
+            shutil.copytree(examples, target)
+
+        command = [part.replace('{bind}', self.bind) for part in self.command]
+        start = time.perf_counter()
+        self._log = open(os.path.join(self.workdir, 'server.log'), 'ab')
+        self.process = subprocess.Popen(command, cwd=self.workdir, env=self.env,
+                                        stdout=self._log, stderr=subprocess.STDOUT)
+        deadline = start + self.startup_timeout
+        while time.perf_counter() < deadline:
+            if self.process.poll() is not None:
+                code = self.process.returncode
+                self.stop()
+                raise RuntimeError(f"Server exited during startup with code {code}")
+            try:
+                if requests.get(f"{self.url}/metrics", timeout=1).status_code == 200:
+                    self.startup_seconds = time.perf_counter() - start
+                    return self
+            except requests.RequestException:
+                pass
+            time.sleep(0.05)
+        self.stop()
+        raise RuntimeError("Server did not become ready in time")
+
+    def rss(self):
+        return process_tree_rss(self.process.pid) if self.process else {}
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if getattr(self, '_log', None):
+            self._log.close()
+        if self.owns_workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,55 @@
+"""
+Keeps benchmarked servers off the network. AppServer puts this directory on PYTHONPATH,
+so Python runs this module at startup in every server process.
+
+DeepLake has no setting for its remote calls, so they are patched as its modules load:
+- the PyPI version check made on `import deeplake` fails at once, which DeepLake ignores;
+- the Activeloop profile lookup (https://app.activeloop.ai/api/user/profile) made when a
+  local vector store is searched answers as the anonymous "public" user, which is what
+  the API returns without an Activeloop token.
+AppServer also sets BUGGER_OFF, which turns off DeepLake's crash reporting.
+"""
+import importlib.abc
+import importlib.util
+import sys
+
+
+def _no_latest_version():
+    raise OSError("the PyPI version check is disabled in benchmarks")
+
+
+def _public_profile(self):
+    return {"name": "public"}
+
+
+_PATCHES = {
+    'deeplake.util.check_latest_version': lambda module: setattr(module, 'get_latest_version', _no_latest_version),
+    'deeplake.client.client': lambda module: setattr(module.DeepLakeBackendClient, 'get_user_profile', _public_profile),
+}
+
+
+class _PatchOnImport(importlib.abc.MetaPathFinder):
+    """Finds the modules in _PATCHES with the other finders and patches them once they have run."""
+
+    def find_spec(self, name, path, target=None):
+        patch = _PATCHES.get(name)
+        if patch is None:
+            return None
+        sys.meta_path.remove(self)
+        try:
+            spec = importlib.util.find_spec(name)
+        finally:
+            sys.meta_path.insert(0, self)
+        if spec is None or spec.loader is None:
+            return spec
+        exec_module = spec.loader.exec_module
+
+        def exec_and_patch(module):
+            exec_module(module)
+            patch(module)
+
+        spec.loader.exec_module = exec_and_patch
+        return spec
+
+
+sys.meta_path.insert(0, _PatchOnImport())
@@ -0,0 +1,127 @@
+"""
+Request pipelining benchmark: latency of a pack query with its stages run in sequence
+(PIPELINE_THREADS=0) and as a dependency graph (the default).
+
+The fake auth server adds --auth-latency-ms to the user lookup and the pack version check,
+and the fake OpenAI server --openai-latency-ms to the query embedding. In sequence a query
+waits for all three; pipelined, the embedding and the dataset open overlap the auth
+calls, so a query should take about as long as the longer of the two chains.
+
+For each endpoint and mode it reports p50/p95/p99 latency and throughput, with the pack
+ingested beforehand so only the query path is measured.
+
+    python benchmarks/pipeline_benchmark.py --requests 100 --concurrency 4 --output pipeline.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import REPO_ROOT, AppServer, git_revision, run_load, summarize  # noqa: E402
+from run_benchmarks import HEADERS, QUESTIONS, make_call  # noqa: E402
+from stub_servers import FakeCentralAuth, FakeOpenAI  # noqa: E402
+from synthetic_packs import code_pack, text_pack  # noqa: E402
+
+CONFIG_FILE = os.path.join(REPO_ROOT, 'gunicorn.conf.py')
+
+ENDPOINTS = [
+    ("deepquery-raw", '/deepquery-raw', 'text-0'),
+    ("deepquery-code-raw", '/deepquery-code-raw', 'code-0'),
+]
+
+
+def run(name, pipeline_threads, args, base_env):
+    env = dict(base_env, PIPELINE_THREADS=str(pipeline_threads))
+    command = [sys.executable, '-m', 'gunicorn', '--bind', '{bind}', '-c', CONFIG_FILE, 'app:app']
+    server = AppServer(env=env, command=command)
+    entry = {"pipeline_threads": pipeline_threads, "endpoints": {}}
+    try:
+        server.start()
+        for _, path, pack_id in ENDPOINTS:
+            requests.post(f"{server.url}{path}", headers=HEADERS, timeout=600,
+                          json={"user_message": QUESTIONS[0], "pack_id": pack_id})
+
+        sessions = {}
+
+        def session_per_thread():
+            key = threading.get_ident()
+            if key not in sessions:
+                sessions[key] = requests.Session()
+            return sessions[key]
+
+        for endpoint, path, pack_id in ENDPOINTS:
+            def payload(i, pack_id=pack_id):
+                return {"user_message": f"{QUESTIONS[i % len(QUESTIONS)]} (#{i})", "pack_id": pack_id}
+
+            latencies, errors, wall = run_load(make_call(server, 'POST', path, payload, session_per_thread),
+                                               args.requests, args.concurrency)
+            summary = summarize(latencies, errors)
+            summary["throughput_rps"] = round(len(latencies) / wall, 2) if wall else None
+            entry["endpoints"][endpoint] = summary
+            print(f"{name} {endpoint}: p50={summary.get('p50_ms')}ms p99={summary.get('p99_ms')}ms "
+                  f"rps={summary['throughput_rps']} errors={errors}", file=sys.stderr)
+    except RuntimeError as e:
+        entry["error"] = str(e)
+    finally:
+        server.stop()
+    return entry
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=100, help="Queries per endpoint")
+    parser.add_argument('--concurrency', type=int, default=4, help="Concurrent clients")
+    parser.add_argument('--workers', type=int, default=1, help="WEB_CONCURRENCY")
+    parser.add_argument('--openai-latency-ms', type=float, default=100.0)
+    parser.add_argument('--auth-latency-ms', type=float, default=50.0)
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    openai_stub = FakeOpenAI(latency_ms=args.openai_latency_ms).start()
+    auth_stub = FakeCentralAuth(latency_ms=args.auth_latency_ms).start()
+    auth_stub.add_pack('pack', 'text-0', text_pack())
+    auth_stub.add_pack('code', 'code-0', code_pack())
+
+    base_env = {
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': openai_stub.base_url,
+        'CENTRAL_AUTH_URL': auth_stub.url,
+        'AUTH_API': auth_stub.url,
+        'WEB_CONCURRENCY': str(args.workers),
+    }
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": vars(args),
+        },
+        "runs": {},
+    }
+    try:
+        results["runs"]["sequential"] = run("sequential", 0, args, base_env)
+        results["runs"]["pipelined"] = run("pipelined", 16, args, base_env)
+    finally:
+        openai_stub.stop()
+        auth_stub.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Raw search response benchmark: serialization CPU and bytes on the wire.
+
+1. Serialization: encodes a raw search response of --documents documents of
+   --document-chars characters --iterations times with Flask-RESTful's default json
+   representation and with representations.dumps (orjson), then compresses the orjson body with
+   gzip and, when installed, brotli at the configured levels. Reports microseconds per
+   response and body sizes.
+2. Over HTTP: runs the app against the local stand-ins and requests /deepquery-raw on a
+   text pack with each Accept-Encoding, in the legacy and the structured format (with
+   --max-chars truncation), and reports p50 latency and the bytes received.
+
+    python benchmarks/response_benchmark.py --documents 40 --document-chars 8000 --output responses.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import REPO_ROOT, AppServer, git_revision, run_load, summarize  # noqa: E402
+from run_benchmarks import HEADERS, QUESTIONS  # noqa: E402
+from stub_servers import FakeCentralAuth, FakeOpenAI  # noqa: E402
+from synthetic_packs import text_pack  # noqa: E402
+
+sys.path.insert(0, REPO_ROOT)
+
+import representations  # noqa: E402
+
+CONFIG_FILE = os.path.join(REPO_ROOT, 'gunicorn.conf.py')
+WORDS = ("request", "response", "user", "pack", "query", "error", "vector", "dataset", "token", "embedding",
+         "the", "of", "and", "a", "to", "in", "is", "for", "with", "on")
+
+
+def sample_response(documents, document_chars, seed=0):
+    rng = random.Random(seed)
+    results = {}
+    for i in range(documents):
+        words = []
+        while sum(len(word) + 1 for word in words) < document_chars:
+            words.append(rng.choice(WORDS))
+        results[f"Document {i + 1}"] = " ".join(words)[:document_chars]
+    return {"vector_results": results}
+
+
+def time_per_call(fn, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return round((time.perf_counter() - started) / iterations * 1e6, 1)
+
+
+def serialization(args):
+    from flask import Flask
+    from flask_restful.representations.json import output_json as restful_output_json
+
+    data = sample_response(args.documents, args.document_chars)
+    body = representations.dumps(data)
+    result = {
+        "documents": args.documents,
+        "document_chars": args.document_chars,
+        "raw_bytes": len(body),
+    }
+    with Flask(__name__).test_request_context():
+        result["flask_restful_json_us"] = time_per_call(lambda: restful_output_json(data, 200), args.iterations)
+    result["orjson_us"] = time_per_call(lambda: representations.dumps(data), args.iterations)
+    encodings = ['gzip'] + (['br'] if representations.brotli is not None else [])
+    for encoding in encodings:
+        result[f"{encoding}_bytes"] = len(representations.compress(body, encoding))
+        result[f"{encoding}_us"] = time_per_call(lambda: representations.compress(body, encoding), args.iterations)
+    return result
+
+
+def over_http(args):
+    openai_stub = FakeOpenAI().start()
+    auth_stub = FakeCentralAuth().start()
+    auth_stub.add_pack('pack', 'text-0', text_pack(documents=args.pack_documents))
+    env = {
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': openai_stub.base_url,
+        'CENTRAL_AUTH_URL': auth_stub.url,
+        'AUTH_API': auth_stub.url,
+        'WEB_CONCURRENCY': '1',
+    }
+    command = [sys.executable, '-m', 'gunicorn', '--bind', '{bind}', '-c', CONFIG_FILE, 'app:app']
+    server = AppServer(env=env, command=command)
+    runs = {}
+    try:
+        server.start()
+        requests.post(f"{server.url}/deepquery-raw", headers=HEADERS, timeout=600,
+                      json={"user_message": QUESTIONS[0], "pack_id": 'text-0'})
+
+        formats = {
+            "legacy": {},
+            "structured": {"format": "structured", "k": 4},
+            "structured-truncated": {"format": "structured", "k": 4, "max_chars": args.max_chars},
+        }
+        for format_name, options in formats.items():
+            for accept_encoding in ('identity', 'gzip', 'br'):
+                sessions = {}
+                received = []
+
+                def call(i):
+                    key = threading.get_ident()
+                    if key not in sessions:
+                        sessions[key] = requests.Session()
+                    body = dict(options, user_message=QUESTIONS[i % len(QUESTIONS)], pack_id='text-0')
+                    # stream=True leaves the body encoded, so its size is what went over the wire
+                    response = sessions[key].post(f"{server.url}/deepquery-raw", json=body, stream=True, timeout=600,
+                                                  headers=dict(HEADERS, **{'Accept-Encoding': accept_encoding}))
+                    received.append((len(response.raw.read(decode_content=False)),
+                                     response.headers.get('Content-Encoding', 'identity')))
+                    return response.status_code == 200
+
+                latencies, errors, _ = run_load(call, args.requests, 1)
+                summary = summarize(latencies, errors)
+                summary["mean_bytes"] = round(sum(size for size, _ in received) / max(1, len(received)))
+                summary["content_encoding"] = received[-1][1] if received else None
+                runs[f"{format_name}/{accept_encoding}"] = summary
+                print(f"{format_name} {accept_encoding}: p50={summary.get('p50_ms')}ms "
+                      f"bytes={summary['mean_bytes']} ({summary['content_encoding']})", file=sys.stderr)
+    except RuntimeError as e:
+        runs["error"] = str(e)
+    finally:
+        server.stop()
+        openai_stub.stop()
+        auth_stub.stop()
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, default=40, help="Documents in the serialized response")
+    parser.add_argument('--document-chars', type=int, default=8000, help="Characters per serialized document")
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--pack-documents', type=int, default=5, help="Documents in the text pack served over HTTP")
+    parser.add_argument('--requests', type=int, default=30, help="Requests per format and encoding")
+    parser.add_argument('--max-chars', type=int, default=500, help="max_chars of the truncated structured format")
+    parser.add_argument('--skip-http', action='store_true', help="Only measure serialization")
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": vars(args),
+        },
+        "serialization": serialization(args),
+    }
+    print(json.dumps(results["serialization"]), file=sys.stderr)
+    if not args.skip_http:
+        results["http"] = over_http(args)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""
+End-to-end benchmark of every API endpoint against local stand-ins.
+
+Starts the fake OpenAI and central auth/packman servers with the configured latency,
+registers synthetic code, CSV and text packs, runs the app with its production server
+command in a scratch directory, then measures:
+
+- ingestion throughput (first query on a pack that has never been processed),
+- p50/p95/p99 latency per endpoint under the configured concurrency,
+- server RSS (start, peak during each endpoint, end),
+- upstream calls made to the stubs.
+
+Results are written as JSON so they can be compared across releases:
+    python benchmarks/run_benchmarks.py --requests 50 --concurrency 4 --output bench.json
+Latencies cover successful requests only. The script exits with status 1, after writing
+the results, when any ingestion round or endpoint request failed.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import wave
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import AppServer, MemorySampler, git_revision, run_load, summarize  # noqa: E402
+from stub_servers import FakeCentralAuth, FakeOpenAI  # noqa: E402
+from synthetic_packs import code_pack, csv_pack, pack_size, text_pack  # noqa: E402
+
+QUESTIONS = [
+    "Where is the database configured?",
+    "Which customers from Canada have the highest lifetime value?",
+    "How are retries handled when a request fails?",
+    "Summarize the documents about the search index.",
+    "Which function filters the records by token?",
+    "What does the export pipeline do with the payload?",
+]
+
+HEADERS = {'Authorization': 'Bearer bench-token'}
+
+
+def write_silent_wav(path, seconds=1):
+    """The transcript demo expects landing-examples/audio.wav; create a silent one if it is missing."""
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(16000)
+        f.writeframes(b'\x00\x00' * 16000 * seconds)
+
+
+def endpoint_specs(args):
+    """(name, method, path, payload factory) for every endpoint that is benchmarked."""
+    def question(i):
+        return QUESTIONS[i % len(QUESTIONS)]
+
+    def batch_queries(i):
+        return [f"{question(i + j)} ({j})" for j in range(args.batch_size)]
+
+    return [
+        ("login", 'POST', '/login', lambda i: {"email": "bench@example.com", "password": "bench"}),
+        ("deepquery", 'POST', '/deepquery', lambda i: {"user_message": question(i), "pack_id": "text-0", "history": ""}),
+        ("deepquery-code", 'POST', '/deepquery-code', lambda i: {"user_message": question(i), "pack_id": "code-0", "history": ""}),
+        ("deepquery-raw", 'POST', '/deepquery-raw', lambda i: {"user_message": question(i), "pack_id": "csv-0"}),
+        ("deepquery-code-raw", 'POST', '/deepquery-code-raw', lambda i: {"user_message": question(i), "pack_id": "code-0"}),
+        ("deepquery-raw-batch", 'POST', '/deepquery-raw-batch',
+         lambda i: {"queries": batch_queries(i), "pack_id": "csv-0", "stream": False}),
+        ("deepquery-code-raw-batch", 'POST', '/deepquery-code-raw-batch',
+         lambda i: {"queries": batch_queries(i), "pack_id": "code-0", "stream": False}),
+        ("landing-rag-example", 'POST', '/landing-rag-example', lambda i: {"prompt": question(i)}),
+        ("landing-sentiment-example", 'POST', '/landing-sentiment-example', lambda i: {"prompt": question(i)}),
+        ("landing-webscrape-example", 'POST', '/landing-webscrape-example', lambda i: {"prompt": question(i)}),
+        ("landing-imagegen-example", 'POST', '/landing-imagegen-example', lambda i: {"prompt": question(i)}),
+        ("landing-transcript-example", 'GET', '/landing-transcript-example', None),
+        ("metrics", 'GET', '/metrics', None),
+        ("batch-chat", 'POST', '/batch-chat', lambda i: {"records": [
+            {"pack_id": "text-0", "user_message": question(i + j), "id": f"{i}-{j}"} for j in range(args.batch_size)]}),
+        # Last, because it deletes the datasets built for the other endpoints
+        ("delete-session", 'DELETE', '/delete-session', lambda i: {"user_id": "bench-user"}),
+    ]
+
+
+def make_call(server, method, path, payload_factory, session_per_thread):
+    def call(i):
+        session = session_per_thread()
+        payload = payload_factory(i) if payload_factory else None
+        response = session.request(method, f"{server.url}{path}", json=payload, headers=HEADERS, timeout=600)
+        if path == '/batch-chat' and response.status_code == 202:
+            # Measure the whole job, not just its submission
+            status_url = f"{server.url}{response.json()['status_url']}"
+            while True:
+                status = session.get(status_url, headers=HEADERS, timeout=60).json()
+                if status.get('state') in ('finished', 'failed'):
+                    return status.get('state') == 'finished' and not status.get('failed')
+                time.sleep(0.05)
+        if response.status_code != 200:
+            return False
+        if response.headers.get('Content-Type', '').startswith('application/json'):
+            body = response.json()
+            if isinstance(body, dict) and str(body.get('message', '')).startswith('Token limit exceeded'):
+                return False
+            return not (isinstance(body, dict) and 'error' in body)
+        return True
+    return call
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20, help="Requests per endpoint")
+    parser.add_argument('--concurrency', type=int, default=4, help="Concurrent clients per endpoint")
+    parser.add_argument('--openai-latency-ms', type=float, default=50.0)
+    parser.add_argument('--auth-latency-ms', type=float, default=20.0)
+    parser.add_argument('--code-files', type=int, default=20, help="Python modules in the synthetic code pack")
+    parser.add_argument('--functions-per-file', type=int, default=15)
+    parser.add_argument('--csv-rows', type=int, default=1000)
+    parser.add_argument('--text-documents', type=int, default=5)
+    parser.add_argument('--text-paragraphs', type=int, default=40)
+    parser.add_argument('--ingest-rounds', type=int, default=3, help="Fresh packs ingested per pack type")
+    parser.add_argument('--batch-size', type=int, default=16, help="Queries per batch endpoint request")
+    parser.add_argument('--no-etags', action='store_true', help="Packman stand-in sends no ETags (digest fallback)")
+    parser.add_argument('--endpoints', help="Comma-separated subset of endpoint names to run")
+    parser.add_argument('--server-cmd', help="Server command line; {bind} is replaced with host:port")
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    openai_stub = FakeOpenAI(latency_ms=args.openai_latency_ms).start()
+    auth_stub = FakeCentralAuth(latency_ms=args.auth_latency_ms, etags=not args.no_etags).start()
+
+    # One fresh pack per ingestion round plus the "-0" packs reused by the endpoint benchmarks
+    packs = {}
+    for round_index in range(args.ingest_rounds + 1):
+        packs[('code', f'code-{round_index}')] = code_pack(args.code_files, args.functions_per_file, seed=round_index)
+        packs[('pack', f'csv-{round_index}')] = csv_pack(args.csv_rows, seed=round_index)
+        packs[('pack', f'text-{round_index}')] = text_pack(args.text_documents, args.text_paragraphs, seed=round_index)
+    for (route, pack_id), contents in packs.items():
+        auth_stub.add_pack(route, pack_id, contents)
+
+    env = {
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': openai_stub.base_url,
+        'CENTRAL_AUTH_URL': auth_stub.url,
+        'AUTH_API': auth_stub.url,
+    }
+    command = args.server_cmd.split() if args.server_cmd else None
+    server = AppServer(env=env, command=command)
+    audio_path = os.path.join(server.workdir, 'landing-examples', 'audio.wav')
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": vars(args),
+            "pack_bytes": {f"{route}/{pack_id}": pack_size(contents) for (route, pack_id), contents in packs.items()
+                           if pack_id.endswith('-0')},
+        },
+        "ingestion": {},
+        "endpoints": {},
+        "memory": {},
+    }
+
+    try:
+        server.start()
+        if not os.path.exists(audio_path):
+            write_silent_wav(audio_path)
+        results["meta"]["server_startup_seconds"] = round(server.startup_seconds, 3)
+        results["memory"]["rss_start_bytes"] = sum(server.rss().values())
+
+        # Ingestion: the first raw query on a pack downloads, chunks and embeds it
+        for kind, route, path in (('code', 'code', '/deepquery-code-raw'), ('csv', 'pack', '/deepquery-raw'),
+                                  ('text', 'pack', '/deepquery-raw')):
+            timings = []
+            total_bytes = 0
+            for round_index in range(1, args.ingest_rounds + 1):
+                pack_id = f"{kind}-{round_index}"
+                start = time.perf_counter()
+                response = requests.post(f"{server.url}{path}", headers=HEADERS, timeout=600,
+                                         json={"user_message": QUESTIONS[0], "pack_id": pack_id})
+                elapsed = time.perf_counter() - start
+                if response.status_code == 200:
+                    timings.append(elapsed)
+                    total_bytes += pack_size(packs[(route, pack_id)])
+            results["ingestion"][kind] = {
+                "rounds": len(timings),
+                "latency": summarize(timings, errors=args.ingest_rounds - len(timings)),
+                "bytes_per_second": round(total_bytes / sum(timings), 1) if timings else None,
+            }
+
+        # Warm the "-0" packs so the endpoint numbers are steady-state
+        for path, pack_id in (('/deepquery-raw', 'csv-0'), ('/deepquery-raw', 'text-0'), ('/deepquery-code-raw', 'code-0')):
+            requests.post(f"{server.url}{path}", headers=HEADERS, timeout=600,
+                          json={"user_message": QUESTIONS[0], "pack_id": pack_id})
+
+        selected = set(args.endpoints.split(',')) if args.endpoints else None
+        sessions = {}
+
+        def session_per_thread():
+            key = threading.get_ident()
+            if key not in sessions:
+                sessions[key] = requests.Session()
+            return sessions[key]
+
+        for name, method, path, payload_factory in endpoint_specs(args):
+            if selected and name not in selected:
+                continue
+            openai_stub.reset_stats()
+            auth_stub.reset_stats()
+            sampler = MemorySampler(server.process.pid).start()
+            latencies, errors, wall = run_load(make_call(server, method, path, payload_factory, session_per_thread),
+                                               args.requests, args.concurrency)
+            peak = sampler.stop()
+            entry = summarize(latencies, errors)
+            entry["throughput_rps"] = round(len(latencies) / wall, 2) if wall else None
+            entry["rss_peak_bytes"] = peak
+            entry["upstream_calls"] = {"openai": dict(openai_stub.stats), "auth": dict(auth_stub.stats)}
+            results["endpoints"][name] = entry
+            print(f"{name}: p50={entry.get('p50_ms')}ms p95={entry.get('p95_ms')}ms "
+                  f"p99={entry.get('p99_ms')}ms errors={errors}", file=sys.stderr)
+
+        results["memory"]["rss_end_bytes"] = sum(server.rss().values())
+        results["memory"]["rss_peak_bytes"] = max([entry.get("rss_peak_bytes", 0) for entry in results["endpoints"].values()]
+                                                  + [results["memory"]["rss_end_bytes"]])
+    finally:
+        server.stop()
+        openai_stub.stop()
+        auth_stub.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    failed = [f"ingestion/{kind}" for kind, entry in results["ingestion"].items() if entry["latency"]["errors"]]
+    failed += [name for name, entry in results["endpoints"].items() if entry["errors"]]
+    if failed:
+        print(f"Scenarios with errors: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
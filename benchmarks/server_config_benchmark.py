@@ -0,0 +1,151 @@
+"""
+Compare gunicorn configurations on the local stub harness.
+
+Each configuration runs the app with the same stand-ins, packs and load, and reports
+boot time, p50/p95/p99 latency, throughput, errors and peak RSS per endpoint:
+
+- default:         `gunicorn app:app` (one sync worker, 30 s timeout, no preload)
+- sync:            gunicorn.conf.py with sync workers
+- gthread:         gunicorn.conf.py with threaded workers, no preload
+- gthread-preload: gunicorn.conf.py defaults (threaded workers, preload and warm-up)
+- gevent:          gunicorn.conf.py with gevent workers (skipped if gevent is not installed)
+
+    python benchmarks/server_config_benchmark.py --workers 2 --concurrency 16 --output server.json
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import REPO_ROOT, AppServer, MemorySampler, git_revision, run_load, summarize  # noqa: E402
+from run_benchmarks import HEADERS, QUESTIONS, endpoint_specs, make_call  # noqa: E402
+from stub_servers import FakeCentralAuth, FakeOpenAI  # noqa: E402
+from synthetic_packs import code_pack, csv_pack, text_pack  # noqa: E402
+
+CONFIG_FILE = os.path.join(REPO_ROOT, 'gunicorn.conf.py')
+
+
+def configurations():
+    gunicorn = [sys.executable, '-m', 'gunicorn', '--bind', '{bind}']
+    configured = gunicorn + ['-c', CONFIG_FILE, 'app:app']
+    configs = [
+        ("default", {}, gunicorn + ['app:app']),
+        ("sync", {'GUNICORN_WORKER_CLASS': 'sync', 'GUNICORN_PRELOAD': '0'}, configured),
+        ("gthread", {'GUNICORN_WORKER_CLASS': 'gthread', 'GUNICORN_PRELOAD': '0'}, configured),
+        ("gthread-preload", {'GUNICORN_WORKER_CLASS': 'gthread', 'GUNICORN_PRELOAD': '1'}, configured),
+    ]
+    if importlib.util.find_spec('gevent'):
+        configs.append(("gevent", {'GUNICORN_WORKER_CLASS': 'gevent'}, configured))
+    return configs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=40, help="Requests per endpoint")
+    parser.add_argument('--concurrency', type=int, default=16, help="Concurrent clients per endpoint")
+    parser.add_argument('--workers', type=int, default=2, help="WEB_CONCURRENCY for the configured servers")
+    parser.add_argument('--threads', type=int, default=8, help="GUNICORN_THREADS for gthread")
+    parser.add_argument('--openai-latency-ms', type=float, default=200.0)
+    parser.add_argument('--auth-latency-ms', type=float, default=20.0)
+    parser.add_argument('--batch-size', type=int, default=16, help="Queries per batch endpoint request")
+    parser.add_argument('--endpoints', default='deepquery,deepquery-raw,deepquery-code-raw,landing-rag-example',
+                        help="Comma-separated endpoint names from run_benchmarks.py")
+    parser.add_argument('--configs', help="Comma-separated subset of configuration names")
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    openai_stub = FakeOpenAI(latency_ms=args.openai_latency_ms).start()
+    auth_stub = FakeCentralAuth(latency_ms=args.auth_latency_ms).start()
+    auth_stub.add_pack('code', 'code-0', code_pack())
+    auth_stub.add_pack('pack', 'csv-0', csv_pack())
+    auth_stub.add_pack('pack', 'text-0', text_pack())
+
+    base_env = {
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': openai_stub.base_url,
+        'CENTRAL_AUTH_URL': auth_stub.url,
+        'AUTH_API': auth_stub.url,
+        'WEB_CONCURRENCY': str(args.workers),
+        'GUNICORN_THREADS': str(args.threads),
+    }
+    selected_endpoints = set(args.endpoints.split(','))
+    selected_configs = set(args.configs.split(',')) if args.configs else None
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": vars(args),
+        },
+        "configs": {},
+    }
+
+    try:
+        for name, extra_env, command in configurations():
+            if selected_configs and name not in selected_configs:
+                continue
+            server = AppServer(env=dict(base_env, **extra_env), command=command)
+            entry = {"endpoints": {}}
+            try:
+                server.start()
+                entry["startup_seconds"] = round(server.startup_seconds, 3)
+                entry["rss_start_bytes"] = sum(server.rss().values())
+
+                # Ingest the packs once so every configuration measures steady-state queries
+                for path, pack_id in (('/deepquery-raw', 'csv-0'), ('/deepquery-raw', 'text-0'),
+                                      ('/deepquery-code-raw', 'code-0')):
+                    requests.post(f"{server.url}{path}", headers=HEADERS, timeout=600,
+                                  json={"user_message": QUESTIONS[0], "pack_id": pack_id})
+
+                sessions = {}
+
+                def session_per_thread():
+                    key = threading.get_ident()
+                    if key not in sessions:
+                        sessions[key] = requests.Session()
+                    return sessions[key]
+
+                for endpoint, method, path, payload_factory in endpoint_specs(args):
+                    if endpoint not in selected_endpoints:
+                        continue
+                    sampler = MemorySampler(server.process.pid).start()
+                    latencies, errors, wall = run_load(make_call(server, method, path, payload_factory,
+                                                                 session_per_thread),
+                                                       args.requests, args.concurrency)
+                    summary = summarize(latencies, errors)
+                    summary["throughput_rps"] = round(len(latencies) / wall, 2) if wall else None
+                    summary["rss_peak_bytes"] = sampler.stop()
+                    entry["endpoints"][endpoint] = summary
+                    print(f"{name} {endpoint}: p50={summary.get('p50_ms')}ms p95={summary.get('p95_ms')}ms "
+                          f"rps={summary['throughput_rps']} errors={errors}", file=sys.stderr)
+                entry["rss_end_bytes"] = sum(server.rss().values())
+            except RuntimeError as e:
+                entry["error"] = str(e)
+            finally:
+                server.stop()
+            results["configs"][name] = entry
+    finally:
+        openai_stub.stop()
+        auth_stub.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Worker startup benchmark: import time, server boot time and per-worker memory.
+
+Measures, for each server configuration:
+
+- how long `import app` takes in a fresh interpreter (median of --import-runs),
+- how long the server takes from exec until /metrics answers,
+- RSS and PSS of the master and every worker (PSS from /proc/<pid>/smaps_rollup counts
+  pages shared copy-on-write between workers only once per sharer),
+- the latency of the first request that needs the lazily imported dependencies.
+
+Configurations compared:
+- lazy:    plain gunicorn, heavy imports happen on the first request in each worker
+- preload: gunicorn --preload with APP_WARM_UP=1, heavy imports happen once in the master
+
+    python benchmarks/startup_benchmark.py --workers 4 --output startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import REPO_ROOT, AppServer, git_revision, process_tree_rss  # noqa: E402
+from stub_servers import FakeCentralAuth, FakeOpenAI  # noqa: E402
+from synthetic_packs import text_pack  # noqa: E402
+
+HEADERS = {'Authorization': 'Bearer bench-token'}
+
+
+def process_pss(pid):
+    """Proportional set size of one process in bytes (Linux 4.14+), or None if unavailable."""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def import_seconds(env, runs):
+    """Median wall time of `import app` in a fresh interpreter."""
+    timings = []
+    code = "import time; start = time.perf_counter(); import app; print(time.perf_counter() - start)"
+    # The app creates uploads/ and app.log in its working directory
+    workdir = tempfile.mkdtemp(prefix='sourcebox-import-')
+    try:
+        for _ in range(runs):
+            output = subprocess.check_output([sys.executable, '-c', code], cwd=workdir, env=env,
+                                             stderr=subprocess.DEVNULL)
+            timings.append(float(output.decode().strip().splitlines()[-1]))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return round(statistics.median(timings), 3)
+
+
+def measure_server(name, env, command, args):
+    server = AppServer(env=env, command=command)
+    try:
+        server.start()
+        # Give every worker a moment to finish booting before sampling memory
+        time.sleep(args.settle_seconds)
+        master = server.process.pid
+        processes = process_tree_rss(master)
+        workers = sorted(pid for pid in processes if pid != master)
+
+        start = time.perf_counter()
+        response = requests.post(f"{server.url}/deepquery-raw", headers=HEADERS, timeout=600,
+                                 json={"user_message": "Where is the search index?", "pack_id": "text-0"})
+        first_request = time.perf_counter() - start
+
+        return {
+            "config": name,
+            "startup_seconds": round(server.startup_seconds, 3),
+            "first_request_seconds": round(first_request, 3),
+            "first_request_status": response.status_code,
+            "master": {"rss_bytes": processes.get(master), "pss_bytes": process_pss(master)},
+            "workers": [{"rss_bytes": processes[pid], "pss_bytes": process_pss(pid)} for pid in workers],
+            "total_rss_bytes": sum(processes.values()),
+            "total_pss_bytes": sum(filter(None, (process_pss(pid) for pid in processes))),
+        }
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn workers per configuration")
+    parser.add_argument('--import-runs', type=int, default=3, help="Fresh interpreters per import measurement")
+    parser.add_argument('--settle-seconds', type=float, default=2.0)
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    openai_stub = FakeOpenAI().start()
+    auth_stub = FakeCentralAuth().start()
+    auth_stub.add_pack('pack', 'text-0', text_pack(2, 10))
+    env = {
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': openai_stub.base_url,
+        'CENTRAL_AUTH_URL': auth_stub.url,
+        'AUTH_API': auth_stub.url,
+    }
+
+    base_env = dict(os.environ, **env)
+    base_env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')]))
+    base_env.setdefault('LOG_LEVEL', 'WARNING')
+
+    gunicorn = [sys.executable, '-m', 'gunicorn', '--bind', '{bind}', '--workers', str(args.workers)]
+    configs = [
+        ("lazy", {}, gunicorn + ['app:app']),
+        ("preload", {'APP_WARM_UP': '1'}, gunicorn + ['--preload', 'app:app']),
+    ]
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": vars(args),
+        },
+        "import_seconds": {
+            "lazy": import_seconds(base_env, args.import_runs),
+            "warm_up": import_seconds(dict(base_env, APP_WARM_UP='1'), args.import_runs),
+        },
+        "servers": [],
+    }
+
+    try:
+        for name, extra_env, command in configs:
+            entry = measure_server(name, dict(env, **extra_env), command, args)
+            results["servers"].append(entry)
+            print(f"{name}: startup={entry['startup_seconds']}s first_request={entry['first_request_seconds']}s "
+                  f"total_pss={entry['total_pss_bytes']}", file=sys.stderr)
+    finally:
+        openai_stub.stop()
+        auth_stub.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
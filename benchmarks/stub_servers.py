@@ -0,0 +1,258 @@
+"""
+Local stand-ins for the services the API depends on, for benchmarks and offline runs.
+
+- FakeOpenAI serves the subset of the OpenAI API used by the app: embeddings, chat
+  completions, image generation and audio transcriptions. Embeddings are deterministic
+  hashed bag-of-words vectors, so similar texts get similar vectors.
+- FakeCentralAuth serves /login, /user/id, /user/token_usage, /user/add_tokens and the
+  /packman/{pack,code}/details/<pack_id> routes from packs registered in memory
+  (with add_pack, or over HTTP with POST /_packs/{pack,code}/<pack_id> and a JSON list
+  of content entries). Pack responses carry an ETag and honour If-None-Match unless
+  the stand-in is created with etags=False.
+
+Both add a configurable latency to every call and count calls per route (GET /_stats).
+
+Run standalone:
+    python benchmarks/stub_servers.py --openai-port 18080 --auth-port 18081 --latency-ms 50
+then start the app with OPENAI_BASE_URL=http://127.0.0.1:18080/v1,
+CENTRAL_AUTH_URL=http://127.0.0.1:18081 and AUTH_API=http://127.0.0.1:18081.
+"""
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+EMBEDDING_DIMENSIONS = 1536
+
+_word_pattern = re.compile(r"\w+")
+
+
+def fake_embedding(text, dimensions=EMBEDDING_DIMENSIONS):
+    """Hashed bag-of-words embedding: each token adds +/-1 to one dimension, then L2-normalize."""
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for token in _word_pattern.findall(text.lower()):
+        digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, 'little')
+        vector[value % dimensions] += 1.0 if (value >> 63) & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector[0] = 1.0
+        norm = 1.0
+    return (vector / norm).tolist()
+
+
+class _StubServer:
+    """A threaded HTTP server with per-route call counters and injected latency."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, route, amount=1):
+        with self._stats_lock:
+            self.stats[route] = self.stats.get(route, 0) + amount
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats.clear()
+
+    def handle(self, method, path, headers, body):
+        """Return (status, JSON-serializable body[, response headers]). Implemented by subclasses."""
+        raise NotImplementedError
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _dispatch(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                path = self.path.split('?', 1)[0]
+
+                if path == '/_stats':
+                    status, response = 200, dict(stub.stats)
+                else:
+                    if stub.latency:
+                        time.sleep(stub.latency)
+                    try:
+                        status, response, *extra = stub.handle(method, path, self.headers, body)
+                    except Exception as e:
+                        status, response, extra = 500, {"error": {"message": str(e)}}, []
+
+                data = json.dumps(response).encode('utf-8') if status != 304 else b''
+                self.send_response(status)
+                for name, value in (extra[0] if extra else {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._dispatch('GET')
+
+            def do_POST(self):
+                self._dispatch('POST')
+
+        return Handler
+
+
+class FakeOpenAI(_StubServer):
+    """Embeddings, chat completions, images and transcriptions with OpenAI-compatible responses."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0.0, dimensions=EMBEDDING_DIMENSIONS):
+        super().__init__(host, port, latency_ms)
+        self.dimensions = dimensions
+
+    @property
+    def base_url(self):
+        return f"{self.url}/v1"
+
+    def handle(self, method, path, headers, body):
+        if path.endswith('/embeddings'):
+            request = json.loads(body)
+            inputs = request['input']
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self.count('embeddings')
+            self.count('embedded_texts', len(inputs))
+            tokens = sum(len(_word_pattern.findall(text)) for text in inputs)
+            return 200, {
+                "object": "list",
+                "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(text, self.dimensions)}
+                         for i, text in enumerate(inputs)],
+                "model": request.get('model', 'text-embedding-3-small'),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }
+
+        if path.endswith('/chat/completions'):
+            request = json.loads(body)
+            self.count('chat_completions')
+            prompt = request['messages'][-1]['content']
+            content = f"Stub answer based on {len(prompt)} characters of context."
+            return 200, {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get('model', 'gpt-4o-mini'),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": 10,
+                          "total_tokens": len(prompt) // 4 + 10},
+            }
+
+        if path.endswith('/images/generations'):
+            self.count('images')
+            return 200, {"created": int(time.time()), "data": [{"url": "https://example.invalid/stub.png"}]}
+
+        if path.endswith('/audio/transcriptions'):
+            self.count('transcriptions')
+            return 200, {"text": f"Stub transcription of {len(body)} bytes."}
+
+        return 404, {"error": {"message": f"Unknown route {path}"}}
+
+
+class FakeCentralAuth(_StubServer):
+    """Central auth and packman routes backed by an in-memory pack registry."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0.0, user_id='bench-user', total_tokens=0, etags=True):
+        super().__init__(host, port, latency_ms)
+        self.user_id = user_id
+        self.total_tokens = total_tokens
+        self.etags = etags
+        self.packs = {}
+
+    def add_pack(self, route, pack_id, contents):
+        """Register a pack; `route` is 'pack' or 'code' and contents are packman content entries."""
+        self.packs[(route, str(pack_id))] = contents
+
+    def handle(self, method, path, headers, body):
+        if path == '/login' and method == 'POST':
+            self.count('login')
+            return 200, {"access_token": "bench-token"}
+
+        if path == '/user/id':
+            self.count('user_id')
+            return 200, {"user_id": self.user_id}
+
+        if path == '/user/token_usage':
+            self.count('token_usage')
+            return 200, {"total_tokens": self.total_tokens}
+
+        if path == '/user/add_tokens' and method == 'POST':
+            # Counted but not added to total_tokens, so long benchmarks never reach the token limit
+            self.count('add_tokens')
+            self.count('added_tokens', json.loads(body or b'{}').get('tokens', 0))
+            return 200, {"message": "ok"}
+
+        match = re.fullmatch(r'/_packs/(pack|code)/([^/]+)', path)
+        if match and method == 'POST':
+            self.add_pack(match.group(1), match.group(2), json.loads(body))
+            return 200, {"message": "registered"}
+
+        match = re.fullmatch(r'/packman/(pack|code)/details/([^/]+)', path)
+        if match:
+            self.count(f'packman_{match.group(1)}')
+            contents = self.packs.get((match.group(1), match.group(2)))
+            if contents is None:
+                return 404, {"error": "Pack not found"}
+            if not self.etags:
+                return 200, {"pack_id": match.group(2), "contents": contents}
+            etag = '"%s"' % hashlib.sha256(json.dumps(contents, sort_keys=True).encode()).hexdigest()[:32]
+            if headers.get('If-None-Match') == etag:
+                self.count('packman_not_modified')
+                return 304, None, {'ETag': etag}
+            return 200, {"pack_id": match.group(2), "contents": contents}, {'ETag': etag}
+
+        return 404, {"error": f"Unknown route {path}"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the fake OpenAI and central auth servers.")
+    parser.add_argument('--openai-port', type=int, default=18080)
+    parser.add_argument('--auth-port', type=int, default=18081)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="Latency added to every call")
+    args = parser.parse_args()
+
+    openai_stub = FakeOpenAI(port=args.openai_port, latency_ms=args.latency_ms).start()
+    auth_stub = FakeCentralAuth(port=args.auth_port, latency_ms=args.latency_ms).start()
+    print(f"OPENAI_BASE_URL={openai_stub.base_url}")
+    print(f"CENTRAL_AUTH_URL={auth_stub.url}")
+    print(f"AUTH_API={auth_stub.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        openai_stub.stop()
+        auth_stub.stop()
+
+
+if __name__ == '__main__':
+    main()
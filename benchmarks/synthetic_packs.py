@@ -0,0 +1,84 @@
+"""
+Deterministic synthetic packs in the packman content format (`{data_type, filename, content}`).
+
+Every generator takes a seed, so the same arguments always produce the same pack and
+benchmark results stay comparable across runs and releases.
+"""
+import random
+
+WORDS = (
+    "account address analysis api async batch buffer cache client cluster config customer "
+    "database dataset deploy document embedding endpoint error event export feature file "
+    "filter handler index ingest invoice latency limit loader memory metric model network "
+    "order package payload pipeline query queue record region report request response "
+    "retry review schema search server service session shard storage stream table tenant "
+    "token trace upload user vector version worker"
+).split()
+
+COUNTRIES = ["Canada", "Brazil", "Kenya", "Japan", "Germany", "India", "Mexico", "Norway", "Chile", "Egypt"]
+
+
+def _sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def text_pack(documents=5, paragraphs=40, seed=0):
+    """Plain-text documents of `paragraphs` paragraphs each."""
+    rng = random.Random(seed)
+    contents = []
+    for index in range(documents):
+        body = "\n\n".join(" ".join(_sentence(rng) for _ in range(5)) for _ in range(paragraphs))
+        contents.append({"data_type": "file", "filename": f"document_{index}.txt", "content": body})
+    return contents
+
+
+def csv_pack(rows=1000, seed=0):
+    """A single customers-style CSV with numeric, categorical and free-text columns."""
+    rng = random.Random(seed)
+    lines = ["customer_id,name,country,orders,lifetime_value,notes"]
+    for index in range(rows):
+        lines.append(",".join([
+            str(index),
+            f"{rng.choice(WORDS).title()} {rng.choice(WORDS).title()}",
+            rng.choice(COUNTRIES),
+            str(rng.randint(0, 200)),
+            f"{rng.uniform(0, 50000):.2f}",
+            " ".join(rng.choice(WORDS) for _ in range(6)),
+        ]))
+    return [{"data_type": "file", "filename": "customers.csv", "content": "\n".join(lines) + "\n"}]
+
+
+def code_pack(files=20, functions_per_file=15, seed=0):
+    """A small repository of Python modules plus a README and a JavaScript file."""
+    rng = random.Random(seed)
+    contents = []
+    for index in range(files):
+        module = rng.choice(WORDS)
+        blocks = [f'"""Module {index}: {_sentence(rng, 8)}"""', "import logging", "",
+                  "logger = logging.getLogger(__name__)", ""]
+        for function in range(functions_per_file):
+            name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{function}"
+            argument = rng.choice(WORDS)
+            blocks.append(
+                f"def {name}({argument}, limit={rng.randint(1, 100)}):\n"
+                f'    """{_sentence(rng, 10)}"""\n'
+                f"    results = []\n"
+                f"    for item in {argument}[:limit]:\n"
+                f"        if item.get('{rng.choice(WORDS)}'):\n"
+                f"            results.append(item['{rng.choice(WORDS)}'])\n"
+                f"    logger.debug('{name} produced %d results', len(results))\n"
+                f"    return results\n"
+            )
+        contents.append({"data_type": "file", "filename": f"{module}_{index}.py", "content": "\n\n".join(blocks)})
+
+    contents.append({"data_type": "file", "filename": "README.md",
+                     "content": "# Synthetic repository\n\n" + "\n\n".join(_sentence(rng) for _ in range(30))})
+    contents.append({"data_type": "file", "filename": "index.js",
+                     "content": "\n".join(f"export function {rng.choice(WORDS)}{i}(x) {{ return x * {i}; }}"
+                                          for i in range(200))})
+    return contents
+
+
+def pack_size(contents):
+    """Total size of a pack's contents in bytes (UTF-8)."""
+    return sum(len(entry["content"].encode("utf-8")) for entry in contents)
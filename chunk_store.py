@@ -0,0 +1,339 @@
+import array
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+# Written last; a chunk store without it is incomplete and ignored
+META_FILE = 'meta.json'
+
+
+class ChunkStore:
+    """
+    Compact, read-only copy of a dataset's chunks for search.
+
+    Layout (a `chunks` folder next to the DeepLake dataset):
+    - texts.bin:      every chunk's UTF-8 text, concatenated
+    - offsets.npy:    uint64[n + 1], chunk i is texts.bin[offsets[i]:offsets[i + 1]]
+    - sources.json:   distinct source names, interned
+    - source_ids.npy: uint32[n], index into sources.json per chunk
+    - lines.npy:      int32[n, 2], first and last line of each chunk in its source (0 = unknown)
+    - embeddings.npy: float32[n, dim], L2-normalized, so cosine similarity is a dot product
+    - duplicates.npy: int32[d, 4], (chunk, source id, first line, last line) of every chunk
+                      that was not stored because it duplicates `chunk`, sorted by chunk
+    - meta.json:      counts and format version
+
+    Everything except sources.json is memory-mapped: opening a store reads no chunk data,
+    pages are shared between workers through the page cache, and a search touches only
+    the embedding matrix and the texts of its hits.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported chunk store version {self.meta.get('version')} in {path}")
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.source_ids = np.load(os.path.join(path, 'source_ids.npy'), mmap_mode='r')
+        self.lines = np.load(os.path.join(path, 'lines.npy'), mmap_mode='r')
+        self.embeddings = np.load(os.path.join(path, 'embeddings.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'sources.json'), encoding='utf-8') as f:
+            self.sources = json.load(f)
+        # Stores built before deduplication have no duplicates file
+        duplicates_path = os.path.join(path, 'duplicates.npy')
+        self._duplicates = np.load(duplicates_path, mmap_mode='r') if os.path.exists(duplicates_path) else None
+        with open(os.path.join(path, 'texts.bin'), 'rb') as f:
+            # mmap of an empty file is not allowed
+            self._texts = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.meta['text_bytes'] else b''
+
+    def __len__(self):
+        return self.meta['count']
+
+    def text(self, index):
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        return str(memoryview(self._texts)[start:end], 'utf-8')
+
+    def source(self, index):
+        return self.sources[int(self.source_ids[index])]
+
+    def line_range(self, index):
+        start, end = self.lines[index]
+        return int(start), int(end)
+
+    def duplicates(self, index):
+        """(source, (first, last)) of every chunk deduplicated into chunk `index`."""
+        if self._duplicates is None or not len(self._duplicates):
+            return []
+        column = self._duplicates[:, 0]
+        start, end = np.searchsorted(column, index, 'left'), np.searchsorted(column, index, 'right')
+        return [(self.sources[int(source_id)], (int(first), int(last)))
+                for _, source_id, first, last in self._duplicates[start:end]]
+
+    def search(self, query_vectors, k=4):
+        """
+        Top-k chunk ids and cosine scores for each query vector.
+
+        Returns (ids, scores), both shaped [len(query_vectors), k], best first.
+        """
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        scores = (queries / norms) @ self.embeddings.T
+
+        k = max(1, min(k, scores.shape[1]))
+        if k < scores.shape[1]:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    @staticmethod
+    def build(path, texts, sources, lines, embedding_blocks, duplicates=()):
+        """
+        Write a chunk store for `texts` (with per-chunk source names and (first, last) line
+        ranges in the same order) and atomically replace any store at `path`.
+
+        `embedding_blocks` yields the chunks' embeddings in the same order, as [rows, dim]
+        blocks; each block is normalized as it is written to the memory-mapped matrix, so
+        the whole matrix is never held in memory. `duplicates` lists (chunk index, source,
+        (first, last)) for chunks left out as duplicates of a stored chunk.
+        """
+        if len(texts) != len(sources) or len(texts) != len(lines):
+            raise ValueError("texts, sources and lines must have the same length")
+
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        try:
+            dimensions = _write_embeddings(os.path.join(tmp_path, 'embeddings.npy'), len(texts), embedding_blocks)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        offsets = np.zeros(len(texts) + 1, dtype=np.uint64)
+        with open(os.path.join(tmp_path, 'texts.bin'), 'wb') as f:
+            position = 0
+            for index, text in enumerate(texts):
+                data = text.encode('utf-8')
+                f.write(data)
+                position += len(data)
+                offsets[index + 1] = position
+
+        interned = {}
+        source_ids = np.array([interned.setdefault(source, len(interned)) for source in sources], dtype=np.uint32)
+        duplicate_rows = np.array(sorted((row, interned.setdefault(source, len(interned)), first, last)
+                                         for row, source, (first, last) in duplicates),
+                                  dtype=np.int32).reshape(-1, 4)
+
+
+        np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+        np.save(os.path.join(tmp_path, 'source_ids.npy'), source_ids)
+        np.save(os.path.join(tmp_path, 'lines.npy'), np.asarray(lines, dtype=np.int32).reshape(len(texts), 2))
+        np.save(os.path.join(tmp_path, 'duplicates.npy'), duplicate_rows)
+        with open(os.path.join(tmp_path, 'sources.json'), 'w', encoding='utf-8') as f:
+            json.dump(list(interned), f)
+        with open(os.path.join(tmp_path, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump({"version": FORMAT_VERSION, "count": len(texts), "dimensions": dimensions,
+                       "text_bytes": int(offsets[-1]), "sources": len(interned),
+                       "duplicates": len(duplicate_rows)}, f)
+
+        # Open readers keep their mappings of the old files until they are dropped
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        logger.info("Built chunk store %s: %d chunks, %d duplicates, %d text bytes, %d sources",
+                    path, len(texts), len(duplicate_rows), int(offsets[-1]), len(interned))
+
+
+def _write_embeddings(path, count, blocks):
+    """
+    Write `count` embeddings, arriving as [rows, dim] blocks, L2-normalized to a .npy file
+    at `path`. Returns the number of dimensions (0 without embeddings).
+    """
+    matrix = None
+    written = 0
+    for block in blocks:
+        block = np.asarray(block, dtype=np.float32)
+        if not block.size:
+            continue
+        if block.ndim != 2 or written + block.shape[0] > count:
+            raise ValueError(f"Got more than {count} embeddings, or a block that is not [rows, dim]")
+        if matrix is None:
+            # The number of dimensions is known from the first block
+            matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(count, block.shape[1]))
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix[written:written + block.shape[0]] = block / norms
+        written += block.shape[0]
+    if written != count:
+        raise ValueError(f"Got {written} embeddings for {count} chunks")
+
+    if matrix is None:
+        np.save(path, np.zeros((0, 0), dtype=np.float32))
+        return 0
+    matrix.flush()
+    dimensions = int(matrix.shape[1])
+    del matrix
+    return dimensions
+
+
+class TextSpool:
+    """
+    Chunk texts collected during ingestion, kept in a temporary file instead of memory
+    until ChunkStore.build writes them out. Supports append, len and iteration.
+    """
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._lengths = array.array('Q')
+
+    def append(self, text):
+        data = text.encode('utf-8')
+        self._file.write(data)
+        self._lengths.append(len(data))
+
+    def extend(self, texts):
+        for text in texts:
+            self.append(text)
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def __iter__(self):
+        self._file.flush()
+        self._file.seek(0)
+        try:
+            for length in self._lengths:
+                yield self._file.read(length).decode('utf-8')
+        finally:
+            self._file.seek(0, os.SEEK_END)
+
+    def close(self):
+        self._file.close()
+
+
+# Duplicate sources of a dataset's chunks keyed by chunk text, for searches of the DeepLake dataset
+DUPLICATES_FILE = 'duplicates.json'
+
+
+def duplicates_path(dataset_path):
+    """Duplicates file of the DeepLake dataset at `dataset_path` (next to its chunk store)."""
+    return os.path.join(os.path.dirname(dataset_path), DUPLICATES_FILE)
+
+
+def text_key(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def write_duplicates(path, texts, duplicates):
+    """
+    Record the chunks left out as duplicates for searches that find their stored chunk in
+    the DeepLake dataset, where stored chunks have no row numbers to look them up by.
+
+    `texts` are the stored chunks in row order and `duplicates` lists (row, source,
+    (first, last)) as for ChunkStore.build. The file maps text_key(stored chunk text) to
+    [[source, first, last], ...].
+    """
+    by_row = {}
+    for row, source, (first, last) in duplicates:
+        by_row.setdefault(row, []).append([source, int(first), int(last)])
+    keyed = {text_key(text): by_row[row] for row, text in enumerate(texts) if row in by_row}
+
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(keyed, f)
+    os.replace(tmp_path, path)
+    logger.info("Wrote duplicates of %d chunks to %s", len(keyed), path)
+
+
+_duplicates_cache = OrderedDict()
+_duplicates_lock = threading.Lock()
+
+
+def read_duplicates(path):
+    """The mapping written by write_duplicates, or {} without one; re-read when the file changes."""
+    try:
+        stamp = os.stat(path).st_mtime_ns
+    except OSError:
+        return {}
+    with _duplicates_lock:
+        cached = _duplicates_cache.get(path)
+        if cached and cached[0] == stamp:
+            _duplicates_cache.move_to_end(path)
+            return cached[1]
+    try:
+        with open(path, encoding='utf-8') as f:
+            keyed = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable duplicates file %s: %s", path, e)
+        return {}
+    with _duplicates_lock:
+        _duplicates_cache[path] = (stamp, keyed)
+        while len(_duplicates_cache) > _cache.size:
+            _duplicates_cache.popitem(last=False)
+    return keyed
+
+
+def store_path(dataset_path):
+    """Chunk store folder of the DeepLake dataset at `dataset_path` (its sibling `chunks`)."""
+    return os.path.join(os.path.dirname(dataset_path), 'chunks')
+
+
+def remove(path):
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class _StoreCache:
+    """Recently opened chunk stores, reopened when their meta.json changes (a rebuild)."""
+
+    def __init__(self, size):
+        self.size = size
+        self._stores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        try:
+            stamp = os.stat(os.path.join(path, META_FILE)).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            cached = self._stores.get(path)
+            if cached and cached[0] == stamp:
+                self._stores.move_to_end(path)
+                return cached[1]
+        try:
+            store = ChunkStore(path)
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable chunk store %s: %s", path, e)
+            return None
+        with self._lock:
+            self._stores[path] = (stamp, store)
+            self._stores.move_to_end(path)
+            while len(self._stores) > self.size:
+                self._stores.popitem(last=False)
+        return store
+
+
+_cache = _StoreCache(int(os.getenv('CHUNK_STORE_CACHE_SIZE', '64')))
+
+
+def open_store(path):
+    """The chunk store at `path`, or None if there is no complete one."""
+    return _cache.get(path)
@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import pytest
+
+from chunk_store import ChunkStore, open_store
+
+TEXTS = ["alpha beta", "gamma", "delta epsilon zeta"]
+SOURCES = ["a.txt", "a.txt", "b.md"]
+LINES = [(1, 1), (2, 2), (1, 3)]
+
+
+def blocks(matrix, size):
+    for start in range(0, len(matrix), size):
+        yield matrix[start:start + size]
+
+
+def test_build_from_blocks_writes_a_normalized_matrix(tmp_path):
+    matrix = np.array([[3, 4], [0, 0], [1, 0]], dtype=np.float32)
+    path = str(tmp_path / 'chunks')
+    ChunkStore.build(path, TEXTS, SOURCES, LINES, blocks(matrix, 2), [(0, 'c.txt', (5, 6))])
+
+    store = open_store(path)
+    assert len(store) == 3 and store.meta['dimensions'] == 2
+    assert np.allclose(store.embeddings, [[0.6, 0.8], [0, 0], [1, 0]])
+    assert [store.text(i) for i in range(3)] == TEXTS
+    assert store.source(2) == 'b.md' and store.line_range(2) == (1, 3)
+    assert store.duplicates(0) == [('c.txt', (5, 6))]
+
+    ids, scores = store.search([[1, 1]], k=2)
+    assert ids.tolist() == [[0, 2]]
+    assert np.allclose(scores, [[1.4 / 2 ** 0.5, 1 / 2 ** 0.5]])
+
+
+def test_build_without_chunks(tmp_path):
+    path = str(tmp_path / 'chunks')
+    ChunkStore.build(path, [], [], [], iter(()))
+    store = open_store(path)
+    assert len(store) == 0 and store.embeddings.shape == (0, 0)
+
+
+@pytest.mark.parametrize('rows', [2, 4])
+def test_wrong_number_of_embeddings_leaves_no_store(tmp_path, rows):
+    path = str(tmp_path / 'chunks')
+    with pytest.raises(ValueError):
+        ChunkStore.build(path, TEXTS, SOURCES, LINES, blocks(np.ones((rows, 2)), 1))
+    assert os.listdir(tmp_path) == []
@@ -1,17 +1,19 @@
 import logging
 import time
+import metrics
+import embedding_batcher
+
+
+def _is_rate_limit(error):
+    # Also matches the error raised once the retries are used up
+    return "rate limit" in str(error).lower()
 
-# Configure logging (if not already configured elsewhere in your application)
-logging.basicConfig(
-    level=logging.ERROR,  # Only log errors
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('app.log'),
-        logging.StreamHandler()
-    ]
-)
 
 class CustomEmbeddingFunction:
+    # Backend name and vector size recorded with each dataset (see embedding_backends.py)
+    name = 'openai'
+    dimensions = 1536
+
     def __init__(self, client, max_retries=3, retry_delay=5):
         self.client = client
         self.max_retries = max_retries  # Maximum number of retries
@@ -24,6 +26,9 @@ class CustomEmbeddingFunction:
 
         while retries < self.max_retries:
             try:
+                metrics.embedding_requests.inc()
+                metrics.embedded_texts.inc(len(document_texts))
+                metrics.embedding_batch_size.observe(len(document_texts))
                 response = self.client.embeddings.create(
                     input=document_texts,
                     model="text-embedding-3-small"
@@ -31,9 +36,10 @@ class CustomEmbeddingFunction:
                 embeddings = [item.embedding for item in response.data]
                 return embeddings  # Return embeddings if successful
             except Exception as e:
-                if "rate limit" in str(e).lower():
+                if _is_rate_limit(e):
                     self.logger.error("Rate limit error: %s. Retrying in %d seconds...", str(e), self.retry_delay)
                     retries += 1
+                    metrics.openai_retries.inc(operation='embeddings')
                     time.sleep(self.retry_delay)  # Wait before retrying
                 else:
                     self.logger.error("Error creating embeddings for documents: %s", str(e))
@@ -44,20 +50,32 @@ class CustomEmbeddingFunction:
 
     def embed_query(self, query):
         query_text = str(query)
+        if embedding_batcher.EMBED_BATCH_WINDOW_MS > 0:
+            # Concurrent queries in this process share one embeddings call
+            batcher = embedding_batcher.batcher_for((id(self.client), "text-embedding-3-small"), self._embed_queries,
+                                                    shared_error=_is_rate_limit)
+            return batcher.embed_one(query_text)
+        return self._embed_queries([query_text])[0]
+
+    def _embed_queries(self, query_texts):
         retries = 0
 
         while retries < self.max_retries:
             try:
+                metrics.embedding_requests.inc()
+                metrics.embedded_texts.inc(len(query_texts))
+                metrics.embedding_batch_size.observe(len(query_texts))
                 response = self.client.embeddings.create(
-                    input=[query_text],
+                    input=query_texts,
                     model="text-embedding-3-small"
                 )
-                embedding = response.data[0].embedding
-                return embedding  # Return embedding if successful
+                embeddings = [item.embedding for item in response.data]
+                return embeddings  # Return embeddings if successful
             except Exception as e:
-                if "rate limit" in str(e).lower():
+                if _is_rate_limit(e):
                     self.logger.error("Rate limit error: %s. Retrying in %d seconds...", str(e), self.retry_delay)
                     retries += 1
+                    metrics.openai_retries.inc(operation='embeddings')
                     time.sleep(self.retry_delay)  # Wait before retrying
                 else:
                     self.logger.error("Error creating embedding for query: %s", str(e))
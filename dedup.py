@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import os
+import re
+import zlib
+
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+DEDUP_ENABLED = os.getenv('DEDUP', '1').lower() not in ('0', 'false', 'no')
+# Estimated Jaccard similarity of word shingles above which two chunks are near-duplicates
+DEDUP_THRESHOLD = float(os.getenv('DEDUP_THRESHOLD', '0.9'))
+
+NUM_PERM = 128
+# 16 bands of 8 rows: pairs above ~0.7 similarity share a band with high probability,
+# and every candidate is then checked against DEDUP_THRESHOLD
+BANDS = 16
+SHINGLE_WORDS = 5
+# Chunks with fewer words are only deduplicated exactly
+MIN_WORDS = 20
+
+_WORD = re.compile(r"\w+")
+
+
+def exact_key(text):
+    """Hash of the text with whitespace normalized, shared by exact duplicates."""
+    return hashlib.blake2b(" ".join(text.split()).encode('utf-8'), digest_size=16).digest()
+
+
+class Deduplicator:
+    """
+    Finds chunks of a pack that repeat an earlier chunk, before they are embedded.
+
+    - Exact duplicates (the same text up to whitespace) are found by hash.
+    - Near-duplicates are found with MinHash signatures of word shingles and banded LSH:
+      chunks sharing a band are candidates, kept as duplicates when their estimated
+      similarity is at least `threshold`.
+
+    The first chunk seen is canonical. Chunks are registered with the row they are stored
+    at; rows registered since the last `commit` can be dropped with `rollback` when adding
+    them to the dataset fails.
+    """
+
+    def __init__(self, threshold=DEDUP_THRESHOLD, num_perm=NUM_PERM, bands=BANDS, seed=1):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing: odd 64-bit multipliers, high 32 bits of the product
+        self._a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+        self._exact = {}
+        self._buckets = {}
+        self._signatures = {}
+        self._pending = []
+
+    def signature(self, text):
+        """MinHash signature (uint32[num_perm]) of the text's word shingles, or None for short texts."""
+        words = _WORD.findall(text.lower())
+        if len(words) < MIN_WORDS:
+            return None
+        shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+                             dtype=np.uint64, count=len(shingles))
+        with np.errstate(over='ignore'):
+            permuted = (hashes[None, :] * self._a[:, None] + self._b[:, None]) >> np.uint64(32)
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature):
+        r = self.rows_per_band
+        return [(band, signature[band * r:(band + 1) * r].tobytes()) for band in range(self.bands)]
+
+    def find(self, text, near=True):
+        """
+        Row of the canonical chunk `text` duplicates, as (row, kind) with kind 'exact' or
+        'near', or (None, key) for a new chunk; pass `key` to `add`.
+        """
+        key = exact_key(text)
+        row = self._exact.get(key)
+        if row is not None:
+            return row, 'exact'
+        signature = self.signature(text) if near else None
+        if signature is not None:
+            candidates = set()
+            for band_key in self._band_keys(signature):
+                candidates.update(self._buckets.get(band_key, ()))
+            best, best_similarity = None, self.threshold
+            for candidate in candidates:
+                similarity = float(np.mean(self._signatures[candidate] == signature))
+                if similarity >= best_similarity:
+                    best, best_similarity = candidate, similarity
+            if best is not None:
+                # Later exact copies of this chunk resolve to the same canonical row
+                self._exact[key] = best
+                self._pending.append((key, best, None))
+                return best, 'near'
+        return None, (key, signature)
+
+    def add(self, key, row):
+        """Register a new canonical chunk stored at `row`."""
+        exact, signature = key
+        self._exact[exact] = row
+        band_keys = []
+        if signature is not None:
+            self._signatures[row] = signature
+            band_keys = self._band_keys(signature)
+            for band_key in band_keys:
+                self._buckets.setdefault(band_key, []).append(row)
+        self._pending.append((exact, row, band_keys))
+
+    def commit(self):
+        self._pending = []
+
+    def rollback(self):
+        for exact, row, band_keys in self._pending:
+            if self._exact.get(exact) == row:
+                del self._exact[exact]
+            if band_keys is None:
+                # An alias of an earlier canonical row, which stays
+                continue
+            self._signatures.pop(row, None)
+            for band_key in band_keys:
+                rows = self._buckets.get(band_key)
+                if rows and row in rows:
+                    rows.remove(row)
+        self._pending = []
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import re
+import threading
+
+from custom_embedding import CustomEmbeddingFunction
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+HashingVectorizer = lazy_import('sklearn.feature_extraction.text', 'HashingVectorizer')
+normalize = lazy_import('sklearn.preprocessing', 'normalize')
+
+logger = logging.getLogger(__name__)
+
+# Backend used for packs whose type has no EMBEDDING_BACKEND_<PACK_TYPE> of its own
+DEFAULT_BACKEND = os.getenv('EMBEDDING_BACKEND', 'openai')
+LOCAL_EMBEDDING_DIMENSIONS = int(os.getenv('LOCAL_EMBEDDING_DIMENSIONS', '512'))
+
+# Written next to each dataset; datasets without one were built with OpenAI
+RECORD_FILE = 'embedding.json'
+
+# Identifiers, words and numbers; identifiers are also split into their camelCase/snake_case parts
+_TOKEN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+")
+_SUBWORD = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+
+def _features(text):
+    tokens = _TOKEN.findall(text)
+    features = []
+    for token in tokens:
+        lowered = token.lower()
+        features.append(lowered)
+        parts = _SUBWORD.findall(token)
+        if len(parts) > 1:
+            features.extend(f"#{part.lower()}" for part in parts)
+    words = [token.lower() for token in tokens]
+    features.extend(f"{first} {second}" for first, second in zip(words, words[1:]))
+    return features
+
+
+class HashingEmbeddingFunction:
+    """
+    Embeddings computed locally on the CPU, without a model download or network call.
+
+    Each text becomes a bag of features (lowercased identifiers and words, their
+    camelCase/snake_case parts and word bigrams), hashed with signed feature hashing into
+    `dimensions` buckets, a sparse random projection of the term counts. Counts are damped
+    logarithmically and vectors L2-normalized, so the cosine similarity of two texts
+    reflects the vocabulary they share. The hashing is stateless, so every process embeds
+    a text to the same vector.
+    """
+
+    name = 'hashing'
+
+    def __init__(self, dimensions=LOCAL_EMBEDDING_DIMENSIONS):
+        self.dimensions = dimensions
+        self._vectorizer = HashingVectorizer(n_features=dimensions, analyzer=_features, alternate_sign=True,
+                                             norm=None, dtype=np.float32)
+
+    def _embed(self, texts):
+        counts = self._vectorizer.transform(texts)
+        counts.data = np.sign(counts.data) * np.log1p(np.abs(counts.data))
+        return normalize(counts).toarray()
+
+    def embed_documents(self, documents):
+        if not documents:
+            return []
+        return self._embed([str(doc) for doc in documents]).tolist()
+
+    def embed_query(self, query):
+        return self._embed([str(query)])[0].tolist()
+
+
+_local_backends = {}
+_local_lock = threading.Lock()
+
+
+def create(name, client):
+    """Embedding function of backend `name`: 'openai' (through `client`) or 'hashing' (local CPU)."""
+    if name == 'openai':
+        return CustomEmbeddingFunction(client)
+    if name == 'hashing':
+        # Stateless, so one instance per process serves every dataset
+        with _local_lock:
+            if name not in _local_backends:
+                _local_backends[name] = HashingEmbeddingFunction()
+            return _local_backends[name]
+    raise ValueError(f"Unknown embedding backend: {name}")
+
+
+def configured_name(pack_type):
+    """Backend new datasets of `pack_type` are built with (EMBEDDING_BACKEND_<PACK_TYPE>, else EMBEDDING_BACKEND)."""
+    return os.getenv(f"EMBEDDING_BACKEND_{pack_type.upper()}") or DEFAULT_BACKEND
+
+
+def for_pack_type(pack_type, client):
+    return create(configured_name(pack_type), client)
+
+
+def record_path(dataset_path):
+    return os.path.join(os.path.dirname(dataset_path), RECORD_FILE)
+
+
+def write_record(dataset_path, backend):
+    """Record which backend, and how many dimensions, the dataset at `dataset_path` was embedded with."""
+    path = record_path(dataset_path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"backend": backend.name, "dimensions": backend.dimensions}, f)
+    os.replace(tmp_path, path)
+
+
+def read_record(dataset_path):
+    try:
+        with open(record_path(dataset_path), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def dataset_backend_name(dataset_path):
+    record = read_record(dataset_path)
+    return record.get('backend', 'openai') if record else 'openai'
+
+
+def for_dataset(dataset_path, client):
+    """Embedding function for querying the dataset at `dataset_path`: the backend it was built with."""
+    return create(dataset_backend_name(dataset_path), client)
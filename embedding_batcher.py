@@ -0,0 +1,133 @@
+import logging
+import os
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# How long the first query of a batch waits for others to join it (0 = no batching)
+EMBED_BATCH_WINDOW_MS = float(os.getenv('EMBED_BATCH_WINDOW_MS', '5'))
+EMBED_BATCH_MAX_SIZE = int(os.getenv('EMBED_BATCH_MAX_SIZE', '256'))
+
+
+class _Batch:
+    """Query texts collected for one embeddings call."""
+
+    def __init__(self):
+        self.texts = []
+        self.slots = {}  # text -> index in texts
+        self.closed = False
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None  # per text, its vector or the exception raised for it
+
+
+class EmbeddingBatcher:
+    """
+    Combine concurrent single-text embedding calls of a process into batched calls.
+
+    The first caller opens a batch and waits up to `window` seconds, or until
+    `max_size` distinct texts have joined, then makes one `embed(texts)` call for all of
+    them and hands each caller its vector. A text already waiting in a batch, or in a call
+    still in flight, is not sent again; its callers share the result.
+
+    When the call fails, the batch is split in halves and each half is sent again, down
+    to single texts, so a text the API rejects (e.g. one over the input limit) fails only
+    its own callers. Errors for which `shared_error(e)` is true, such as running out of
+    rate-limit retries, concern the call rather than a text: they are raised in every
+    caller of the batch without sending it again.
+    """
+
+    def __init__(self, embed, window=EMBED_BATCH_WINDOW_MS / 1000.0, max_size=EMBED_BATCH_MAX_SIZE,
+                 shared_error=lambda e: False):
+        self.embed = embed
+        self.window = window
+        self.max_size = max_size
+        self.shared_error = shared_error
+        self._open = None
+        self._in_flight = {}  # text -> batch whose call has started
+        self._lock = threading.Lock()
+
+    def embed_one(self, text):
+        with self._lock:
+            batch = self._in_flight.get(text)
+            leader = False
+            if batch is None:
+                batch = self._open
+                if batch is None:
+                    batch = self._open = _Batch()
+                    leader = True
+                if text not in batch.slots:
+                    batch.slots[text] = len(batch.texts)
+                    batch.texts.append(text)
+                    if len(batch.texts) >= self.max_size:
+                        self._close(batch)
+                        batch.full.set()
+            metrics.embedding_queries.inc(result='leader' if leader else 'joined')
+
+        if leader:
+            self._run(batch)
+        else:
+            batch.done.wait()
+        result = batch.results[batch.slots[text]]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _close(self, batch):
+        # Caller holds the lock; later identical texts wait on this batch's call
+        batch.closed = True
+        if self._open is batch:
+            self._open = None
+        for text in batch.texts:
+            self._in_flight.setdefault(text, batch)
+
+    def _run(self, batch):
+        batch.full.wait(self.window)
+        with self._lock:
+            if not batch.closed:
+                self._close(batch)
+        try:
+            batch.results = self._embed_isolated(batch.texts)
+        finally:
+            with self._lock:
+                for text in batch.texts:
+                    if self._in_flight.get(text) is batch:
+                        del self._in_flight[text]
+            batch.done.set()
+
+    def _embed_isolated(self, texts):
+        """The vector of each text, or the exception its call raised, sending halves again after a failure."""
+        try:
+            return self.embed(texts)
+        except Exception as e:
+            if len(texts) == 1 or self.shared_error(e):
+                return [e] * len(texts)
+            logger.warning("Embeddings call for %d texts failed, retrying them in halves: %s", len(texts), e)
+        middle = len(texts) // 2
+        return self._embed_isolated(texts[:middle]) + self._embed_isolated(texts[middle:])
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def batcher_for(key, embed, shared_error=lambda e: False):
+    """The process-wide batcher for `key` (e.g. an API client and model), created with `embed`."""
+    with _batchers_lock:
+        batcher = _batchers.get(key)
+        if batcher is None:
+            batcher = _batchers[key] = EmbeddingBatcher(embed, shared_error=shared_error)
+        return batcher
+
+
+def _forget_batchers():
+    # Batches open in the parent at fork time are never completed in the child
+    global _batchers_lock
+    _batchers.clear()
+    _batchers_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_batchers)
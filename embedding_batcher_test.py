@@ -0,0 +1,199 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import embedding_batcher
+from custom_embedding import CustomEmbeddingFunction
+from embedding_batcher import EmbeddingBatcher, batcher_for
+
+
+class FakeEmbeddings:
+    """
+    Records every embeddings call; each text's vector is [len(text), call number].
+    A call raises `error`, or, when it includes a text starting with "invalid", a
+    ValueError as the API does for input it rejects.
+    """
+
+    def __init__(self, delay=0.2, error=None):
+        self.delay = delay
+        self.error = error
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, texts):
+        with self._lock:
+            self.calls.append(list(texts))
+            number = len(self.calls)
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        if any(text.startswith("invalid") for text in texts):
+            raise ValueError("Invalid input: maximum context length exceeded")
+        return [[float(len(text)), float(number)] for text in texts]
+
+
+def call_concurrently(batcher, texts):
+    """embed_one for every text on its own thread, started together; returns results or exceptions in order."""
+    results = [None] * len(texts)
+    start = threading.Barrier(len(texts))
+
+    def call(index):
+        start.wait()
+        try:
+            results[index] = batcher.embed_one(texts[index])
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(len(texts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def test_concurrent_callers_share_one_call():
+    embed = FakeEmbeddings()
+    texts = [f"question {'?' * i}" for i in range(8)]
+    # The batch closes as soon as every caller has joined, long before the window ends
+    batcher = EmbeddingBatcher(embed, window=5, max_size=len(texts))
+
+    started = time.perf_counter()
+    results = call_concurrently(batcher, texts)
+
+    assert time.perf_counter() - started < 2
+    assert len(embed.calls) == 1
+    assert sorted(embed.calls[0]) == sorted(texts)
+    assert results == [[float(len(text)), 1.0] for text in texts]
+
+
+def test_window_closes_a_batch_that_is_not_full():
+    embed = FakeEmbeddings(delay=0)
+    batcher = EmbeddingBatcher(embed, window=0.05, max_size=100)
+
+    assert batcher.embed_one("alone") == [5.0, 1.0]
+    assert embed.calls == [["alone"]]
+
+
+def test_full_batches_are_split():
+    embed = FakeEmbeddings()
+    texts = [f"text {i}" for i in range(6)]
+    batcher = EmbeddingBatcher(embed, window=0.5, max_size=3)
+
+    results = call_concurrently(batcher, texts)
+
+    assert sorted(len(call) for call in embed.calls) == [3, 3]
+    assert sorted(text for call in embed.calls for text in call) == sorted(texts)
+    assert [result[0] for result in results] == [float(len(text)) for text in texts]
+
+
+def test_identical_texts_are_embedded_once():
+    embed = FakeEmbeddings()
+    texts = ["same question"] * 6 + ["other question"] * 2
+    batcher = EmbeddingBatcher(embed, window=0.2, max_size=256)
+
+    results = call_concurrently(batcher, texts)
+
+    assert sum(len(call) for call in embed.calls) == 2
+    assert all(result == results[0] for result in results[:6])
+    assert all(result == results[6] for result in results[6:])
+
+
+def test_text_in_flight_is_not_sent_again():
+    embed = FakeEmbeddings(delay=0.3)
+    batcher = EmbeddingBatcher(embed, window=0, max_size=256)
+
+    first = threading.Thread(target=batcher.embed_one, args=("slow question",))
+    first.start()
+    time.sleep(0.1)
+    # The first call is in flight; this caller waits for it instead of calling again
+    assert batcher.embed_one("slow question") == [13.0, 1.0]
+    first.join()
+    assert embed.calls == [["slow question"]]
+
+
+def test_upstream_error_is_raised_in_every_caller():
+    error = RuntimeError("embeddings API unavailable")
+    embed = FakeEmbeddings(error=error)
+    texts = [f"question {i}" for i in range(5)]
+    batcher = EmbeddingBatcher(embed, window=5, max_size=len(texts))
+
+    results = call_concurrently(batcher, texts)
+
+    assert all(result is error for result in results)
+    # Every text was tried on its own before failing
+    assert sorted(call[0] for call in embed.calls if len(call) == 1) == sorted(texts)
+
+
+def test_invalid_text_fails_only_its_callers():
+    embed = FakeEmbeddings(delay=0.05)
+    texts = [f"question {i}" for i in range(7)] + ["invalid " + "x" * 100]
+    batcher = EmbeddingBatcher(embed, window=5, max_size=len(texts))
+
+    results = call_concurrently(batcher, texts)
+
+    assert isinstance(results[-1], ValueError)
+    assert [result[0] for result in results[:-1]] == [float(len(text)) for text in texts[:-1]]
+    # The batch is halved down to the invalid text: 1 + 2 + 2 + 2 calls instead of one per text
+    assert len(embed.calls) == 7
+    assert ["invalid " + "x" * 100] in embed.calls
+
+
+def test_shared_error_fails_the_batch_without_splitting_it():
+    error = RuntimeError("Rate limit exceeded, max retries reached")
+    embed = FakeEmbeddings(error=error)
+    texts = [f"question {i}" for i in range(5)]
+    batcher = EmbeddingBatcher(embed, window=5, max_size=len(texts), shared_error=lambda e: "rate limit" in str(e).lower())
+
+    results = call_concurrently(batcher, texts)
+
+    assert len(embed.calls) == 1
+    assert all(result is error for result in results)
+
+
+class FakeOpenAI:
+    """An OpenAI client whose embeddings endpoint answers like FakeEmbeddings, rate limiting the first `rate_limits` calls."""
+
+    def __init__(self, rate_limits=0):
+        self.fake = FakeEmbeddings(delay=0.05)
+        self.rate_limits = rate_limits
+        self.embeddings = self
+
+    def create(self, input, model):
+        if self.rate_limits:
+            self.rate_limits -= 1
+            raise RuntimeError("Rate limit reached for text-embedding-3-small")
+        return SimpleNamespace(data=[SimpleNamespace(embedding=vector) for vector in self.fake(input)])
+
+
+def test_query_embeddings_isolate_a_rejected_query(monkeypatch):
+    monkeypatch.setattr(embedding_batcher, 'EMBED_BATCH_WINDOW_MS', 200)
+    monkeypatch.setattr(embedding_batcher, '_batchers', {})
+    client = FakeOpenAI(rate_limits=1)
+    function = CustomEmbeddingFunction(client, retry_delay=0)
+    queries = [f"question {i}" for i in range(5)] + ["invalid " + "x" * 100]
+
+    results = call_concurrently(SimpleNamespace(embed_one=function.embed_query), queries)
+
+    assert isinstance(results[-1], ValueError)
+    assert [result[0] for result in results[:-1]] == [float(len(query)) for query in queries[:-1]]
+    # The rate-limited call was retried once for the whole batch, not split
+    assert sorted(client.fake.calls[0]) == sorted(queries)
+
+
+def test_batcher_recovers_after_an_error():
+    embed = FakeEmbeddings(delay=0, error=RuntimeError("rate limited"))
+    batcher = EmbeddingBatcher(embed, window=0, max_size=256)
+    with pytest.raises(RuntimeError):
+        batcher.embed_one("retry me")
+
+    embed.error = None
+    assert batcher.embed_one("retry me") == [8.0, 2.0]
+
+
+def test_batcher_for_shares_a_batcher_per_key():
+    embed = FakeEmbeddings()
+    assert batcher_for(("client", "model-a"), embed) is batcher_for(("client", "model-a"), embed)
+    assert batcher_for(("client", "model-a"), embed) is not batcher_for(("client", "model-b"), embed)
@@ -0,0 +1,304 @@
+import base64
+import binascii
+import io
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import resource
+except ImportError:  # Windows: extraction processes are not memory-capped
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Documents that need a parser instead of TextLoader, and how their files start
+MAGIC = {
+    '.pdf': b'%PDF-',
+    '.docx': b'PK\x03\x04',
+    '.xlsx': b'PK\x03\x04',
+}
+
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Address-space limit of each extraction process; a document that needs more fails alone
+EXTRACT_MEMORY_MB = int(os.getenv('EXTRACT_MEMORY_MB', '2048'))
+# Characters kept per document; the rest is dropped with a warning
+EXTRACT_MAX_CHARS = int(os.getenv('EXTRACT_MAX_CHARS', str(50 * 1000 * 1000)))
+# Seconds an extraction may go without producing a section
+EXTRACT_TIMEOUT = float(os.getenv('EXTRACT_TIMEOUT', '300'))
+# Folder of the files extracted sections are streamed through (default: the system temp folder)
+EXTRACT_SPOOL_DIR = os.getenv('EXTRACT_SPOOL_DIR') or None
+
+# DOCX paragraphs and XLSX rows are returned in sections of about this many characters
+SECTION_CHARS = 64 * 1024
+
+
+class ExtractionError(Exception):
+    """A PDF, DOCX or XLSX document whose text could not be extracted."""
+
+
+def extension(filename):
+    return os.path.splitext(filename)[1].lower()
+
+
+def is_document(filename, file_path=None, data=None):
+    """True if the file is a PDF, DOCX or XLSX document (by extension and content), not text."""
+    magic = MAGIC.get(extension(filename))
+    if magic is None:
+        return False
+    if data is None:
+        try:
+            with open(file_path, 'rb') as f:
+                data = f.read(len(magic))
+        except OSError:
+            return False
+    return isinstance(data, (bytes, bytearray)) and data.startswith(magic)
+
+
+def decode_content(filename, content, encoding=None):
+    """
+    Bytes of a PDF, DOCX or XLSX document sent in a pack as base64 (optionally as a
+    `data:` URL), or None when the content is plain text, e.g. text packman extracted itself.
+    """
+    if extension(filename) not in MAGIC or not isinstance(content, str):
+        return None
+    payload = content
+    if content.startswith('data:') and ';base64,' in content[:256]:
+        payload = content.split(',', 1)[1]
+    elif encoding not in (None, 'base64'):
+        return None
+    try:
+        data = base64.b64decode("".join(payload.split()), validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return data if is_document(filename, data=data) else None
+
+
+# ---- Runs in the extraction processes ----
+
+def _pdf_sections(source):
+    from pypdf import PdfReader
+
+    reader = PdfReader(source)
+    for number, page in enumerate(reader.pages, 1):
+        yield f"page {number}", page.extract_text() or ""
+
+
+def _docx_sections(source):
+    import docx
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+
+    document = docx.Document(source)
+    blocks, size, first = [], 0, 1
+    # Paragraphs and tables in document order
+    for number, element in enumerate(document.element.body.iterchildren(), 1):
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag == 'p':
+            text = Paragraph(element, document).text
+        elif tag == 'tbl':
+            text = "\n".join(" | ".join(cell.text for cell in row.cells) for row in Table(element, document).rows)
+        else:
+            continue
+        if not text.strip():
+            continue
+        blocks.append(text)
+        size += len(text)
+        if size >= SECTION_CHARS:
+            yield f"blocks {first}-{number}", "\n\n".join(blocks)
+            blocks, size, first = [], 0, number + 1
+    if blocks:
+        yield f"blocks {first}-{number}", "\n\n".join(blocks)
+
+
+def _xlsx_sections(source):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            rows = sheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                continue
+            names = [str(name) if name is not None else f"Column {index}" for index, name in enumerate(header, 1)]
+            # Rows read like the CSV rows of prepare_data: "column: value" pairs
+            lines, size, first = [], 0, 2
+            for number, row in enumerate(rows, 2):
+                line = " ".join(f"{name}: {value}" for name, value in zip(names, row) if value is not None)
+                if not line:
+                    continue
+                lines.append(line)
+                size += len(line)
+                if size >= SECTION_CHARS:
+                    yield f"{sheet.title} rows {first}-{number}", "\n\n".join(lines)
+                    lines, size, first = [], 0, number + 1
+            if lines:
+                yield f"{sheet.title} rows {first}-{number}", "\n\n".join(lines)
+    finally:
+        workbook.close()
+
+
+_SECTIONS = {
+    '.pdf': _pdf_sections,
+    '.docx': _docx_sections,
+    '.xlsx': _xlsx_sections,
+}
+
+
+def extract(filename, file_path=None, data=None, max_chars=EXTRACT_MAX_CHARS, spool_path=None):
+    """
+    Text of a PDF (page by page), DOCX (paragraphs and tables) or XLSX (sheet by sheet)
+    document as (label, text) sections, read from `file_path` or from `data` bytes.
+
+    Each section is appended to the JSONL file `spool_path` as soon as it is extracted,
+    so neither this process nor the reader ever holds the whole document's text.
+    Sections stop once `max_chars` characters are written. Returns (sections, truncated).
+    """
+    source = file_path if file_path else io.BytesIO(data)
+    count, total, truncated = 0, 0, False
+    with open(spool_path, 'a', encoding='utf-8') as spool:
+        for label, text in _SECTIONS[extension(filename)](source):
+            if not text.strip():
+                continue
+            if total + len(text) > max_chars:
+                text, truncated = text[:max_chars - total], True
+            spool.write(json.dumps([label, text]) + "\n")
+            spool.flush()
+            count += 1
+            total += len(text)
+            if truncated:
+                break
+    return count, truncated
+
+
+def _limit_memory(limit_bytes):
+    if resource is not None and limit_bytes:
+        resource.setrlimit(resource.RLIMIT_AS, (limit_bytes, limit_bytes))
+
+
+# ---- Runs in the API process ----
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Forking a threaded worker can deadlock the child; the fork server is a clean,
+            # single-threaded process that only has this module loaded
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            if 'forkserver' in methods:
+                context.set_forkserver_preload([__name__])
+            _pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, mp_context=context,
+                                        initializer=_limit_memory, initargs=(EXTRACT_MEMORY_MB * 1024 * 1024,))
+            logger.info("Started %d document extraction processes", EXTRACT_WORKERS)
+        return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _forget_pool():
+    # A forked gunicorn worker starts its own pool on first use
+    global _pool
+    _pool = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_pool)
+
+
+class Extraction:
+    """A document being extracted: the pool's future and the file its sections stream into."""
+
+    def __init__(self, future, spool_path):
+        self.future = future
+        self.spool_path = spool_path
+
+    def discard(self):
+        # Stops an extraction that has not started; one that has writes on into the removed file
+        self.future.cancel()
+        try:
+            os.remove(self.spool_path)
+        except OSError:
+            pass
+
+
+def submit(filename, file_path=None, data=None):
+    """Start extracting a document in the process pool (inline when EXTRACT_WORKERS=0)."""
+    fd, spool_path = tempfile.mkstemp(prefix='extract-', suffix='.jsonl', dir=EXTRACT_SPOOL_DIR)
+    os.close(fd)
+    if EXTRACT_WORKERS <= 0:
+        future = Future()
+        try:
+            future.set_result(extract(filename, file_path, data, spool_path=spool_path))
+        except Exception as e:
+            future.set_exception(e)
+        return Extraction(future, spool_path)
+    return Extraction(_get_pool().submit(extract, filename, file_path, data, spool_path=spool_path), spool_path)
+
+
+def sections(extraction, filename):
+    """
+    Sections of a submitted extraction, yielded as the extraction process writes them;
+    raises ExtractionError if it fails. The spool file is removed once the sections are
+    read or the generator is closed.
+    """
+    try:
+        with open(extraction.spool_path, 'r', encoding='utf-8') as spool:
+            partial = ""
+            waiting_since = time.monotonic()
+            while not extraction.future.done():
+                line = spool.readline()
+                if not line.endswith("\n"):
+                    # A partly written section, or none yet
+                    partial += line
+                    if time.monotonic() - waiting_since > EXTRACT_TIMEOUT:
+                        raise ExtractionError(f"Extracting {filename} produced nothing for {EXTRACT_TIMEOUT:.0f}s")
+                    time.sleep(0.01)
+                    continue
+                label, text = json.loads(partial + line)
+                partial = ""
+                yield label, text
+                waiting_since = time.monotonic()
+
+            # The process has finished, so everything it wrote is complete
+            _count, truncated = _result(extraction.future, filename)
+            for line in (partial + spool.read()).splitlines():
+                label, text = json.loads(line)
+                yield label, text
+    finally:
+        extraction.discard()
+    if truncated:
+        logger.warning("Kept the first %d characters of %s", EXTRACT_MAX_CHARS, filename)
+
+
+def _result(future, filename):
+    try:
+        return future.result(timeout=0)
+    except BrokenProcessPool as e:
+        # A process died (e.g. killed for memory); later documents get a fresh pool
+        if _pool is not None:
+            _discard_pool(_pool)
+        raise ExtractionError(f"Extraction process for {filename} died: {e}")
+    except MemoryError:
+        raise ExtractionError(f"Extracting {filename} needed more than {EXTRACT_MEMORY_MB} MB")
+    except ImportError as e:
+        raise ExtractionError(f"Cannot extract {filename}: {e}")
+    except Exception as e:
+        raise ExtractionError(f"Could not extract text from {filename}: {e}")
@@ -0,0 +1,104 @@
+"""
+Gunicorn settings for production, tuned through environment variables.
+
+Requests spend most of their time waiting on OpenAI and the central auth service, while
+pack ingestion is CPU-bound (chunking, pandas, DeepLake writes). The defaults therefore
+run one process per CPU for ingestion with several threads each for the I/O waits.
+
+- GUNICORN_WORKER_CLASS: `gthread` (default), `sync`, or `gevent` (requires `pip install gevent`)
+- WEB_CONCURRENCY: worker processes (default: CPU count, at least 2)
+- GUNICORN_THREADS: threads per gthread worker (default 8)
+- GUNICORN_WORKER_CONNECTIONS: concurrent requests per gevent worker (default 100)
+- GUNICORN_TIMEOUT: seconds before a silent worker is restarted (default 300, LLM calls are slow)
+- GUNICORN_PRELOAD: import the app in the master before forking (default on, off for gevent)
+- GUNICORN_MAX_REQUESTS / GUNICORN_MAX_REQUESTS_JITTER: recycle a worker after this many
+  requests, plus a random jitter so workers do not all restart together (default 1000 / 100)
+- METRICS_DIR: directory where workers share their metrics for /metrics (default: a fresh
+  one in /dev/shm or the temp directory; empty to serve each worker's own metrics)
+- PORT: listen port (default 8000)
+
+Usage:
+    gunicorn -c gunicorn.conf.py app:app
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    try:
+        return int(value) if value else default
+    except ValueError:
+        logging.getLogger(__name__).warning("Ignoring invalid %s=%r, using %d", name, value, default)
+        return default
+
+
+def _env_bool(name, default):
+    value = os.getenv(name)
+    if value is None or value == '':
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = _env_int('WEB_CONCURRENCY', max(2, multiprocessing.cpu_count()))
+threads = _env_int('GUNICORN_THREADS', 8) if worker_class == 'gthread' else 1
+worker_connections = _env_int('GUNICORN_WORKER_CONNECTIONS', 100)
+
+timeout = _env_int('GUNICORN_TIMEOUT', 300)
+graceful_timeout = _env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+keepalive = _env_int('GUNICORN_KEEPALIVE', 5)
+
+# gevent patches the standard library in each worker; importing the app in the master
+# first would leave already-imported modules unpatched
+preload_app = _env_bool('GUNICORN_PRELOAD', worker_class != 'gevent')
+if preload_app:
+    # Import the lazily loaded dependencies in the master so workers share them (see app.warm_up)
+    os.environ.setdefault('APP_WARM_UP', '1')
+
+# DeepLake and pandas hold on to memory after large ingestions; recycling bounds the growth
+max_requests = _env_int('GUNICORN_MAX_REQUESTS', 1000)
+max_requests_jitter = _env_int('GUNICORN_MAX_REQUESTS_JITTER', 100)
+
+# The worker heartbeat file is touched constantly; keep it off overlay/disk filesystems
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# Workers write their metrics here and /metrics adds them up (see metrics.py); a fresh
+# directory per server, kept across config reloads. METRICS_DIR= (empty) disables it.
+_metrics_dir = None
+if 'METRICS_DIR' not in os.environ:
+    _metrics_dir = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                                f"sourcebox-metrics-{os.getpid()}")
+    shutil.rmtree(_metrics_dir, ignore_errors=True)
+    os.environ['METRICS_DIR'] = _metrics_dir
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG') or None
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    server.log.info("Starting %d %s workers (threads=%d, preload=%s, max_requests=%d+%d, timeout=%ds)",
+                    workers, worker_class, threads, preload_app, max_requests, max_requests_jitter, timeout)
+
+
+def post_worker_init(worker):
+    # Open (or, on a fresh host, build) the landing example index before the first visitor asks
+    import app
+    app.landing_rag.start()
+
+
+def child_exit(server, worker):
+    # Keep an exited worker's counters in the /metrics totals after it is recycled
+    import metrics
+    metrics.mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    if _metrics_dir:
+        shutil.rmtree(_metrics_dir, ignore_errors=True)
@@ -0,0 +1,113 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Central auth / packman service (user lookup, login and pack downloads)
+CENTRAL_AUTH_URL = os.getenv('CENTRAL_AUTH_URL', 'https://sourcebox-central-auth-8396932a641c.herokuapp.com')
+
+
+class UserIdError(Exception):
+    """The auth service gave no user ID for a token; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+
+class UserIds:
+    """
+    Access token -> user ID, as the auth service's /user/id reports it, remembered for
+    `ttl` seconds.
+
+    Routing and quotas are keyed by the user rather than the token, so a user keeps their
+    node and their limits across logins and token refreshes; the cache lets them look the
+    user up before every request without a call to the auth service each time. Tokens are
+    kept as digests, at most `max_entries` of them, least recently used evicted first.
+    A token the auth service rejects (a 4xx answer) is remembered for `failure_ttl`
+    seconds, so repeated requests with it are refused without asking again; other
+    failures are not cached. A ttl of 0 disables the cache.
+    """
+
+    def __init__(self, auth_url, ttl=300, max_entries=10000, failure_ttl=30):
+        self.auth_url = auth_url
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.failure_ttl = failure_ttl
+        # token digest -> (user_id or the UserIdError of a rejected token, expires_at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """
+        USER_ID_CACHE_SECONDS (default 300), USER_ID_CACHE_SIZE (default 10000) and
+        USER_ID_FAILURE_CACHE_SECONDS (default 30).
+        """
+        return cls(CENTRAL_AUTH_URL, float(os.getenv('USER_ID_CACHE_SECONDS', '300')),
+                   int(os.getenv('USER_ID_CACHE_SIZE', '10000')),
+                   float(os.getenv('USER_ID_FAILURE_CACHE_SECONDS', '30')))
+
+    def lookup(self, access_token):
+        """User ID of the access token; raises UserIdError when the auth service does not give one."""
+        key = hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                metrics.record_cache('user_id', True)
+                if isinstance(entry[0], UserIdError):
+                    raise UserIdError(str(entry[0]), entry[0].status)
+                return entry[0]
+
+        metrics.record_cache('user_id', False)
+        try:
+            user_id = self.fetch(access_token)
+        except UserIdError as e:
+            if 400 <= e.status < 500:
+                self._remember(key, e, now + self.failure_ttl)
+            raise
+        self._remember(key, user_id, now + self.ttl)
+        return user_id
+
+    def _remember(self, key, value, expires_at):
+        if expires_at <= time.time() or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def fetch(self, access_token):
+        """User ID of the access token from the auth service, bypassing the cache."""
+        get_user_id_url = f'{self.auth_url}/user/id'
+        headers = {'Authorization': f'Bearer {access_token}'}
+        try:
+            with metrics.span('user_id_lookup'):
+                user_id_response = requests.get(get_user_id_url, headers=headers)
+        except requests.RequestException as e:
+            logger.error("Failed to retrieve user ID: %s", str(e))
+            raise UserIdError(f"Failed to retrieve user ID: {str(e)}")
+        if user_id_response.status_code != 200:
+            logger.error("Failed to retrieve user ID: %s", user_id_response.text)
+            raise UserIdError(f"Failed to retrieve user ID: {user_id_response.text}", user_id_response.status_code)
+        user_id = user_id_response.json().get('user_id')
+        if not user_id:
+            logger.error("User ID not found in the response")
+            raise UserIdError("Failed to retrieve user ID")
+        logger.info("User ID retrieved: %s", user_id)
+        return str(user_id)
+
+
+# Shared by the request handlers, cluster routing and quotas
+user_ids = UserIds.from_env()
@@ -0,0 +1,293 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import chunk_store
+import metrics
+from lazy import lazy_import
+
+prepare_csv_for_embedding = lazy_import('prepare_data', 'prepare_csv_for_embedding')
+
+logger = logging.getLogger(__name__)
+
+# Rows embedded per embeddings API call while building an index
+BUILD_BATCH_SIZE = 512
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+_digests = {}
+
+
+def cached_file_digest(path):
+    """file_digest, recomputed only when the file's size or modification time changes."""
+    stat = os.stat(path)
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    cached = _digests.get(path)
+    if cached is None or cached[0] != stamp:
+        cached = _digests[path] = (stamp, file_digest(path))
+    return cached[1]
+
+
+def normalize_prompt(prompt):
+    """Prompts that differ only in case or whitespace share a cache entry."""
+    return " ".join(prompt.lower().split())
+
+
+class ArtifactCache:
+    """
+    Results of expensive upstream calls for the landing examples (model answers,
+    transcriptions, generated images, scraped pages), keyed by a hash of their inputs.
+
+    - An entry is fresh for `ttl` seconds. For `stale_ttl` seconds after that it is still
+      served, while a single background refresh replaces it (stale-while-revalidate).
+    - A miss is computed once; concurrent requests for the same key wait for that result.
+    - Entries are evicted least recently used first once they take more than `max_bytes`.
+    - With `directory`, entries are also written to disk, so other workers and restarts
+      reuse them instead of calling upstream again.
+
+    Failed computations are never cached.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=3600, stale_ttl=86400, directory=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.directory = directory
+        # key -> (created_at, value, size, ttl, stale_ttl)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._pending = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def get_or_compute(self, kind, parts, compute, ttl=None, stale_ttl=None):
+        """
+        The cached value for (`kind`, *`parts`), computing it with `compute()` on a miss.
+
+        `kind` names the artifact in logs and the cache metrics; `ttl` and `stale_ttl`
+        override the cache defaults (e.g. for image URLs that expire upstream).
+        """
+        ttl = self.ttl if ttl is None else ttl
+        stale_ttl = self.stale_ttl if stale_ttl is None else stale_ttl
+        key = self.key(kind, *parts)
+        now = time.time()
+
+        entry = self._lookup(key, ttl, now)
+        if entry is not None:
+            created_at, value = entry[0], entry[1]
+            age = now - created_at
+            if age <= ttl:
+                metrics.record_cache(f"landing_{kind}", True)
+                return value
+            if age <= ttl + stale_ttl:
+                metrics.record_cache(f"landing_{kind}", True)
+                self._refresh(key, kind, compute, ttl, stale_ttl)
+                return value
+
+        metrics.record_cache(f"landing_{kind}", False)
+        return self._compute_once(key, kind, compute, ttl, stale_ttl)
+
+    def _lookup(self, key, ttl, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if now - entry[0] <= ttl:
+                    return entry
+        # Missing or stale here: another worker may have stored a newer one
+        stored = self._read_disk(key)
+        if stored is not None and (entry is None or stored[0] > entry[0]):
+            self._store(key, *stored, write=False)
+            return stored
+        return entry
+
+    def _compute_once(self, key, kind, compute, ttl, stale_ttl):
+        with self._lock:
+            pending = self._pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = self._pending[key] = {"done": threading.Event(), "value": None, "error": None}
+        if not leader:
+            pending["done"].wait()
+            if pending["error"] is not None:
+                raise pending["error"]
+            return pending["value"]
+
+        try:
+            with metrics.span(f"landing_{kind}"):
+                pending["value"] = compute()
+            self._store(key, time.time(), pending["value"], ttl, stale_ttl)
+            return pending["value"]
+        except Exception as e:
+            pending["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending["done"].set()
+
+    def _refresh(self, key, kind, compute, ttl, stale_ttl):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                with metrics.span(f"landing_{kind}_refresh"):
+                    value = compute()
+                self._store(key, time.time(), value, ttl, stale_ttl)
+                logger.info("Refreshed stale landing %s artifact", kind)
+            except Exception as e:
+                # The stale value keeps being served until the next attempt
+                logger.error("Refreshing landing %s artifact failed: %s", kind, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+        threading.Thread(target=run, name='landing-refresh', daemon=True).start()
+
+    def _store(self, key, created_at, value, ttl, stale_ttl, write=True):
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            logger.warning("Not caching landing artifact of %d bytes (limit %d)", size, self.max_bytes)
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[2]
+            self._entries[key] = (created_at, value, size, ttl, stale_ttl)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[2]
+        if write:
+            self._write_disk(key, created_at, value, ttl, stale_ttl)
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._disk_path(key), encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - record["created_at"] > record["ttl"] + record["stale_ttl"]:
+            return None
+        return record["created_at"], record["value"], record["ttl"], record["stale_ttl"]
+
+    def _write_disk(self, key, created_at, value, ttl, stale_ttl):
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._disk_path(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"created_at": created_at, "value": value, "ttl": ttl, "stale_ttl": stale_ttl}, f)
+            os.replace(tmp_path, path)
+
+            # Keep the directory within the same bound, dropping the least recently written
+            files = sorted(os.scandir(self.directory), key=lambda entry: entry.stat().st_mtime, reverse=True)
+            total = 0
+            for entry in files:
+                total += entry.stat().st_size
+                if total > self.max_bytes:
+                    os.remove(entry.path)
+        except (OSError, TypeError) as e:
+            logger.warning("Could not write landing artifact %s: %s", key, e)
+
+
+class LandingRag:
+    """
+    Retrieval over a bundled landing example CSV.
+
+    The rows are embedded once into a chunk store under `index_root`, named after the
+    file's digest, so the index is built by one worker, memory-mapped by the others and
+    kept across restarts until the file changes. Each request embeds only the prompt and
+    sends the `top_k` closest rows to the model instead of the whole file.
+    """
+
+    def __init__(self, csv_path, index_root, flight, embeddings, top_k=5):
+        self.csv_path = csv_path
+        self.index_root = index_root
+        self.flight = flight
+        self.embeddings = embeddings
+        self.top_k = top_k
+        self.digest = None
+        self._store = None
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return os.path.splitext(os.path.basename(self.csv_path))[0]
+
+    def _build(self, digest):
+        path = os.path.join(self.index_root, f"{self.name}-{digest[:16]}")
+        if chunk_store.open_store(path) is not None:
+            return path
+
+        with metrics.span('landing_index_build'):
+            rows = prepare_csv_for_embedding(self.csv_path)
+            vectors = (self.embeddings.embed_documents(rows[start:start + BUILD_BATCH_SIZE])
+                       for start in range(0, len(rows), BUILD_BATCH_SIZE))
+            # Row i of the data is line i + 2 of the file, after the header
+            lines = [(index + 2, index + 2) for index in range(len(rows))]
+            chunk_store.ChunkStore.build(path, rows, [os.path.basename(self.csv_path)] * len(rows), lines, vectors)
+
+        # Indexes of earlier versions of the file
+        for entry in os.listdir(self.index_root):
+            if entry.startswith(f"{self.name}-") and os.path.join(self.index_root, entry) != path:
+                shutil.rmtree(os.path.join(self.index_root, entry), ignore_errors=True)
+        logger.info("Built landing index for %s: %d rows", self.csv_path, len(rows))
+        return path
+
+    def index(self):
+        """The chunk store of the CSV, building it on first use."""
+        with self._lock:
+            if self._store is None:
+                digest = file_digest(self.csv_path)
+                # One build across workers; the others wait and open the result
+                path = self.flight.do(f"landing/{self.name}/{digest}", lambda: self._build(digest))
+                store = chunk_store.open_store(path)
+                if store is None:
+                    raise RuntimeError(f"Landing index {path} could not be opened")
+                self._store, self.digest = store, digest
+            return self._store
+
+    def retrieve(self, prompt):
+        """The rows closest to `prompt`, best first."""
+        store = self.index()
+        if len(store) == 0:
+            return []
+        with metrics.span('landing_retrieve'):
+            ids, scores = store.search(self.embeddings.embed_query(prompt), k=self.top_k)
+            return [store.text(i) for i in ids[0]]
+
+    def start(self):
+        """Build or open the index on a background thread so the first visitor does not wait for it."""
+        def run():
+            try:
+                self.index()
+            except Exception as e:
+                logger.error("Building landing index for %s failed: %s", self.csv_path, e, exc_info=True)
+        threading.Thread(target=run, name='landing-index', daemon=True).start()
+        return self
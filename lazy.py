@@ -0,0 +1,77 @@
+import importlib
+import threading
+
+# Every lazy import created so far, so a preloading master can force them all at once
+_registry = []
+
+
+class LazyObject:
+    """
+    Proxy that builds its target on first use.
+
+    Attribute access and calls are forwarded to the target, so module-level names such as
+    `DeepLake = lazy_import('langchain_community.vectorstores', 'DeepLake')` keep working
+    unchanged at their call sites while the import cost moves to the first request that
+    needs it.
+    """
+
+    def __init__(self, factory, name):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_target', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _load(self):
+        target = self._target
+        if target is None:
+            with self._lock:
+                target = self._target
+                if target is None:
+                    target = self._factory()
+                    object.__setattr__(self, '_target', target)
+        return target
+
+    @property
+    def loaded(self):
+        return self._target is not None
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self):
+        state = "loaded" if self.loaded else "not loaded"
+        return f"<lazy {self._name} ({state})>"
+
+
+def lazy_import(module, attribute=None):
+    """Import `module` (or `module.attribute`) the first time the returned proxy is used."""
+    def factory():
+        target = importlib.import_module(module)
+        return getattr(target, attribute) if attribute else target
+
+    proxy = LazyObject(factory, f"{module}.{attribute}" if attribute else module)
+    _registry.append(proxy)
+    return proxy
+
+
+def lazy_object(factory, name):
+    """
+    Create an object (e.g. an API client) the first time it is used.
+
+    Unlike `lazy_import`, these are not loaded by `preload_imports`: objects that hold
+    sockets or threads must be created in each worker after fork, not in the master.
+    """
+    return LazyObject(factory, name)
+
+
+def preload_imports():
+    """Force every lazy import registered so far. Returns the number loaded."""
+    for proxy in list(_registry):
+        proxy._load()
+    return len(_registry)
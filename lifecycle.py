@@ -0,0 +1,268 @@
+import logging
+import os
+import shutil
+import threading
+import time
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: every process may sweep
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Touched on every use of a dataset; its mtime is the dataset's last access time
+ACCESS_MARKER = '.last_access'
+
+
+def _env_number(name, scale=1):
+    value = os.getenv(name)
+    if not value:
+        return None
+    try:
+        return float(value) * scale
+    except ValueError:
+        logger.warning("Ignoring invalid %s=%r", name, value)
+        return None
+
+
+def _folder_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            try:
+                total += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class DatasetLifecycle:
+    """
+    Tracks the size and last access of every dataset under `root` (laid out as
+    <user_id>/<pack_type>/<pack_id>) and evicts cold ones.
+
+    A sweep deletes, least recently used first:
+    - datasets not accessed for `ttl_seconds`,
+    - datasets of users above `user_quota_bytes`, until they fit,
+    - datasets of any user while the total is above `disk_quota_bytes`.
+
+    Datasets used within `min_idle_seconds` are never evicted, and neither is a dataset
+    whose ingestion is in flight (checked through the ingestion single-flight lock), so a
+    request never loses the dataset it is about to query. Evicted packs are simply
+    ingested again on their next query.
+    """
+
+    def __init__(self, root, flight, ttl_seconds=None, disk_quota_bytes=None, user_quota_bytes=None,
+                 min_idle_seconds=600, interval=600):
+        self.root = root
+        self.flight = flight
+        self.ttl_seconds = ttl_seconds
+        self.disk_quota_bytes = disk_quota_bytes
+        self.user_quota_bytes = user_quota_bytes
+        self.min_idle_seconds = min_idle_seconds
+        self.interval = interval
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, root, flight):
+        """
+        DATASET_TTL_HOURS, DATASET_DISK_QUOTA_GB, DATASET_USER_QUOTA_GB (unset = no limit),
+        DATASET_MIN_IDLE_SECONDS (default 600) and DATASET_SWEEP_INTERVAL seconds (default 600, 0 = off).
+        """
+        gigabyte = 1024 ** 3
+        min_idle_seconds = _env_number('DATASET_MIN_IDLE_SECONDS')
+        interval = _env_number('DATASET_SWEEP_INTERVAL')
+        return cls(
+            root, flight,
+            ttl_seconds=_env_number('DATASET_TTL_HOURS', 3600),
+            disk_quota_bytes=_env_number('DATASET_DISK_QUOTA_GB', gigabyte),
+            user_quota_bytes=_env_number('DATASET_USER_QUOTA_GB', gigabyte),
+            min_idle_seconds=600 if min_idle_seconds is None else min_idle_seconds,
+            interval=600 if interval is None else interval,
+        )
+
+    @property
+    def limits(self):
+        return {
+            "ttl_seconds": self.ttl_seconds,
+            "disk_quota_bytes": self.disk_quota_bytes,
+            "user_quota_bytes": self.user_quota_bytes,
+            "min_idle_seconds": self.min_idle_seconds,
+        }
+
+    def touch(self, user_id, pack_type, pack_id):
+        """Record an access to a dataset."""
+        folder = os.path.join(self.root, user_id, pack_type, pack_id)
+        marker = os.path.join(folder, ACCESS_MARKER)
+        try:
+            os.utime(marker)
+        except FileNotFoundError:
+            if os.path.isdir(folder):
+                try:
+                    open(marker, 'a').close()
+                except OSError:
+                    pass
+        except OSError:
+            pass
+
+    def scan(self):
+        """Every dataset with its size in bytes and last access time."""
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for user_id in os.listdir(self.root):
+            user_folder = os.path.join(self.root, user_id)
+            if user_id.startswith('.') or not os.path.isdir(user_folder):
+                continue
+            for pack_type in os.listdir(user_folder):
+                type_folder = os.path.join(user_folder, pack_type)
+                if pack_type.startswith('.') or not os.path.isdir(type_folder):
+                    continue
+                for pack_id in os.listdir(type_folder):
+                    folder = os.path.join(type_folder, pack_id)
+                    # Dot-prefixed folders are downloads in progress (see storage.py)
+                    if pack_id.startswith('.') or not os.path.isdir(folder):
+                        continue
+                    try:
+                        marker = os.path.join(folder, ACCESS_MARKER)
+                        last_access = os.path.getmtime(marker if os.path.exists(marker) else folder)
+                    except OSError:
+                        continue
+                    entries.append({
+                        "user_id": user_id,
+                        "pack_type": pack_type,
+                        "pack_id": pack_id,
+                        "path": folder,
+                        "bytes": _folder_size(folder),
+                        "last_access": last_access,
+                    })
+        return entries
+
+    def usage(self):
+        """Storage by user, for the admin endpoint."""
+        entries = self.scan()
+        users = {}
+        for entry in entries:
+            user = users.setdefault(entry["user_id"], {"bytes": 0, "datasets": []})
+            user["bytes"] += entry["bytes"]
+            user["datasets"].append({key: entry[key] for key in ("pack_type", "pack_id", "bytes", "last_access")})
+        for user in users.values():
+            user["datasets"].sort(key=lambda dataset: dataset["last_access"], reverse=True)
+        return {
+            "total_bytes": sum(entry["bytes"] for entry in entries),
+            "datasets": len(entries),
+            "limits": self.limits,
+            "users": users,
+        }
+
+    def plan(self, entries, now=None):
+        """(entry, reason) pairs to evict for the configured limits, least recently used first."""
+        now = now or time.time()
+        evictable = sorted((entry for entry in entries if now - entry["last_access"] >= self.min_idle_seconds),
+                           key=lambda entry: entry["last_access"])
+        chosen = {}
+
+        if self.ttl_seconds:
+            for entry in evictable:
+                if now - entry["last_access"] >= self.ttl_seconds:
+                    chosen[entry["path"]] = (entry, 'ttl')
+
+        if self.user_quota_bytes:
+            user_bytes = {}
+            for entry in entries:
+                if entry["path"] not in chosen:
+                    user_bytes[entry["user_id"]] = user_bytes.get(entry["user_id"], 0) + entry["bytes"]
+            for entry in evictable:
+                if entry["path"] in chosen or user_bytes.get(entry["user_id"], 0) <= self.user_quota_bytes:
+                    continue
+                chosen[entry["path"]] = (entry, 'user_quota')
+                user_bytes[entry["user_id"]] -= entry["bytes"]
+
+        if self.disk_quota_bytes:
+            total = sum(entry["bytes"] for entry in entries if entry["path"] not in chosen)
+            for entry in evictable:
+                if total <= self.disk_quota_bytes:
+                    break
+                if entry["path"] in chosen:
+                    continue
+                chosen[entry["path"]] = (entry, 'disk_quota')
+                total -= entry["bytes"]
+
+        return list(chosen.values())
+
+    def evict(self, entry, reason):
+        key = f"{entry['user_id']}/{entry['pack_type']}/{entry['pack_id']}"
+        with self.flight.hold(key) as held:
+            if not held:
+                logger.info("Skipping eviction of %s: ingestion in progress", key)
+                return False
+            shutil.rmtree(entry["path"], ignore_errors=True)
+
+        # Remove the pack type and user folders once they are empty
+        for folder in (os.path.dirname(entry["path"]), os.path.dirname(os.path.dirname(entry["path"]))):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+
+        metrics.dataset_evictions.inc(reason=reason)
+        metrics.dataset_evicted_bytes.inc(entry["bytes"], reason=reason)
+        logger.info("Evicted dataset %s (%d bytes, idle %.0fs, reason=%s)",
+                    key, entry["bytes"], time.time() - entry["last_access"], reason)
+        return True
+
+    def sweep(self):
+        """Evict what the limits require. Only one process sweeps at a time; others return None."""
+        lock_file = None
+        if fcntl is not None:
+            os.makedirs(self.flight.lock_dir, exist_ok=True)
+            lock_file = open(os.path.join(self.flight.lock_dir, 'lifecycle.lock'), 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return None
+
+        try:
+            with metrics.span('dataset_sweep'):
+                entries = self.scan()
+                evicted = [dict(entry, reason=reason) for entry, reason in self.plan(entries)
+                           if self.evict(entry, reason)]
+            summary = {
+                "scanned": len(entries),
+                "evicted": [{key: entry[key] for key in ("user_id", "pack_type", "pack_id", "bytes", "reason")}
+                            for entry in evicted],
+                "bytes_freed": sum(entry["bytes"] for entry in evicted),
+            }
+            if evicted:
+                logger.info("Dataset sweep evicted %d of %d datasets, freed %d bytes",
+                            len(evicted), len(entries), summary["bytes_freed"])
+            return summary
+        finally:
+            if lock_file is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error("Dataset sweep failed: %s", e, exc_info=True)
+
+    def start(self):
+        """Sweep every `interval` seconds on a background thread (restarted in forked workers)."""
+        if not self.interval or self._thread is not None:
+            return self
+        self._start_thread()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._start_thread)
+        return self
+
+    def _start_thread(self):
+        self._thread = threading.Thread(target=self._run, name='dataset-lifecycle', daemon=True)
+        self._thread.start()
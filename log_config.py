@@ -0,0 +1,150 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+
+# Root level and per-module overrides, e.g. LOG_LEVELS="query=WARNING,vector=INFO,werkzeug=ERROR"
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+
+# Log file shared by all workers; set LOG_FILE to an empty string to log to the console only
+LOG_FILE = os.getenv('LOG_FILE', 'app.log')
+
+# 'text' (the original format) or 'json' for one structured object per line
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+
+# Payloads (documents, vector results, GPT responses) are cut to this many characters
+LOG_PAYLOAD_CHARS = int(os.getenv('LOG_PAYLOAD_CHARS', 200))
+
+# Fraction of records carrying a payload that are kept
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', 1.0))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_lock = threading.Lock()
+_listener = None
+
+
+class payload:
+    """
+    Wrap a large value passed as a logging argument.
+
+    The value is only converted to a string if the record is actually emitted, and is
+    truncated to LOG_PAYLOAD_CHARS characters, so passing full results to a disabled
+    DEBUG call costs nothing.
+    """
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = LOG_PAYLOAD_CHARS if limit is None else limit
+
+    def __str__(self):
+        text = self.value if isinstance(self.value, str) else str(self.value)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}... [{len(text) - self.limit} more chars]"
+
+    __repr__ = __str__
+
+
+class PayloadSampleFilter(logging.Filter):
+    """Drop a share of the records that carry a `payload` argument."""
+
+    def filter(self, record):
+        if LOG_PAYLOAD_SAMPLE_RATE >= 1.0:
+            return True
+        args = record.args if isinstance(record.args, tuple) else ()
+        if any(isinstance(arg, payload) for arg in args):
+            return random.random() < LOG_PAYLOAD_SAMPLE_RATE
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def _build_handlers():
+    formatter = JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        handlers.append(logging.FileHandler(LOG_FILE))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+def _parse_levels(spec):
+    levels = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        name, level = item.split('=', 1)
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def _start_listener(log_queue):
+    global _listener
+    _listener = logging.handlers.QueueListener(log_queue, *_build_handlers(), respect_handler_level=True)
+    _listener.start()
+
+
+def setup_logging():
+    """
+    Configure process-wide logging once.
+
+    Records are put on an in-memory queue by the calling thread and written to the
+    console and LOG_FILE by a background listener thread, so request handlers never
+    block on log I/O. The listener is restarted in forked children (gunicorn workers
+    forked from a preloaded master).
+    """
+    with _lock:
+        if _listener is not None:
+            return
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(PayloadSampleFilter())
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        root.setLevel(LOG_LEVEL)
+
+        for name, level in _parse_levels(LOG_LEVELS).items():
+            logging.getLogger(name).setLevel(level)
+
+        _start_listener(log_queue)
+        atexit.register(shutdown_logging)
+
+        # The listener thread does not survive fork; start a fresh one in each child
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=lambda: _start_listener(log_queue))
+
+
+def shutdown_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
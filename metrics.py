@@ -0,0 +1,530 @@
+import atexit
+import bisect
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+try:
+    import fcntl
+except ImportError:  # Windows: archiving a dead worker's metrics can race with a scrape
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Histogram buckets in seconds, from fast in-process stages to long LLM calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Optional trace export: a JSONL file of OTLP/JSON payloads and/or an OTLP/HTTP collector
+TRACE_EXPORT_FILE = os.getenv('TRACE_EXPORT_FILE')
+OTLP_ENDPOINT = os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT')
+SERVICE_NAME = os.getenv('OTEL_SERVICE_NAME', 'sourcebox-llm-api')
+
+# Directory shared by the gunicorn workers: each writes its metrics there and /metrics
+# merges them (see gunicorn.conf.py). Unset, /metrics shows the serving process only.
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '1'))
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=None):
+    items = list(label_key) + (list(extra) if extra else [])
+    if not items:
+        return ""
+    escaped = []
+    for name, value in items:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter:
+    """A monotonically increasing counter with optional labels."""
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        global _changed
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        _changed = True
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merge(self, snapshot):
+        """Add the values of another process's snapshot."""
+        with self._lock:
+            for key, value in snapshot:
+                key = tuple(tuple(item) for item in key)
+                self._values[key] = self._values.get(key, 0) + value
+
+    def reset(self):
+        """Drop every value, in a forked child (where another thread may have held the lock)."""
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    """A cumulative-bucket histogram with optional labels, in the Prometheus exposition format."""
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        global _changed
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+        _changed = True
+
+    def count(self, **labels):
+        series = self._series.get(_label_key(labels))
+        return series["count"] if series else 0
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), series["counts"], series["sum"], series["count"]]
+                    for key, series in self._series.items()]
+
+    def merge(self, snapshot):
+        """Add the observations of another process's snapshot."""
+        with self._lock:
+            for key, counts, total, count in snapshot:
+                if len(counts) != len(self.buckets):
+                    continue
+                key = tuple(tuple(item) for item in key)
+                series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                series["counts"] = [a + b for a, b in zip(series["counts"], counts)]
+                series["sum"] += total
+                series["count"] += count
+
+    def reset(self):
+        """Drop every value, in a forked child (where another thread may have held the lock)."""
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, series["counts"]):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+# Process-wide metrics. With METRICS_DIR, /metrics adds up the registries of every worker.
+_registry = []
+# Set when a metric changes, cleared when the process's values are written to METRICS_DIR
+_changed = False
+
+
+def counter(name, description):
+    metric = Counter(name, description)
+    _registry.append(metric)
+    return metric
+
+
+def histogram(name, description, buckets=DEFAULT_BUCKETS):
+    metric = Histogram(name, description, buckets)
+    _registry.append(metric)
+    return metric
+
+
+http_request_duration = histogram('http_request_duration_seconds', "HTTP request latency by endpoint and status.")
+stage_duration = histogram('stage_duration_seconds', "Latency of each request stage (auth, ingest, query, LLM, ...).")
+stage_errors = counter('stage_errors_total', "Stages that raised an exception.")
+embedding_requests = counter('embedding_requests_total', "Calls made to the embeddings API.")
+embedded_texts = counter('embedded_texts_total', "Texts sent to the embeddings API.")
+embedding_batch_size = histogram('embedding_batch_size', "Number of texts per embeddings API call.",
+                                 buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048))
+embedding_queries = counter('embedding_queries_total',
+                            "Query embeddings by batching role: leader (made the batched call) or joined (shared it).")
+pipeline_cancelled_stages = counter('pipeline_cancelled_stages_total',
+                                    "Request stages cancelled or discarded because another stage ended the request.")
+response_bytes = counter('response_bytes_total',
+                         "JSON response bytes before (raw) and after (sent) compression, by content encoding.")
+llm_tokens = counter('llm_tokens_total', "Tokens counted for LLM calls and vectorization, by kind.")
+cache_requests = counter('cache_requests_total', "Cache lookups by cache name and result (hit or miss).")
+openai_retries = counter('openai_retries_total', "Retries of OpenAI API calls after rate-limit errors.")
+pack_cache_saved_bytes = counter('pack_cache_saved_bytes_total',
+                                 "Pack download bytes avoided because packman answered 304 Not Modified.")
+pack_cache_saved_seconds = counter('pack_cache_saved_seconds_total',
+                                   "Ingestion time avoided by reusing the dataset of an unchanged pack.")
+dataset_evictions = counter('dataset_evictions_total', "Datasets evicted by the lifecycle manager, by reason.")
+dataset_evicted_bytes = counter('dataset_evicted_bytes_total', "Bytes freed by dataset evictions, by reason.")
+dataset_store_bytes = counter('dataset_store_bytes_total', "Bytes moved between the local datasets and the object store, by direction.")
+routing_requests = counter('routing_requests_total',
+                           "Pack requests by routing result (local, forwarded, or fallback after a failed forward).")
+quota_rejections = counter('quota_rejections_total',
+                           "Requests refused by the quota limiter, by reason (usage, tokens or requests).")
+ingestion_singleflight = counter('ingestion_singleflight_total',
+                                 "Pack ingestions by single-flight role (leader ran it, waiter/shared reused it).")
+dedup_chunks = counter('dedup_chunks_total',
+                       "Chunks not embedded because they duplicate another chunk of the pack, by kind (exact or near).")
+dedup_saved_tokens = counter('dedup_saved_tokens_total', "Embedding tokens saved by chunk deduplication.")
+extracted_documents = counter('extracted_documents_total',
+                              "PDF, DOCX and XLSX documents by format and extraction result (ok, empty, failed).")
+
+
+def record_cache(cache, hit):
+    """Count a lookup on the named cache."""
+    cache_requests.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def render_metrics():
+    """Render every registered metric in the Prometheus text exposition format."""
+    registry = _registry if not METRICS_DIR else _shared.merged()
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _SharedMetrics:
+    """
+    The registries of all worker processes, merged through files in `directory`.
+
+    Each process writes its values to `<pid>-<id>.json` every `flush_interval` seconds
+    when they changed, at exit, and before it renders /metrics; a scrape adds up every
+    file, so counters and histograms cover all workers whichever one serves it. When
+    gunicorn reports a worker dead, its file is added into `archive.json`, so totals
+    never go backwards when workers are recycled.
+    """
+
+    ARCHIVE = 'archive.json'
+
+    def __init__(self, directory, flush_interval):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+        self._start()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+        atexit.register(self.flush)
+
+    def _start(self):
+        # A new id per process: a recycled pid must not overwrite a dead worker's file
+        self.path = os.path.join(self.directory, f"{os.getpid()}-{os.urandom(4).hex()}.json")
+        self._flush_lock = threading.Lock()
+        threading.Thread(target=self._run, name='metrics-flush', daemon=True).start()
+
+    def _after_fork(self):
+        # Values inherited from a preloading master are already counted in its own file
+        for metric in _registry:
+            metric.reset()
+        self._start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if _changed:
+                self.flush()
+
+    def flush(self):
+        """Write this process's values to its file."""
+        global _changed
+        with self._flush_lock:
+            _changed = False
+            snapshot = {metric.name: metric.snapshot() for metric in _registry}
+            try:
+                _write_json(self.path, snapshot)
+            except FileNotFoundError:
+                # The server removed the directory on shutdown
+                pass
+            except OSError as e:
+                logger.error("Failed to write metrics to %s: %s", self.path, e)
+
+    def merged(self):
+        """Fresh metrics holding the sum of every process's values."""
+        self.flush()
+        merged = [_empty_copy(metric) for metric in _registry]
+        by_name = {metric.name: metric for metric in merged}
+        with self._locked(fcntl.LOCK_SH if fcntl else None):
+            for entry in os.listdir(self.directory):
+                if not entry.endswith('.json'):
+                    continue
+                snapshot = _read_json(os.path.join(self.directory, entry))
+                for name, values in (snapshot or {}).items():
+                    if name in by_name:
+                        by_name[name].merge(values)
+        return merged
+
+    def mark_process_dead(self, pid):
+        """Add the files of the exited process `pid` to the archive."""
+        with self._locked(fcntl.LOCK_EX if fcntl else None):
+            paths = [os.path.join(self.directory, entry) for entry in os.listdir(self.directory)
+                     if entry.startswith(f"{pid}-") and entry.endswith('.json')]
+            if not paths:
+                return
+            archive_path = os.path.join(self.directory, self.ARCHIVE)
+            archive = _read_json(archive_path) or {}
+            for path in paths:
+                for name, values in (_read_json(path) or {}).items():
+                    archive.setdefault(name, []).extend(values)
+            # The archive keeps one entry per label set, summed
+            for metric in _registry:
+                if metric.name in archive:
+                    summed = _empty_copy(metric)
+                    summed.merge(archive[metric.name])
+                    archive[metric.name] = summed.snapshot()
+            _write_json(archive_path, archive)
+            for path in paths:
+                os.remove(path)
+
+    @contextmanager
+    def _locked(self, mode):
+        if mode is None:
+            yield
+            return
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _empty_copy(metric):
+    if isinstance(metric, Histogram):
+        return Histogram(metric.name, metric.description, metric.buckets)
+    return Counter(metric.name, metric.description)
+
+
+def _write_json(path, value):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+_shared = _SharedMetrics(METRICS_DIR, METRICS_FLUSH_SECONDS) if METRICS_DIR else None
+
+
+def mark_process_dead(pid):
+    """Keep the totals of an exited worker process (gunicorn's child_exit hook)."""
+    if _shared is not None:
+        _shared.mark_process_dead(pid)
+
+
+# _____________tracing_______________
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class _TraceExporter:
+    """Batches finished spans on a background thread and writes them as OTLP/JSON."""
+
+    def __init__(self, file_path=None, endpoint=None, flush_interval=2.0, max_batch=512):
+        self.file_path = file_path
+        self.endpoint = endpoint.rstrip('/') + '/v1/traces' if endpoint else None
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._start()
+        # A preloading gunicorn master forks workers after this thread exists; threads do
+        # not survive fork, so each child starts its own
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+        self._thread.start()
+
+    def submit(self, span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            # Dropping spans is preferable to blocking the request path
+            pass
+
+    def _run(self):
+        while True:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+                while len(batch) < self.max_batch:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if batch:
+                self._export(batch)
+
+    def _export(self, spans):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+                "scopeSpans": [{"scope": {"name": "sourcebox"}, "spans": spans}],
+            }]
+        }
+        if self.file_path:
+            try:
+                with open(self.file_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(payload) + "\n")
+            except OSError as e:
+                logger.error("Failed to write traces to %s: %s", self.file_path, e)
+        if self.endpoint:
+            try:
+                requests.post(self.endpoint, json=payload, timeout=5)
+            except requests.RequestException as e:
+                logger.error("Failed to export traces to %s: %s", self.endpoint, e)
+
+
+_exporter = _TraceExporter(TRACE_EXPORT_FILE, OTLP_ENDPOINT) if (TRACE_EXPORT_FILE or OTLP_ENDPOINT) else None
+
+
+def _otlp_attributes(attributes):
+    converted = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            converted.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            converted.append({"key": key, "value": {"intValue": str(value)}})
+        elif isinstance(value, float):
+            converted.append({"key": key, "value": {"doubleValue": value}})
+        else:
+            converted.append({"key": key, "value": {"stringValue": str(value)}})
+    return converted
+
+
+class span:
+    """
+    Time a request stage.
+
+    Records the duration in `stage_duration_seconds{stage=name}` and, when trace export is
+    configured, emits an OTLP span nested under the enclosing span of the same context.
+    Usable as a context manager or, through `timed`, as a function decorator.
+    """
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.span_id = os.urandom(8).hex()
+        self._token = _current_span.set(self)
+        self._start_wall = time.time_ns()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = self.duration = time.perf_counter() - self._start
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # Exited from a different context than it was entered in (e.g. a streamed response)
+            pass
+        stage_duration.observe(duration, stage=self.name)
+        if exc_type is not None:
+            stage_errors.inc(stage=self.name)
+
+        if _exporter:
+            record = {
+                "traceId": self.trace_id,
+                "spanId": self.span_id,
+                "name": self.name,
+                "kind": 1,
+                "startTimeUnixNano": str(self._start_wall),
+                "endTimeUnixNano": str(self._start_wall + int(duration * 1e9)),
+                "attributes": _otlp_attributes(self.attributes),
+                "status": {"code": 2, "message": str(exc)} if exc_type is not None else {"code": 1},
+            }
+            if self.parent_id:
+                record["parentSpanId"] = self.parent_id
+            _exporter.submit(record)
+        return False
+
+
+def timed(name):
+    """Decorator form of `span`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def init_app(app):
+    """Time every request and expose the registry on /metrics."""
+    from flask import Response, request
+
+    @app.before_request
+    def start_request_span():
+        request._metrics_span = span('http_request', method=request.method, path=request.path)
+        request._metrics_span.__enter__()
+
+    @app.after_request
+    def record_status(response):
+        request._metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def end_request_span(exc):
+        request_span = getattr(request, '_metrics_span', None)
+        if request_span is None:
+            return
+        request_span.attributes['status'] = getattr(request, '_metrics_status', 500)
+        request_span.__exit__(type(exc) if exc else None, exc, None)
+        http_request_duration.observe(request_span.duration, endpoint=request.endpoint or 'unknown',
+                                      status=request_span.attributes['status'])
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,88 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def python(code, metrics_dir, **kwargs):
+    """Run `code` in a new process with metrics shared through `metrics_dir`."""
+    env = dict(os.environ, METRICS_DIR=str(metrics_dir), METRICS_FLUSH_SECONDS='60')
+    return subprocess.Popen([sys.executable, '-c', textwrap.dedent(code)], cwd=ROOT, env=env, text=True,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, **kwargs)
+
+
+def worker(metrics_dir, requests, wait=False):
+    """A process counting `requests` embedding calls and one stage; with `wait`, alive until stdin closes."""
+    process = python(f"""
+        import sys
+        import metrics
+        metrics.embedding_requests.inc({requests})
+        metrics.stage_duration.observe(0.02, stage='perform_query')
+        metrics._shared.flush()
+        print('flushed', flush=True)
+        if {wait}:
+            sys.stdin.read()
+    """, metrics_dir)
+    assert process.stdout.readline().strip() == 'flushed'
+    return process
+
+
+def scrape(metrics_dir):
+    output, _ = python("import metrics; print(metrics.render_metrics())", metrics_dir).communicate(timeout=30)
+    return output.splitlines()
+
+
+def mark_dead(metrics_dir, pid):
+    python(f"import metrics; metrics.mark_process_dead({pid})", metrics_dir).communicate(timeout=30)
+
+
+def value(lines, series):
+    return next(float(line.rsplit(' ', 1)[1]) for line in lines if line.startswith(series + ' '))
+
+
+@pytest.fixture
+def metrics_dir(tmp_path):
+    return tmp_path / 'metrics'
+
+
+def test_scrape_adds_up_every_worker(metrics_dir):
+    first = worker(metrics_dir, 2, wait=True)
+    second = worker(metrics_dir, 3, wait=True)
+    try:
+        lines = scrape(metrics_dir)
+        assert value(lines, 'embedding_requests_total') == 5
+        assert value(lines, 'stage_duration_seconds_count{stage="perform_query"}') == 2
+        assert value(lines, 'stage_duration_seconds_bucket{stage="perform_query",le="0.025"}') == 2
+    finally:
+        first.communicate(timeout=30)
+        second.communicate(timeout=30)
+
+
+def test_totals_survive_recycled_workers(metrics_dir):
+    exited = worker(metrics_dir, 2)
+    exited.communicate(timeout=30)
+    alive = worker(metrics_dir, 3, wait=True)
+    try:
+        assert value(scrape(metrics_dir), 'embedding_requests_total') == 5
+
+        mark_dead(metrics_dir, exited.pid)
+        assert not any(entry.startswith(f"{exited.pid}-") for entry in os.listdir(metrics_dir))
+        assert value(scrape(metrics_dir), 'embedding_requests_total') == 5
+    finally:
+        alive.communicate(timeout=30)
+
+    mark_dead(metrics_dir, alive.pid)
+    # A replacement worker adds to the archived totals
+    worker(metrics_dir, 1).communicate(timeout=30)
+    lines = scrape(metrics_dir)
+    assert value(lines, 'embedding_requests_total') == 6
+    assert value(lines, 'stage_duration_seconds_count{stage="perform_query"}') == 3
+
+
+def test_exiting_worker_flushes_its_last_values(metrics_dir):
+    python("import metrics; metrics.embedding_requests.inc(4)", metrics_dir).communicate(timeout=30)
+    assert value(scrape(metrics_dir), 'embedding_requests_total') == 4
@@ -0,0 +1,153 @@
+import contextvars
+import logging
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Threads shared by all requests of a worker for stages that run beside the request thread (0 = run in sequence)
+PIPELINE_THREADS = int(os.getenv('PIPELINE_THREADS', '16'))
+
+
+class Abort(Exception):
+    """Raised by a stage to end the request with `response`, a Flask-RESTful return value."""
+
+    def __init__(self, response):
+        super().__init__(response)
+        self.response = response
+
+
+class _Stage:
+    def __init__(self, name, fn, after, speculative, error):
+        self.name = name
+        self.fn = fn
+        self.after = tuple(after)
+        self.speculative = speculative
+        self.error = error
+
+
+class Pipeline:
+    """
+    The stages of one request as a dependency graph.
+
+    Each stage is called with the results of the stages it comes `after`, in that order, as
+    soon as they are all available; stages that do not depend on each other run
+    concurrently, one on the request thread and the others on a shared thread pool, so a
+    request takes about as long as its slowest chain of stages rather than the sum of them.
+
+    - A stage that raises ends the run: stages that have not started are cancelled and the
+      results of those still running are discarded. `Abort` is re-raised as is; other
+      errors become `Abort(error)` when the stage has an `error` response (or
+      `Abort(error(e))` when `error` is a function of the exception), and are re-raised
+      otherwise.
+    - Every stage is timed as the span `pipeline.<stage>`.
+    - A speculative stage is work done ahead of knowing it is needed (e.g. embedding the
+      query before the user is authenticated). Its failure does not fail the request: its
+      result is None and the stages after it fall back to doing the work themselves.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._stages = {}
+
+    def stage(self, name, fn, after=(), speculative=False, error=None):
+        for dependency in after:
+            if dependency not in self._stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}")
+        self._stages[name] = _Stage(name, fn, after, speculative, error)
+        return self
+
+    def run(self, target):
+        """Run the stages `target` depends on, and `target`; returns the results by stage name."""
+        needed = self._needed(target)
+        pending = [stage for stage in self._stages.values() if stage.name in needed]
+        results = {}
+        futures = {}
+        try:
+            while target not in results:
+                for future in [f for f in futures if f.done()]:
+                    self._finish(futures.pop(future), future, results)
+
+                ready = [stage for stage in pending if all(d in results for d in stage.after)]
+                if not ready:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._finish(futures.pop(future), future, results)
+                    continue
+
+                for stage in ready:
+                    pending.remove(stage)
+                # Speculative stages go to the pool first, so the request thread stays on the critical path
+                ready.sort(key=lambda stage: not stage.speculative)
+                inline = ready.pop()
+                for stage in ready:
+                    if PIPELINE_THREADS > 0:
+                        # A copy of the request's context, so the stage's spans nest under the request span
+                        futures[_pool().submit(contextvars.copy_context().run, self._call, stage,
+                                               self._arguments(stage, results))] = stage
+                    else:
+                        results[stage.name] = self._call(stage, self._arguments(stage, results))
+                results[inline.name] = self._call(inline, self._arguments(inline, results))
+        finally:
+            for future, stage in futures.items():
+                if future.cancel() or not future.done():
+                    logger.debug("Pipeline %s: dropping stage %s", self.name, stage.name)
+                    metrics.pipeline_cancelled_stages.inc(pipeline=self.name, stage=stage.name)
+        return results
+
+    def _needed(self, target):
+        needed, stack = set(), [target]
+        while stack:
+            name = stack.pop()
+            if name not in needed:
+                needed.add(name)
+                stack.extend(self._stages[name].after)
+        return needed
+
+    def _finish(self, stage, future, results):
+        results[stage.name] = future.result()
+
+    def _arguments(self, stage, results):
+        return [results[dependency] for dependency in stage.after]
+
+    def _call(self, stage, arguments):
+        try:
+            with metrics.span(f"pipeline.{stage.name}", pipeline=self.name):
+                return stage.fn(*arguments)
+        except Abort:
+            raise
+        except Exception as e:
+            if stage.speculative:
+                logger.warning("Pipeline %s: speculative stage %s failed, continuing without it: %s",
+                               self.name, stage.name, str(e))
+                return None
+            logger.error("Pipeline %s: stage %s failed: %s", self.name, stage.name, str(e))
+            if stage.error is not None:
+                raise Abort(stage.error(e) if callable(stage.error) else stage.error) from e
+            raise
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=PIPELINE_THREADS, thread_name_prefix='pipeline')
+        return _executor
+
+
+def _forget_pool():
+    # The pool's threads do not exist in a forked child
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_pool)
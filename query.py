@@ -1,86 +1,292 @@
-from langchain_community.vectorstores import DeepLake
 from custom_embedding import CustomEmbeddingFunction
-from openai import OpenAI
 import os
 from dotenv import load_dotenv
+from log_config import setup_logging, payload
+from lazy import lazy_import
 import logging
+import metrics
+import chunk_store
 
-# Set up logging
-logging.basicConfig(
-    level=logging.DEBUG,  # Minimum level of severity to capture
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',  # Log message format
-    handlers=[
-        logging.FileHandler('app.log'),  # Log to a file
-        logging.StreamHandler()  # Also log to the console
-    ]
-)
+# Imported on first use (see app.warm_up)
+np = lazy_import('numpy')
+DeepLake = lazy_import('langchain_community.vectorstores', 'DeepLake')
+OpenAI = lazy_import('openai', 'OpenAI')
+Document = lazy_import('langchain.docstore.document', 'Document')
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
-def perform_query(db_instance, query):
-    logging.info(f"Initiating query with text: {query}")
+
+class StoreIndex:
+    """
+    Searches a pack's chunk store (see chunk_store.py) with the same interface the query
+    functions use on a DeepLake instance: `similarity_search`, `similarity_search_by_vector`
+    and `embeddings`.
+    """
+
+    def __init__(self, store, embeddings):
+        self.store = store
+        self.embeddings = embeddings
+
+    def similarity_search(self, query, k=4):
+        if len(self.store) == 0:
+            return []
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k=k)
+
+    def similarity_search_by_vector(self, embedding, k=4):
+        if len(self.store) == 0:
+            return []
+        ids, scores = self.store.search(embedding, k=k)
+        # Chunks deduplicated at ingestion are listed under the chunk they repeat
+        return [Document(page_content=self.store.text(i),
+                         metadata={'source': self.store.source(i), 'lines': self.store.line_range(i),
+                                   'score': float(score),
+                                   'duplicates': [{'source': source, 'lines': lines}
+                                                  for source, lines in self.store.duplicates(i)]})
+                for i, score in zip(ids[0], scores[0])]
+
+
+def duplicate_sources(db_instance, doc):
+    """
+    [{"source", "lines"}] of the chunks deduplicated into a matched document at ingestion;
+    `lines` is [first, last] or None when unknown. Chunk store matches carry them in their
+    metadata; DeepLake matches are looked up by text in the dataset's duplicates file.
+    """
+    metadata = getattr(doc, 'metadata', None) or {}
+    if 'duplicates' in metadata:
+        return _duplicate_entries((entry['source'], *entry['lines']) for entry in metadata['duplicates'])
+    return _dataset_duplicates(getattr(db_instance, 'dataset_path', None), doc.page_content)
+
+
+def _dataset_duplicates(dataset_path, text):
+    if not dataset_path:
+        return []
+    keyed = chunk_store.read_duplicates(chunk_store.duplicates_path(dataset_path))
+    return _duplicate_entries(keyed.get(chunk_store.text_key(text), [])) if keyed else []
+
+
+def _duplicate_entries(entries):
+    return [{"source": source, "lines": [first, last] if first else None} for source, first, last in entries]
+
+
+def with_duplicate_sources(text, duplicates):
+    """A match's text as returned in "Document N" results, followed by the other sources it was found in."""
+    if not duplicates:
+        return text
+    sources = ", ".join(f"{entry['source']} (lines {entry['lines'][0]}-{entry['lines'][1]})" if entry['lines']
+                        else entry['source'] for entry in duplicates)
+    return f"{text}\n\n[Also in: {sources}]"
+
+
+def open_dataset(dataset_path, embedding_function):
+    """
+    Open a pack's dataset for querying: its chunk store when one has been built, which needs
+    no DeepLake open and reads only the pages a search touches, otherwise the DeepLake dataset.
+    """
+    store = chunk_store.open_store(chunk_store.store_path(dataset_path))
+    metrics.record_cache('chunk_store', store is not None)
+    if store is not None:
+        return StoreIndex(store, embedding_function)
+    logger.info("No chunk store for %s, opening the DeepLake dataset", dataset_path)
+    return DeepLake(dataset_path=dataset_path, embedding=embedding_function, read_only=True)
+
+
+@metrics.timed('perform_query')
+def perform_query(db_instance, query, embedding=None):
+    """Top matches for `query`; `embedding` is its vector when already computed (see app.query_pipeline)."""
+    logger.debug("Initiating query with text: %s", payload(query))
     try:
         # Validate query
         if not isinstance(query, str) or not query.strip():
-            logging.error(f"Invalid query provided: {query}")
+            logger.error("Invalid query provided: %s", payload(query))
             raise ValueError("Query must be a non-empty string.")
 
-        logging.info("Checking if db_instance is initialized properly...")
+        logger.debug("Checking if db_instance is initialized properly...")
         if db_instance is None:
-            logging.error("The db_instance is None. Aborting query.")
+            logger.error("The db_instance is None. Aborting query.")
             return {}
 
         # Start performing the similarity search
-        logging.info(f"Executing similarity search with query: '{query}'")
-        docs = db_instance.similarity_search(query)
+        logger.debug("Executing similarity search with query: '%s'", payload(query))
+        if embedding is not None:
+            docs = db_instance.similarity_search_by_vector(embedding)
+        else:
+            docs = db_instance.similarity_search(query)
         
         # Check how many documents were found
-        logging.info(f"Search complete. {len(docs)} documents were found matching the query.")
+        logger.info("Search complete. %d documents were found matching the query.", len(docs))
 
         if len(docs) == 0:
-            logging.warning("No documents returned for the query. Returning an empty result.")
+            logger.warning("No documents returned for the query. Returning an empty result.")
             return {}
 
         output = {}
-        logging.info(f"Processing each document retrieved from the search...")
+        logger.debug("Processing each document retrieved from the search...")
         
         # Log detailed information for each document
         for i, doc in enumerate(docs):
             if doc is None:
-                logging.warning(f"Document {i + 1} is None. Skipping this document.")
+                logger.warning("Document %d is None. Skipping this document.", i + 1)
                 continue
 
             # Ensure the document has page_content and it is a string
             if not hasattr(doc, 'page_content') or not isinstance(doc.page_content, str):
-                logging.warning(f"Document {i + 1} does not have valid page_content or it's not a string. Skipping.")
+                logger.warning("Document %d does not have valid page_content or it's not a string. Skipping.", i + 1)
                 continue
 
-            # Log metadata if it exists, otherwise log that metadata is missing
-            if hasattr(doc, 'metadata') and doc.metadata:
-                logging.info(f"Document {i + 1} metadata: {doc.metadata}")
-            else:
-                logging.info(f"Document {i + 1} has no metadata.")
-
-            # Log a snippet of the document for clarity
-            logging.info(f"Document {i + 1} content snippet: {doc.page_content[:100]}...")
+            # Log metadata and a snippet of the document at DEBUG; formatted only when enabled
+            logger.debug("Document %d metadata: %s", i + 1, getattr(doc, 'metadata', None) or "none")
+            logger.debug("Document %d content snippet: %s", i + 1, payload(doc.page_content, 100))
 
-            output[f"Document {i + 1}"] = doc.page_content
+            output[f"Document {i + 1}"] = with_duplicate_sources(doc.page_content, duplicate_sources(db_instance, doc))
         
-        logging.info(f"Finished processing all {len(docs)} documents. Returning results.")
+        logger.debug("Finished processing all %d documents. Returning results.", len(docs))
         return output
 
     except ValueError as ve:
-        logging.error(f"ValueError occurred: {ve}")
+        logger.error(f"ValueError occurred: {ve}")
         return {}
     except Exception as e:
-        logging.error(f"An error occurred during the similarity search: {e}", exc_info=True)
+        logger.error(f"An error occurred during the similarity search: {e}", exc_info=True)
         return {}
 
 
+@metrics.timed('search_documents')
+def search_documents(db_instance, query, embedding=None, k=4, offset=0, max_chars=None):
+    """
+    One page of the matches for `query` in the structured result format.
+
+    Returns {"results": [...], "offset": offset, "next_offset": n or None}, where each
+    result is {"id", "score", "source", "text", "duplicates"}: `id` is the match's rank (as
+    in "Document <id>" of perform_query), `score` its similarity (None on DeepLake datasets
+    without a chunk store), `text` its content, cut to `max_chars` characters with
+    "truncated": true when longer, and `duplicates` the other sources of the same chunk
+    (see duplicate_sources). Results `offset` to `offset + k` are returned.
+    """
+    if not isinstance(query, str) or not query.strip():
+        raise ValueError("Query must be a non-empty string.")
+    if embedding is None:
+        embedding = db_instance.embeddings.embed_query(query)
+    # One extra match tells whether there is a next page
+    docs = db_instance.similarity_search_by_vector(embedding, k=offset + k + 1)
+    logger.info("Search complete. %d documents were found matching the query.", len(docs))
+
+    results = []
+    for rank, doc in enumerate(docs[offset:offset + k], start=offset + 1):
+        metadata = getattr(doc, 'metadata', None) or {}
+        score = metadata.get('score')
+        result = {"id": rank, "score": float(score) if score is not None else None,
+                  "source": metadata.get('source'), "text": doc.page_content,
+                  "duplicates": duplicate_sources(db_instance, doc)}
+        if max_chars is not None and len(doc.page_content) > max_chars:
+            result["text"] = doc.page_content[:max_chars]
+            result["truncated"] = True
+        results.append(result)
+    next_offset = offset + k if len(docs) > offset + k else None
+    return {"results": results, "offset": offset, "next_offset": next_offset}
+
+
+# Maximum number of queries sent to the embeddings API in one request
+EMBEDDING_BATCH_SIZE = 2048
+
+# Number of queries scored against the dataset matrix at once (bounds memory use)
+SEARCH_BLOCK_SIZE = 256
+
+
+def iter_batch_query(db_instance, queries, k=4):
+    """
+    Run a similarity search for many queries against a single pack's dataset.
+
+    The queries are embedded in batched calls and scored with one cosine-similarity
+    matrix product per block instead of one `similarity_search` per query.
+
+    Args:
+    db_instance (DeepLake or StoreIndex): Opened dataset whose embedding function is used for the queries.
+    queries (List[str]): Query texts.
+    k (int): Number of documents to return per query (same default as `similarity_search`).
+
+    Yields:
+    Tuple[int, Dict[str, str]]: The query index and its results, in the same
+    `{"Document N": page_content}` format returned by `perform_query`.
+    """
+    if db_instance is None:
+        logger.error("The db_instance is None. Aborting batch query.")
+        return
+
+    if isinstance(db_instance, StoreIndex):
+        store = db_instance.store
+        count = len(store)
+    else:
+        dataset = db_instance.vectorstore.dataset
+        count = len(dataset)
+    if count == 0:
+        logger.warning("Dataset is empty. Returning empty results for all %d queries.", len(queries))
+        for index in range(len(queries)):
+            yield index, {}
+        return
+
+    if isinstance(db_instance, StoreIndex):
+        # Stored normalized and memory-mapped; texts are sliced straight out of the store
+        matrix = store.embeddings
+        fetch_texts = lambda ids: [
+            with_duplicate_sources(store.text(i), _duplicate_entries((source, *lines) for source, lines in store.duplicates(i)))
+            for i in ids]
+    else:
+        # Load and normalize the stored embeddings once for the whole batch
+        matrix = dataset.embedding.numpy().astype(np.float32, copy=False)
+        matrix_norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix_norms[matrix_norms == 0] = 1.0
+        matrix = matrix / matrix_norms
+        fetch_texts = lambda ids: [with_duplicate_sources(text, _dataset_duplicates(db_instance.dataset_path, text))
+                                   for text in dataset.text[ids].data(aslist=True)["value"]]
+    k = max(1, min(k, matrix.shape[0]))
+    logger.info("Loaded %d stored embeddings for batch query of %d queries.", matrix.shape[0], len(queries))
+
+    for start in range(0, len(queries), EMBEDDING_BATCH_SIZE):
+        batch = queries[start:start + EMBEDDING_BATCH_SIZE]
+        query_vectors = np.asarray(db_instance.embeddings.embed_documents(batch), dtype=np.float32)
+        query_norms = np.linalg.norm(query_vectors, axis=1, keepdims=True)
+        query_norms[query_norms == 0] = 1.0
+        query_vectors = query_vectors / query_norms
+
+        for block_start in range(0, len(batch), SEARCH_BLOCK_SIZE):
+            scores = query_vectors[block_start:block_start + SEARCH_BLOCK_SIZE] @ matrix.T
+
+            # Select the top-k rows per query without sorting the whole score matrix
+            if k < scores.shape[1]:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                top = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+            order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+
+            # Fetch the texts of every hit in the block with a single dataset read
+            hit_ids = sorted(set(int(i) for i in top.ravel()))
+            texts = fetch_texts(hit_ids)
+            text_by_id = dict(zip(hit_ids, texts))
+
+            for row, ids in enumerate(top):
+                output = {f"Document {rank + 1}": text_by_id[int(i)] for rank, i in enumerate(ids)}
+                yield start + block_start + row, output
+
+
+def perform_batch_query(db_instance, queries, k=4):
+    """Run `iter_batch_query` and collect the results into a list ordered like `queries`."""
+    results = [{} for _ in queries]
+    try:
+        for index, output in iter_batch_query(db_instance, queries, k=k):
+            results[index] = output
+    except Exception as e:
+        logger.error(f"An error occurred during the batch similarity search: {e}", exc_info=True)
+    return results
+
 
 
 if __name__ == "__main__":
+    setup_logging()
+
     # Initialize OpenAI client
     client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
@@ -95,7 +301,7 @@ if __name__ == "__main__":
     dataset_path = os.path.join("my_deeplake", user_id, pack_id, "actual_deeplake_name")
 
     # Initialize DeepLake instance
-    logging.info(f"Loading DeepLake from path: {dataset_path}")
+    logger.info("Loading DeepLake from path: %s", dataset_path)
     db = DeepLake(dataset_path=dataset_path, embedding=embedding_function, read_only=True)
     
     # Define the query
@@ -0,0 +1,311 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+import identity
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name, default):
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning("Ignoring invalid %s=%r", name, value)
+        return default
+
+
+def user_key(access_token):
+    """
+    The user whose buckets and usage a token draws on (see identity.py), so every token of
+    a user shares their limits. None when the auth service does not know the token.
+    """
+    try:
+        return identity.user_ids.lookup(access_token)
+    except identity.UserIdError:
+        return None
+
+
+class MemoryBuckets:
+    """Token buckets held in this process; each gunicorn worker enforces its own share."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, capacity, cost, minimum, now):
+        with self._lock:
+            level, updated = self._buckets.get(key, (capacity, now))
+            level = min(capacity, level + (now - updated) * rate)
+            taken = level >= minimum
+            if taken:
+                level = max(-capacity, level - cost)
+            self._buckets[key] = (level, now)
+            return taken, level
+
+    def prune(self, older_than):
+        with self._lock:
+            for key in [key for key, (level, updated) in self._buckets.items() if updated < older_than]:
+                del self._buckets[key]
+
+
+class SqliteBuckets:
+    """
+    Token buckets in a SQLite file, so every worker on the host draws from the same buckets.
+
+    Each update runs in its own immediate transaction; SQLite serializes them across processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS buckets "
+                               "(key TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)")
+
+    def _connection(self):
+        # Connections cannot cross threads or forks; keep one per thread of each process
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def take(self, key, rate, capacity, cost, minimum, now):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT level, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            level, updated = row if row else (capacity, now)
+            level = min(capacity, level + (now - updated) * rate)
+            taken = level >= minimum
+            if taken:
+                level = max(-capacity, level - cost)
+            connection.execute("INSERT OR REPLACE INTO buckets (key, level, updated) VALUES (?, ?, ?)",
+                               (key, level, now))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return taken, level
+
+    def prune(self, older_than):
+        self._connection().execute("DELETE FROM buckets WHERE updated < ?", (older_than,))
+
+
+class QuotaLimiter:
+    """
+    Per-user quotas enforced locally, before a request does any expensive work.
+
+    - Requests: a token bucket of `request_burst` requests refilled at `requests_per_minute`.
+    - LLM tokens: a bucket of `token_burst` tokens refilled at `tokens_per_minute`. A request
+      is admitted while the bucket is not in debt; the tokens it actually used are taken
+      afterwards, so a large request delays the user's next ones instead of being cut short.
+    - Total usage: requests are refused once the user's usage recorded by the auth service
+      exceeds `usage_limit`. Usage is fetched from the auth service the first time a user is
+      seen, counted locally as tokens are used, and re-fetched in the background every
+      `sync_interval` seconds instead of on every request.
+
+    A rate of 0 disables that bucket. Buckets live in this process, or in the SQLite file
+    `db_path` to be shared by all workers on the host. Buckets and usage belong to the user
+    behind the access token, not to the token; a token the auth service does not know is
+    not limited here, since the request fails its own user lookup.
+    """
+
+    def __init__(self, auth_api=None, usage_limit=1000000, requests_per_minute=0, request_burst=None,
+                 tokens_per_minute=0, token_burst=None, db_path=None, sync_interval=60, idle_seconds=900):
+        self.auth_api = auth_api
+        self.usage_limit = usage_limit
+        self.request_rate = requests_per_minute / 60.0
+        self.request_burst = request_burst or requests_per_minute
+        self.token_rate = tokens_per_minute / 60.0
+        self.token_burst = token_burst or tokens_per_minute
+        self.sync_interval = sync_interval
+        self.idle_seconds = idle_seconds
+        self.db_path = db_path
+        self.buckets = SqliteBuckets(db_path) if db_path else MemoryBuckets()
+        # user id -> {"total", "access_token" (the user's latest), "synced_at", "seen_at"}
+        self._usage = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls):
+        """
+        TOKEN_LIMIT (default 1000000), QUOTA_REQUESTS_PER_MINUTE / QUOTA_REQUEST_BURST and
+        QUOTA_TOKENS_PER_MINUTE / QUOTA_TOKEN_BURST (0 = off), QUOTA_DB, QUOTA_SYNC_SECONDS
+        (default 60) and QUOTA_IDLE_SECONDS (default 900).
+        """
+        return cls(
+            auth_api=os.getenv('AUTH_API'),
+            usage_limit=_env_float('TOKEN_LIMIT', 1000000),
+            requests_per_minute=_env_float('QUOTA_REQUESTS_PER_MINUTE', 0),
+            request_burst=_env_float('QUOTA_REQUEST_BURST', None),
+            tokens_per_minute=_env_float('QUOTA_TOKENS_PER_MINUTE', 0),
+            token_burst=_env_float('QUOTA_TOKEN_BURST', None),
+            db_path=os.getenv('QUOTA_DB'),
+            sync_interval=_env_float('QUOTA_SYNC_SECONDS', 60),
+            idle_seconds=_env_float('QUOTA_IDLE_SECONDS', 900),
+        )
+
+    def fetch_usage(self, access_token):
+        """Total tokens the auth service has recorded for the user, or None if it cannot be fetched."""
+        if not self.auth_api:
+            logger.error("AUTH_API environment variable is not set")
+            return None
+        headers = {'Authorization': f'Bearer {access_token}'}
+        try:
+            with metrics.span('quota_sync'):
+                response = requests.get(f'{self.auth_api}/user/token_usage', headers=headers, timeout=10)
+            if response.status_code == 200:
+                return response.json().get('total_tokens', 0)
+            logger.error("Failed to get token count. Status code: %s", response.status_code)
+        except (requests.RequestException, ValueError) as e:
+            logger.error("Error fetching token count: %s", e)
+        return None
+
+    def usage(self, access_token, key=None):
+        """
+        The user's total usage as known locally, fetching it the first time the user is seen.
+        `key` is the token's user when the caller has already looked it up.
+        """
+        if key is None:
+            key = user_key(access_token)
+        if key is None:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._usage.get(key)
+            if entry is not None:
+                # Sync with the token the user is using now; an older one may have expired
+                entry.update(seen_at=now, access_token=access_token)
+                metrics.record_cache('token_usage', True)
+                return entry["total"]
+
+        metrics.record_cache('token_usage', False)
+        total = self.fetch_usage(access_token)
+        if total is None:
+            # Not cached, so the next request tries again
+            return None
+        with self._lock:
+            entry = self._usage.setdefault(key, {"total": total, "access_token": access_token,
+                                                 "synced_at": now, "seen_at": now})
+            return entry["total"]
+
+    def over_limit(self, access_token, key=None):
+        """True once the user's total usage exceeds the limit; unknown usage is not held against them."""
+        total = self.usage(access_token, key)
+        return total is not None and total > self.usage_limit
+
+    def check(self, access_token, user_id=None, cost=1):
+        """
+        Admit a request or refuse it without contacting anything but the local buckets
+        (and the auth service for a user seen for the first time). `user_id` is the
+        token's user when the caller has already looked it up. `cost` is the number of
+        requests it counts as; like tokens, it is admitted while the request bucket holds
+        one and takes the rest as debt that delays the user's next requests.
+
+        Returns None when admitted, otherwise (reason, retry_after_seconds) where reason is
+        'usage', 'tokens' or 'requests'.
+        """
+        key = user_id if user_id is not None else user_key(access_token)
+        if key is None:
+            return None
+        if self.over_limit(access_token, key):
+            metrics.quota_rejections.inc(reason='usage')
+            logger.info("Token limit exceeded.")
+            return 'usage', None
+
+        now = time.time()
+        if self.token_rate:
+            admitted, level = self.buckets.take(f"tokens:{key}", self.token_rate, self.token_burst, 0, 1, now)
+            if not admitted:
+                metrics.quota_rejections.inc(reason='tokens')
+                logger.info("Token rate limit exceeded, bucket at %.0f tokens", level)
+                return 'tokens', (1 - level) / self.token_rate
+        if self.request_rate:
+            admitted, level = self.buckets.take(f"requests:{key}", self.request_rate, self.request_burst, cost, 1, now)
+            if not admitted:
+                metrics.quota_rejections.inc(reason='requests')
+                logger.info("Request rate limit exceeded")
+                return 'requests', (1 - level) / self.request_rate
+        return None
+
+    def consume(self, access_token, tokens):
+        """Charge `tokens` used on behalf of the user to their token bucket and local usage."""
+        if not tokens:
+            return
+        key = user_key(access_token)
+        if key is None:
+            return
+        if self.token_rate:
+            self.buckets.take(f"tokens:{key}", self.token_rate, self.token_burst, tokens, float('-inf'), time.time())
+        with self._lock:
+            entry = self._usage.get(key)
+            if entry is not None:
+                entry["total"] += tokens
+
+    def sync(self):
+        """Re-fetch the usage of recently active users and forget idle ones."""
+        now = time.time()
+        with self._lock:
+            for key in [key for key, entry in self._usage.items() if now - entry["seen_at"] > self.idle_seconds]:
+                del self._usage[key]
+            due = [(key, entry["access_token"]) for key, entry in self._usage.items()
+                   if now - entry["synced_at"] >= self.sync_interval]
+
+        synced = 0
+        for key, access_token in due:
+            started = time.time()
+            total = self.fetch_usage(access_token)
+            if total is None:
+                continue
+            with self._lock:
+                entry = self._usage.get(key)
+                if entry is not None:
+                    entry.update(total=total, synced_at=started)
+                    synced += 1
+        # Buckets idle this long have refilled completely and can be recreated full
+        refill_seconds = [2 * burst / rate for rate, burst in ((self.request_rate, self.request_burst),
+                                                              (self.token_rate, self.token_burst)) if rate]
+        self.buckets.prune(now - max([self.idle_seconds] + refill_seconds))
+        if due:
+            logger.debug("Reconciled token usage of %d of %d active users", synced, len(due))
+        return synced
+
+    def _run(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error("Token usage sync failed: %s", e, exc_info=True)
+
+    def start(self):
+        """Reconcile usage every `sync_interval` seconds on a background thread (restarted in forked workers)."""
+        if not self.sync_interval or self._thread is not None:
+            return self
+        self._start_thread()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._start_thread)
+        return self
+
+    def _start_thread(self):
+        self._thread = threading.Thread(target=self._run, name='quota-sync', daemon=True)
+        self._thread.start()
+
+
+# Shared by the API handlers and the vectorization code, which charges embedding tokens
+limiter = QuotaLimiter.from_env()
@@ -0,0 +1,74 @@
+import gzip
+import logging
+import os
+
+import orjson
+from flask import make_response, request
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # Responses are compressed with gzip only
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# JSON bodies smaller than this are sent uncompressed; compressing them costs more than it saves
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv('RESPONSE_COMPRESS_MIN_BYTES', '1024'))
+RESPONSE_GZIP_LEVEL = int(os.getenv('RESPONSE_GZIP_LEVEL', '5'))
+RESPONSE_BROTLI_QUALITY = int(os.getenv('RESPONSE_BROTLI_QUALITY', '4'))
+
+
+def dumps(data):
+    """JSON bytes of `data`; NumPy arrays and scalars (e.g. search scores) serialize as numbers."""
+    return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+
+
+def choose_encoding(accept_encodings, size):
+    """Content encoding for a body of `size` bytes: 'br' or 'gzip', whichever the client prefers, or None."""
+    if size < RESPONSE_COMPRESS_MIN_BYTES:
+        return None
+    best, best_quality = None, 0
+    # On equal preference brotli wins; it compresses JSON better at the same speed
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+
+
+def output_json(data, code, headers=None):
+    """
+    Flask-RESTful representation of application/json responses.
+
+    Serializes with orjson and compresses bodies of at least RESPONSE_COMPRESS_MIN_BYTES
+    with brotli or gzip, as negotiated from the request's Accept-Encoding.
+    """
+    body = dumps(data)
+    raw_size = len(body)
+    encoding = choose_encoding(request.accept_encodings, raw_size)
+    if encoding:
+        compressed = compress(body, encoding)
+        if len(compressed) < raw_size:
+            body = compressed
+        else:
+            encoding = None
+
+    response = make_response(body, code)
+    response.headers.extend(headers or {})
+    response.mimetype = 'application/json'
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    metrics.response_bytes.inc(raw_size, kind='raw', encoding=encoding or 'identity')
+    metrics.response_bytes.inc(len(body), kind='sent', encoding=encoding or 'identity')
+    return response
@@ -0,0 +1,227 @@
+import bisect
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import requests
+from flask import Response, request
+
+import identity
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Set on forwarded requests; the receiving node always serves them itself
+FORWARDED_HEADER = 'X-SourceBox-Forwarded-By'
+
+# Endpoints whose work depends on one pack's dataset, keyed by the `pack_id` in their JSON body
+ROUTED_PATHS = {
+    '/deepquery', '/deepquery-code', '/deepquery-raw', '/deepquery-code-raw',
+    '/deepquery-raw-batch', '/deepquery-code-raw-batch',
+}
+
+# Hop-by-hop headers that must not be copied between connections
+_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers',
+                'transfer-encoding', 'upgrade', 'content-length', 'content-encoding', 'host'}
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent-hash ring with virtual nodes.
+
+    Each node owns `replicas` points on the ring, so adding or removing a node only moves
+    about 1/N of the keys, and they move to or from that node only.
+    """
+
+    def __init__(self, nodes=(), replicas=128):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+        self.nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.replicas):
+            point = _hash(f"{node}#{replica}")
+            bisect.insort(self._points, point)
+            self._owners[point] = node
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        removed = {point for point, owner in self._owners.items() if owner == node}
+        self._points = [point for point in self._points if point not in removed]
+        for point in removed:
+            del self._owners[point]
+
+    def node_for(self, key):
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+
+class Router:
+    """
+    Sends each (user, pack) to the node that owns it on the ring, so that node's datasets,
+    pack versions and caches are reused instead of every node building the same pack.
+
+    Membership comes from CLUSTER_NODES (comma-separated internal base URLs, including this
+    node's own NODE_URL) or from CLUSTER_NODES_FILE (one URL per line), which is re-read
+    when it changes so nodes can join and leave. A node that cannot be reached is taken
+    off the ring for NODE_RETRY_SECONDS and its keys are served by their next owner; if
+    forwarding fails, the receiving node serves the request itself.
+    """
+
+    def __init__(self, self_url, nodes=(), nodes_file=None, retry_seconds=30.0, timeout=600.0):
+        self.self_url = self_url.rstrip('/') if self_url else None
+        self.static_nodes = [node.rstrip('/') for node in nodes if node]
+        self.nodes_file = nodes_file
+        self.retry_seconds = retry_seconds
+        self.timeout = timeout
+        self._nodes_mtime = None
+        self._down = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.ring = HashRing()
+        self._rebuild(self._members())
+
+    @classmethod
+    def from_env(cls):
+        nodes = [node.strip() for node in os.getenv('CLUSTER_NODES', '').split(',') if node.strip()]
+        return cls(os.getenv('NODE_URL'), nodes, os.getenv('CLUSTER_NODES_FILE'),
+                   float(os.getenv('NODE_RETRY_SECONDS', '30')), float(os.getenv('NODE_FORWARD_TIMEOUT', '600')))
+
+    @property
+    def enabled(self):
+        return bool(self.self_url) and (bool(self.static_nodes) or bool(self.nodes_file))
+
+    def _members(self):
+        if not self.nodes_file:
+            return set(self.static_nodes)
+        try:
+            with open(self.nodes_file, encoding='utf-8') as f:
+                return {line.strip().rstrip('/') for line in f if line.strip() and not line.startswith('#')}
+        except OSError as e:
+            logger.error("Could not read cluster nodes from %s: %s", self.nodes_file, e)
+            return set(self.ring.nodes) | set(self._down)
+
+    def _rebuild(self, members):
+        now = time.time()
+        available = {node for node in members if self._down.get(node, 0) <= now}
+        if self.self_url:
+            available.add(self.self_url)
+        for node in self.ring.nodes - available:
+            self.ring.remove(node)
+            logger.info("Node %s left the ring", node)
+        for node in available - self.ring.nodes:
+            self.ring.add(node)
+            logger.info("Node %s joined the ring", node)
+
+    def _refresh(self):
+        """Pick up membership file changes and nodes whose retry delay has passed."""
+        with self._lock:
+            if self.nodes_file:
+                try:
+                    mtime = os.path.getmtime(self.nodes_file)
+                except OSError:
+                    mtime = None
+                changed = mtime != self._nodes_mtime
+                self._nodes_mtime = mtime
+            else:
+                changed = False
+            if changed or any(until <= time.time() for until in self._down.values()):
+                self._down = {node: until for node, until in self._down.items() if until > time.time()}
+                self._rebuild(self._members())
+
+    def mark_down(self, node):
+        with self._lock:
+            self._down[node] = time.time() + self.retry_seconds
+            self.ring.remove(node)
+        logger.warning("Node %s is unreachable; removed from the ring for %.0fs", node, self.retry_seconds)
+
+    def owner(self, user_id, pack_id):
+        self._refresh()
+        return self.ring.node_for(f"{user_id}/{pack_id}")
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def forward(self, node):
+        """Replay the current request on `node` and stream its response back."""
+        headers = {name: value for name, value in request.headers.items() if name.lower() not in _HOP_HEADERS}
+        headers[FORWARDED_HEADER] = self.self_url
+        # The owner compresses for the client (see representations.py); its body is relayed as is
+        headers['Accept-Encoding'] = request.headers.get('Accept-Encoding', 'identity')
+        upstream = self._session().request(request.method, f"{node}{request.full_path.rstrip('?')}",
+                                           headers=headers, data=request.get_data(), stream=True,
+                                           timeout=(5, self.timeout))
+        response_headers = [(name, value) for name, value in upstream.headers.items()
+                            if name.lower() not in _HOP_HEADERS]
+        if upstream.headers.get('Content-Encoding'):
+            response_headers.append(('Content-Encoding', upstream.headers['Content-Encoding']))
+        return Response(upstream.raw.stream(64 * 1024, decode_content=False), status=upstream.status_code,
+                        headers=response_headers, direct_passthrough=True)
+
+    def user_id(self):
+        """The current request's user, or None without a bearer token the auth service accepts."""
+        auth_header = request.headers.get('Authorization', '')
+        if not auth_header.startswith('Bearer '):
+            return None
+        try:
+            return identity.user_ids.lookup(auth_header.split(' ')[1])
+        except identity.UserIdError:
+            return None
+
+    def route(self):
+        """before_request hook: forward to the owning node, or return None to serve locally."""
+        if request.path not in ROUTED_PATHS or request.headers.get(FORWARDED_HEADER):
+            return None
+        data = request.get_json(silent=True) or {}
+        pack_id = data.get('pack_id') if isinstance(data, dict) else None
+        if not pack_id:
+            return None
+
+        # Placement follows the user, so it survives new logins and token refreshes
+        user_id = self.user_id()
+        if user_id is None:
+            # The request fails authentication wherever it runs
+            return None
+        node = self.owner(user_id, str(pack_id))
+        if node is None or node == self.self_url:
+            metrics.routing_requests.inc(result='local')
+            return None
+
+        try:
+            with metrics.span('forward', node=node):
+                response = self.forward(node)
+            metrics.routing_requests.inc(result='forwarded')
+            return response
+        except requests.RequestException as e:
+            logger.error("Forwarding to %s failed, serving locally: %s", node, e)
+            self.mark_down(node)
+            metrics.routing_requests.inc(result='fallback')
+            return None
+
+
+def init_app(app, router=None):
+    """Install the routing hook when the node is part of a cluster."""
+    router = router or Router.from_env()
+    if router.enabled:
+        app.before_request(router.route)
+        logger.info("Cluster routing enabled: node %s, %d nodes on the ring", router.self_url, len(router.ring.nodes))
+    return router
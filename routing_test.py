@@ -0,0 +1,155 @@
+from collections import Counter
+
+import pytest
+from flask import Flask
+
+import identity
+import routing
+from routing import FORWARDED_HEADER, HashRing, Router
+
+NODES = [f"http://node-{i}:8000" for i in range(4)]
+KEYS = [f"user-{i}/pack-{i % 7}" for i in range(2000)]
+
+
+def placement(ring):
+    return {key: ring.node_for(key) for key in KEYS}
+
+
+def test_empty_ring_has_no_owner():
+    assert HashRing().node_for('user/pack') is None
+
+
+def test_placement_is_deterministic_and_independent_of_join_order():
+    assert placement(HashRing(NODES)) == placement(HashRing(reversed(NODES)))
+
+
+def test_keys_spread_over_every_node():
+    counts = Counter(placement(HashRing(NODES)).values())
+    assert set(counts) == set(NODES)
+    # 128 virtual nodes each keep every node within a factor of two of its fair share
+    assert all(len(KEYS) / len(NODES) / 2 < count < len(KEYS) / len(NODES) * 2 for count in counts.values())
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+    before = placement(HashRing(NODES))
+    after = placement(HashRing(NODES + ["http://node-new:8000"]))
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert moved
+    assert all(after[key] == "http://node-new:8000" for key in moved)
+    assert len(moved) < len(KEYS) / 3
+
+
+def test_removing_a_node_only_moves_its_keys():
+    ring = HashRing(NODES)
+    before = placement(ring)
+    ring.remove(NODES[0])
+    after = placement(ring)
+
+    assert NODES[0] not in after.values()
+    assert all(before[key] == after[key] for key in KEYS if before[key] != NODES[0])
+
+
+def test_re_adding_a_node_restores_its_keys():
+    ring = HashRing(NODES)
+    before = placement(ring)
+    ring.remove(NODES[1])
+    ring.add(NODES[1])
+    assert placement(ring) == before
+
+
+class FakeUserIds(identity.UserIds):
+    """The auth service's answers, without the auth service."""
+
+    def __init__(self, users):
+        super().__init__(auth_url=None)
+        self.users = users
+        self.fetches = 0
+
+    def fetch(self, access_token):
+        self.fetches += 1
+        if access_token not in self.users:
+            raise identity.UserIdError("Failed to retrieve user ID: invalid token", 401)
+        return self.users[access_token]
+
+
+@pytest.fixture
+def cluster(monkeypatch):
+    user_ids = FakeUserIds({'token-1': 'alice', 'token-2': 'alice', 'token-3': 'bob'})
+    monkeypatch.setattr(identity, 'user_ids', user_ids)
+    router = Router(NODES[0], NODES)
+    forwarded = []
+    monkeypatch.setattr(router, 'forward', lambda node: forwarded.append(node) or 'forwarded')
+    return router, user_ids, forwarded
+
+
+def route(router, token=None, pack_id='pack-1', path='/deepquery-raw', headers=None):
+    headers = dict(headers or {})
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    with Flask(__name__).test_request_context(path, method='POST', json={"pack_id": pack_id}, headers=headers):
+        return router.route()
+
+
+def remote_pack(router, user_id):
+    """A pack of `user_id`'s that another node owns."""
+    return next(pack_id for pack_id in (f"pack-{i}" for i in range(100))
+                if router.owner(user_id, pack_id) != router.self_url)
+
+
+def test_placement_follows_the_user_not_the_token(cluster):
+    router, user_ids, forwarded = cluster
+    pack_id = remote_pack(router, 'alice')
+
+    assert route(router, 'token-1', pack_id) == 'forwarded'
+    assert route(router, 'token-2', pack_id) == 'forwarded'
+    assert forwarded == [router.owner('alice', pack_id)] * 2
+
+
+def test_user_lookups_are_cached(cluster):
+    router, user_ids, _ = cluster
+    pack_id = remote_pack(router, 'alice')
+    for _ in range(3):
+        route(router, 'token-1', pack_id)
+    assert user_ids.fetches == 1
+
+
+def test_requests_without_a_known_user_are_served_locally(cluster):
+    router, _, forwarded = cluster
+    pack_id = remote_pack(router, 'alice')
+
+    assert route(router, None, pack_id) is None
+    assert route(router, 'unknown-token', pack_id) is None
+    assert forwarded == []
+
+
+def test_rejected_tokens_are_remembered(cluster):
+    router, user_ids, _ = cluster
+    pack_id = remote_pack(router, 'alice')
+    for _ in range(3):
+        assert route(router, 'unknown-token', pack_id) is None
+    assert user_ids.fetches == 1
+
+
+def test_forwarded_and_unrouted_requests_are_served_locally(cluster):
+    router, _, forwarded = cluster
+    pack_id = remote_pack(router, 'alice')
+
+    assert route(router, 'token-1', pack_id, headers={FORWARDED_HEADER: NODES[1]}) is None
+    assert route(router, 'token-1', pack_id, path='/login') is None
+    assert route(router, 'token-1', pack_id=None) is None
+    assert forwarded == []
+
+
+def test_unreachable_owner_is_taken_off_the_ring(cluster, monkeypatch):
+    router, _, _ = cluster
+    pack_id = remote_pack(router, 'alice')
+    owner = router.owner('alice', pack_id)
+
+    def unreachable(node):
+        raise routing.requests.ConnectionError(f"{node} is down")
+
+    monkeypatch.setattr(router, 'forward', unreachable)
+    assert route(router, 'token-1', pack_id) is None
+    assert owner not in router.ring.nodes
+    assert router.owner('alice', pack_id) != owner
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: only requests within one process are deduplicated
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    """One in-flight call that other threads of this process can wait on."""
+
+    def __init__(self, hold=False):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # A hold() produces no result; its waiters start over once it is released
+        self.hold = hold
+
+
+class SingleFlight:
+    """
+    Run at most one call per key at a time and share its result with concurrent callers.
+
+    Threads of the same process wait on an in-memory call. Other processes (gunicorn
+    workers) serialize on an exclusive file lock in `lock_dir`; when a process had to wait
+    for the lock, it reuses the result the previous holder recorded after it started
+    waiting instead of running the call again. A failed call records nothing, so the next
+    waiter runs it itself.
+    """
+
+    def __init__(self, lock_dir):
+        self.lock_dir = lock_dir
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+
+            if leader:
+                break
+            logger.info("Waiting for in-flight call %s", key)
+            call.done.wait()
+            if call.hold:
+                continue
+            metrics.ingestion_singleflight.inc(role='waiter')
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run_exclusive(key, fn)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    @contextmanager
+    def hold(self, key):
+        """
+        Try to take `key` without waiting, e.g. to delete a dataset nobody is building.
+
+        Yields True while held; yields False if a call for `key` is in flight anywhere.
+        """
+        with self._lock:
+            busy = key in self._calls
+            if not busy:
+                call = self._calls[key] = _Call(hold=True)
+        if busy:
+            yield False
+            return
+
+        lock_file = None
+        try:
+            if fcntl is not None:
+                os.makedirs(self.lock_dir, exist_ok=True)
+                lock_file = open(self._paths(key)[0], 'a')
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    lock_file.close()
+                    lock_file = None
+                    yield False
+                    return
+            yield True
+        finally:
+            if lock_file is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _paths(self, key):
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.lock_dir, f"{name}.lock"), os.path.join(self.lock_dir, f"{name}.json")
+
+    def _run_exclusive(self, key, fn):
+        if fcntl is None:
+            metrics.ingestion_singleflight.inc(role='leader')
+            return fn()
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+        lock_path, result_path = self._paths(key)
+        started = time.time()
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                contended = False
+            except BlockingIOError:
+                logger.info("Call %s is running in another process, waiting for it", key)
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                contended = True
+
+            try:
+                if contended:
+                    shared = self._read_result(result_path, started)
+                    if shared is not None:
+                        logger.info("Reusing result of call %s finished by another process", key)
+                        metrics.ingestion_singleflight.inc(role='shared')
+                        return shared['result']
+
+                metrics.ingestion_singleflight.inc(role='leader')
+                result = fn()
+                self._write_result(result_path, result)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _read_result(path, not_before):
+        try:
+            with open(path, encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return record if record.get('finished_at', 0) >= not_before else None
+
+    @staticmethod
+    def _write_result(path, result):
+        try:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"finished_at": time.time(), "result": result}, f)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError) as e:
+            # Waiting processes will run the call themselves
+            logger.warning("Could not record result at %s: %s", path, e)
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from urllib.parse import urlparse
+
+import metrics
+from lazy import lazy_import
+
+boto3 = lazy_import('boto3')
+botocore_exceptions = lazy_import('botocore.exceptions')
+
+logger = logging.getLogger(__name__)
+
+# Uploaded last: a dataset only counts as stored once its manifest exists, and the
+# manifest names the version folder its files are in
+MANIFEST = '_manifest.json'
+
+# Times a fetch starts over when the version it was downloading is replaced under it
+FETCH_ATTEMPTS = 3
+
+# Files in a dataset folder that are per-node state and never leave it
+LOCAL_ONLY = {'.last_access'}
+
+
+class DatasetStore:
+    """
+    Persists datasets (my_deeplake/<user_id>/<pack_type>/<pack_id>) to an S3-compatible
+    object store, with the local folder acting as a hot cache.
+
+    - `upload` writes a dataset through after ingestion. Each version's files go under a
+      folder of their own, `<pack_id>/<digest>/`, named by a digest of the files; then the
+      manifest is replaced to point at the new folder, and only then is the previous
+      version's folder deleted. Objects are never overwritten in place, so a reader sees
+      either the old version or the new one, never a mix.
+    - `fetch` restores a dataset that is missing locally from the store, downloading into
+      a temporary folder and moving it into place only once complete. If the version it
+      is downloading is deleted by a newer upload, it starts over from the new manifest.
+
+    Configured with DATASET_STORE_URL (`s3://bucket/prefix`) and, for MinIO or other
+    S3-compatible services, S3_ENDPOINT_URL; credentials come from the usual AWS
+    environment variables. Without DATASET_STORE_URL the store is disabled and every
+    method is a no-op.
+    """
+
+    def __init__(self, url=None, local_root='my_deeplake', endpoint_url=None):
+        self.local_root = local_root
+        self.endpoint_url = endpoint_url
+        self.bucket = self.prefix = None
+        if url:
+            parsed = urlparse(url)
+            if parsed.scheme != 's3' or not parsed.netloc:
+                raise ValueError(f"DATASET_STORE_URL must look like s3://bucket/prefix, got {url!r}")
+            self.bucket = parsed.netloc
+            self.prefix = parsed.path.strip('/')
+        self._client = None
+
+    @classmethod
+    def from_env(cls, local_root='my_deeplake'):
+        return cls(os.getenv('DATASET_STORE_URL'), local_root, os.getenv('S3_ENDPOINT_URL'))
+
+    @property
+    def enabled(self):
+        return self.bucket is not None
+
+    @property
+    def client(self):
+        # boto3 clients are thread-safe; one per process, created after fork
+        if self._client is None:
+            self._client = boto3.client('s3', endpoint_url=self.endpoint_url)
+        return self._client
+
+    def _key(self, *parts):
+        return '/'.join(part for part in (self.prefix,) + parts if part)
+
+    def _local_folder(self, user_id, pack_type, pack_id):
+        return os.path.join(self.local_root, user_id, pack_type, pack_id)
+
+    def _version_key(self, user_id, pack_type, pack_id, manifest, relative):
+        # Manifests written before versions had folders point at files directly under the pack
+        return self._key(user_id, pack_type, pack_id, manifest.get('version'), relative)
+
+    def _manifest(self, user_id, pack_type, pack_id):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(user_id, pack_type, pack_id, MANIFEST))
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read())
+
+    def upload(self, user_id, pack_type, pack_id):
+        """Write a local dataset through to the store. Returns the number of bytes uploaded."""
+        if not self.enabled:
+            return 0
+        folder = self._local_folder(user_id, pack_type, pack_id)
+        started = time.perf_counter()
+        with metrics.span('dataset_store_upload'):
+            files = {}
+            for root, dirs, filenames in os.walk(folder):
+                for filename in filenames:
+                    if filename in LOCAL_ONLY:
+                        continue
+                    path = os.path.join(root, filename)
+                    files[os.path.relpath(path, folder).replace(os.sep, '/')] = path
+            version = _digest(files)
+
+            previous = self._manifest(user_id, pack_type, pack_id)
+            if previous is not None and previous.get('version') == version:
+                logger.info("Dataset %s/%s/%s is already stored as version %s", user_id, pack_type, pack_id, version[:12])
+                return 0
+
+            manifest = {"version": version, "files": {}, "uploaded_at": time.time()}
+            for relative, path in files.items():
+                self.client.upload_file(path, self.bucket, self._version_key(user_id, pack_type, pack_id, manifest, relative))
+                manifest["files"][relative] = os.path.getsize(path)
+
+            # The swap: from here on fetches download the new version
+            self.client.put_object(Bucket=self.bucket, Key=self._key(user_id, pack_type, pack_id, MANIFEST),
+                                   Body=json.dumps(manifest).encode('utf-8'))
+
+            # Objects of the previous version
+            if previous is not None:
+                stale = [self._version_key(user_id, pack_type, pack_id, previous, name) for name in previous.get('files', {})]
+                for start in range(0, len(stale), 1000):
+                    self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': [
+                        {'Key': key} for key in stale[start:start + 1000]]})
+
+        total = sum(manifest["files"].values())
+        metrics.dataset_store_bytes.inc(total, direction='upload')
+        logger.info("Uploaded dataset %s/%s/%s version %s to s3://%s (%d files, %d bytes, %.2fs)", user_id, pack_type,
+                    pack_id, version[:12], self.bucket, len(files), total, time.perf_counter() - started)
+        return total
+
+    def fetch(self, user_id, pack_type, pack_id):
+        """Restore a dataset from the store if it is missing locally. Returns True if one was fetched."""
+        if not self.enabled:
+            return False
+        folder = self._local_folder(user_id, pack_type, pack_id)
+        if os.path.isdir(os.path.join(folder, 'actual_deeplake_name')):
+            return False
+
+        with metrics.span('dataset_store_fetch'):
+            for attempt in range(1, FETCH_ATTEMPTS + 1):
+                manifest = self._manifest(user_id, pack_type, pack_id)
+                if manifest is None:
+                    metrics.record_cache('dataset_store', False)
+                    return False
+                try:
+                    self._download(user_id, pack_type, pack_id, manifest, folder)
+                    break
+                except botocore_exceptions.ClientError as e:
+                    # A newer upload deleted the version being downloaded; its manifest is already in place
+                    if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey') or attempt == FETCH_ATTEMPTS:
+                        raise
+                    logger.info("Dataset %s/%s/%s version %s was replaced during fetch, retrying", user_id, pack_type,
+                                pack_id, str(manifest.get('version'))[:12])
+
+        total = sum(manifest['files'].values())
+        metrics.record_cache('dataset_store', True)
+        metrics.dataset_store_bytes.inc(total, direction='download')
+        logger.info("Fetched dataset %s/%s/%s from s3://%s (%d bytes)", user_id, pack_type, pack_id, self.bucket, total)
+        return True
+
+    def _download(self, user_id, pack_type, pack_id, manifest, folder):
+        parent = os.path.dirname(folder)
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=f".{pack_id}-", dir=parent)
+        try:
+            for relative in manifest['files']:
+                path = os.path.join(staging, *relative.split('/'))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.client.download_file(self.bucket, self._version_key(user_id, pack_type, pack_id, manifest, relative),
+                                          path)
+            # Replace whatever partial folder was there (e.g. only an access marker)
+            shutil.rmtree(folder, ignore_errors=True)
+            os.replace(staging, folder)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    def delete_user(self, user_id):
+        """Remove every stored dataset of a user."""
+        if not self.enabled:
+            return 0
+        deleted = 0
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(user_id) + '/'):
+            objects = [{'Key': item['Key']} for item in page.get('Contents', [])]
+            if objects:
+                self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': objects})
+                deleted += len(objects)
+        logger.info("Deleted %d stored objects for user %s", deleted, user_id)
+        return deleted
+
+
+def _digest(files):
+    """Digest of a dataset's files (relative name -> local path), naming the version folder they are stored in."""
+    digest = hashlib.sha256()
+    for relative in sorted(files):
+        digest.update(relative.encode('utf-8') + b'\0')
+        with open(files[relative], 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        digest.update(b'\0')
+    return digest.hexdigest()
@@ -0,0 +1,155 @@
+import os
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from storage import MANIFEST, DatasetStore
+
+BUCKET = 'datasets'
+
+
+def write_dataset(root, files, user_id='u1', pack_type='pack', pack_id='p1'):
+    folder = os.path.join(root, user_id, pack_type, pack_id)
+    for relative, content in files.items():
+        path = os.path.join(folder, 'actual_deeplake_name', relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+    # Per-node state that must not be uploaded
+    with open(os.path.join(folder, '.last_access'), 'w') as f:
+        f.write('0')
+    return folder
+
+
+def read_dataset(root, user_id='u1', pack_type='pack', pack_id='p1'):
+    folder = os.path.join(root, user_id, pack_type, pack_id, 'actual_deeplake_name')
+    files = {}
+    for directory, _, filenames in os.walk(folder):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, folder).replace(os.sep, '/')] = f.read()
+    return files
+
+
+def stored_keys():
+    response = boto3.client('s3', region_name='us-east-1').list_objects_v2(Bucket=BUCKET)
+    return sorted(item['Key'] for item in response.get('Contents', []))
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in (('AWS_ACCESS_KEY_ID', 'test'), ('AWS_SECRET_ACCESS_KEY', 'test'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')):
+        monkeypatch.setenv(name, value)
+    with mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+        yield
+
+
+@pytest.fixture
+def nodes(s3, tmp_path):
+    """The stores of two nodes sharing a bucket, each with its own local folder."""
+    return (DatasetStore(f"s3://{BUCKET}/prefix", str(tmp_path / 'a')),
+            DatasetStore(f"s3://{BUCKET}/prefix", str(tmp_path / 'b')))
+
+
+V1 = {'chunks': b'one' * 100, 'meta/info.json': b'{"v": 1}', 'removed': b'gone in v2'}
+V2 = {'chunks': b'two' * 100, 'meta/info.json': b'{"v": 2}', 'added': b'new in v2'}
+
+
+def test_upload_then_fetch(nodes):
+    a, b = nodes
+    write_dataset(a.local_root, V1)
+
+    assert a.upload('u1', 'pack', 'p1') == sum(len(content) for content in V1.values())
+    assert b.fetch('u1', 'pack', 'p1')
+
+    assert read_dataset(b.local_root) == V1
+    assert not any(key.endswith('.last_access') for key in stored_keys())
+    # Already present locally
+    assert not b.fetch('u1', 'pack', 'p1')
+
+
+def test_fetch_without_stored_dataset(nodes):
+    _, b = nodes
+    assert not b.fetch('u1', 'pack', 'missing')
+
+
+def test_unchanged_dataset_is_not_uploaded_again(nodes):
+    a, _ = nodes
+    write_dataset(a.local_root, V1)
+    a.upload('u1', 'pack', 'p1')
+    keys = stored_keys()
+
+    assert a.upload('u1', 'pack', 'p1') == 0
+    assert stored_keys() == keys
+
+
+def test_replace_moves_to_a_new_version_and_deletes_the_old_one(nodes, tmp_path):
+    a, b = nodes
+    write_dataset(a.local_root, V1)
+    a.upload('u1', 'pack', 'p1')
+    old_manifest = a._manifest('u1', 'pack', 'p1')
+
+    write_dataset(str(tmp_path / 'rebuilt'), V2)
+    a.local_root = str(tmp_path / 'rebuilt')
+    a.upload('u1', 'pack', 'p1')
+    manifest = a._manifest('u1', 'pack', 'p1')
+
+    assert manifest['version'] != old_manifest['version']
+    version_prefix = f"prefix/u1/pack/p1/{manifest['version']}/"
+    assert stored_keys() == sorted([f"prefix/u1/pack/p1/{MANIFEST}"] +
+                                   [version_prefix + 'actual_deeplake_name/' + name for name in V2])
+
+    assert b.fetch('u1', 'pack', 'p1')
+    assert read_dataset(b.local_root) == V2
+
+
+def test_fetch_during_upload_sees_the_previous_version(nodes, tmp_path):
+    a, b = nodes
+    write_dataset(a.local_root, V1)
+    a.upload('u1', 'pack', 'p1')
+    write_dataset(str(tmp_path / 'rebuilt'), V2)
+    a.local_root = str(tmp_path / 'rebuilt')
+
+    # b fetches while a is half way through uploading the new version
+    upload_file = a.client.upload_file
+    fetched = []
+
+    def upload_then_fetch(*args, **kwargs):
+        upload_file(*args, **kwargs)
+        if not fetched:
+            fetched.append(b.fetch('u1', 'pack', 'p1'))
+
+    a.client.upload_file = upload_then_fetch
+    a.upload('u1', 'pack', 'p1')
+
+    assert fetched == [True]
+    assert read_dataset(b.local_root) == V1
+
+
+def test_fetch_restarts_when_its_version_is_replaced(nodes, tmp_path):
+    a, b = nodes
+    write_dataset(a.local_root, V1)
+    a.upload('u1', 'pack', 'p1')
+    write_dataset(str(tmp_path / 'rebuilt'), V2)
+    a.local_root = str(tmp_path / 'rebuilt')
+
+    # a replaces the version b is downloading after b's first file
+    download_file = b.client.download_file
+    replaced = []
+
+    def download_then_replace(*args, **kwargs):
+        download_file(*args, **kwargs)
+        if not replaced:
+            replaced.append(a.upload('u1', 'pack', 'p1'))
+
+    b.client.download_file = download_then_replace
+    assert b.fetch('u1', 'pack', 'p1')
+
+    assert replaced
+    assert read_dataset(b.local_root) == V2
+    # No staging folders are left behind
+    assert os.listdir(os.path.join(b.local_root, 'u1', 'pack')) == ['p1']
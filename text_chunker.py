@@ -0,0 +1,133 @@
+import codecs
+import logging
+import mmap
+import os
+from collections import deque
+
+from lazy import lazy_import
+
+tiktoken = lazy_import('tiktoken')
+charset_normalizer = lazy_import('charset_normalizer')
+
+logger = logging.getLogger(__name__)
+
+# Bytes at the start of the file used to detect its encoding
+DETECT_BYTES = 64 * 1024
+# Bytes decoded at a time; their pages are released from the mapping once decoded
+BLOCK_BYTES = 1024 * 1024
+# Text without a newline is cut into pieces of this many characters (e.g. minified files)
+MAX_PIECE_CHARS = 256 * 1024
+
+# UTF-32 before UTF-16: the UTF-32 LE mark starts with the UTF-16 LE one
+_BOMS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+
+def detect_encoding(prefix):
+    """Encoding of a file from its first bytes: a byte order mark, valid UTF-8, or charset_normalizer's guess."""
+    for bom, encoding in _BOMS:
+        if prefix.startswith(bom):
+            return encoding
+    try:
+        # The prefix may end in the middle of a character
+        codecs.getincrementaldecoder('utf-8')().decode(prefix, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    match = charset_normalizer.from_bytes(prefix).best()
+    return match.encoding if match is not None else 'latin-1'
+
+
+def _iter_blocks(path, encoding=None):
+    """Decoded text of the file at `path`, BLOCK_BYTES at a time, read through a read-only mapping."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            can_advise = hasattr(mapping, 'madvise')
+            if can_advise:
+                mapping.madvise(mmap.MADV_SEQUENTIAL)
+            encoding = encoding or detect_encoding(mapping[:DETECT_BYTES])
+            logger.debug("Reading %s (%d bytes) as %s", path, size, encoding)
+            # Undecodable bytes (a wrong guess further into the file) become U+FFFD instead of failing the file
+            decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+            for start in range(0, size, BLOCK_BYTES):
+                end = min(size, start + BLOCK_BYTES)
+                yield decoder.decode(mapping[start:end], final=end == size)
+                if can_advise:
+                    # Drop the decoded pages from this process; they stay in the page cache
+                    mapping.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+def _iter_pieces(blocks):
+    """Lines of the text (with their newline), cutting lines longer than MAX_PIECE_CHARS into pieces."""
+    pending = ""
+    for block in blocks:
+        parts = (pending + block).split('\n')
+        pending = parts.pop()
+        for part in parts:
+            yield part + '\n'
+        while len(pending) > MAX_PIECE_CHARS:
+            yield pending[:MAX_PIECE_CHARS]
+            pending = pending[MAX_PIECE_CHARS:]
+    if pending:
+        yield pending
+
+
+def iter_chunks(path, max_tokens=512, overlap_tokens=32, encoding=None):
+    """
+    Split the text file at `path` into chunks of at most `max_tokens` tokens (cl100k_base),
+    consecutive chunks sharing their last/first lines up to `overlap_tokens` tokens.
+
+    Yields (text, first_line, last_line). The file is memory-mapped and decoded block by
+    block, and only the lines of the current chunk are kept, so memory use depends on the
+    chunk size rather than the file size. Lines longer than `max_tokens` are cut by tokens.
+    """
+    if overlap_tokens >= max_tokens:
+        raise ValueError("overlap_tokens must be smaller than max_tokens")
+    tokenizer = tiktoken.get_encoding("cl100k_base")
+
+    # (piece, tokens, line) of the current chunk
+    window = deque()
+    window_tokens = 0
+    fresh = False  # the window holds lines not yielded yet
+    line = 1
+
+    for piece in _iter_pieces(_iter_blocks(path, encoding)):
+        piece_line = line
+        if piece.endswith('\n'):
+            line += 1
+        tokens = tokenizer.encode_ordinary(piece)
+
+        if len(tokens) > max_tokens:
+            if fresh:
+                yield "".join(p for p, _, _ in window), window[0][2], window[-1][2]
+            window.clear()
+            window_tokens, fresh = 0, False
+            step = max_tokens - overlap_tokens
+            for start in range(0, len(tokens), step):
+                yield tokenizer.decode(tokens[start:start + max_tokens]), piece_line, piece_line
+                if start + max_tokens >= len(tokens):
+                    break
+            continue
+
+        if window_tokens + len(tokens) > max_tokens:
+            if fresh:
+                yield "".join(p for p, _, _ in window), window[0][2], window[-1][2]
+                fresh = False
+            # Keep the last lines as overlap, as long as the new line still fits
+            while window and (window_tokens > overlap_tokens or window_tokens + len(tokens) > max_tokens):
+                window_tokens -= window.popleft()[1]
+
+        window.append((piece, len(tokens), piece_line))
+        window_tokens += len(tokens)
+        fresh = True
+
+    if fresh:
+        yield "".join(p for p, _, _ in window), window[0][2], window[-1][2]
@@ -1,37 +1,55 @@
+import io
 import os
 import shutil
 from dotenv import load_dotenv
-from openai import OpenAI
-from langchain_community.document_loaders import TextLoader
-from langchain_text_splitters import CharacterTextSplitter
-from langchain_community.vectorstores import DeepLake
-from custom_embedding import CustomEmbeddingFunction
-from prepare_data import prepare_csv_for_embedding
-from langchain.docstore.document import Document
+from lazy import lazy_import, lazy_object
 import logging
-import tiktoken
+from log_config import setup_logging
 import requests
+import metrics
+import chunk_store
+import text_chunker
+import dedup
+import embedding_backends
+import quota
+import extractors
+
+# Heavy dependencies are imported on first use (see app.warm_up)
+OpenAI = lazy_import('openai', 'OpenAI')
+TextLoader = lazy_import('langchain_community.document_loaders', 'TextLoader')
+CharacterTextSplitter = lazy_import('langchain_text_splitters', 'CharacterTextSplitter')
+DeepLake = lazy_import('langchain_community.vectorstores', 'DeepLake')
+Document = lazy_import('langchain.docstore.document', 'Document')
+prepare_csv_for_embedding = lazy_import('prepare_data', 'prepare_csv_for_embedding')
+tiktoken = lazy_import('tiktoken')
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+logger = logging.getLogger(__name__)
 
-# Initialize the embedding function
-embedding_function = CustomEmbeddingFunction(client)
+# Initialize OpenAI client (created on first use in each process)
+client = lazy_object(lambda: OpenAI(api_key=os.getenv("OPENAI_API_KEY")), 'openai.OpenAI')
 
 # Token counting function
-def count_vector_tokens(access_token, text_chunks):
+def count_tokens(text_chunks):
     encoding = tiktoken.get_encoding("cl100k_base")  # Adapt as necessary
+    return sum(len(encoding.encode(chunk)) for chunk in text_chunks)
 
-    total_tokens = sum(len(encoding.encode(chunk)) for chunk in text_chunks)
-    logging.info(f"Total vector token usage: {total_tokens}")
+
+def record_vector_tokens(access_token, total_tokens, kind='vector'):
+    """
+    Charge embedded tokens to the user, locally and in the auth service. `kind` labels
+    them in llm_tokens_total: 'vector' for pack chunks, 'query' for batch queries.
+    """
+    logger.info(f"Total {kind} token usage: {total_tokens}")
+    metrics.llm_tokens.inc(total_tokens, kind=kind)
+    quota.limiter.consume(access_token, total_tokens)
 
     # Send the total tokens to the API to record it in the database
     BASE_URL = os.getenv('AUTH_API')
     if not BASE_URL:
-        logging.error("AUTH_API environment variable is not set")
+        logger.error("AUTH_API environment variable is not set")
         return total_tokens
 
     add_tokens_url = f"{BASE_URL}/user/add_tokens"
@@ -41,122 +59,341 @@ def count_vector_tokens(access_token, text_chunks):
     try:
         response = requests.post(add_tokens_url, json=payload, headers=headers)
         if response.status_code == 200:
-            logging.info(f"Successfully added {total_tokens} tokens to the user's account.")
+            logger.info(f"Successfully added {total_tokens} tokens to the user's account.")
         else:
-            logging.error(f"Failed to add tokens. Status code: {response.status_code}, Response: {response.text}")
+            logger.error(f"Failed to add tokens. Status code: {response.status_code}, Response: {response.text}")
     except requests.RequestException as e:
-        logging.error(f"Error occurred while trying to add tokens: {e}")
+        logger.error(f"Error occurred while trying to add tokens: {e}")
 
     return total_tokens
 
 
-def project_to_vector(user_folder_path, user_id, pack_id, pack_type, access_token):
-    """Process files in the user folder, ensure proper cleanup, and create a user-specific DeepLake dataset."""
-    logging.info(f"Starting vectorization for user folder: {user_folder_path}")
-    logging.info(f"User ID: {user_id}, Pack ID: {pack_id}, Pack Type: {pack_type}")
+# Define allowed file extensions
+ALLOWED_EXTENSIONS = {
+    ".py", ".txt", ".csv", ".json", ".md", ".html", ".xml", ".yaml", ".yml", ".pdf",
+    ".js", ".docx", ".xlsx", "Dockerfile", "Procfile", ".gitignore",
+    ".java", ".rb", ".go", ".sh", ".php", ".cs", ".cpp", ".c", ".ts", ".swift", ".kt", ".rs", ".r", ".scala", ".pl", ".sql"
+}
+
+# Text files at least this large are chunked while streaming them from disk (see text_chunker.py)
+STREAM_CHUNK_MIN_BYTES = int(float(os.getenv('STREAM_CHUNK_MIN_MB', '8')) * 1024 * 1024)
+STREAM_CHUNK_TOKENS = int(os.getenv('STREAM_CHUNK_TOKENS', '512'))
+STREAM_CHUNK_OVERLAP_TOKENS = int(os.getenv('STREAM_CHUNK_OVERLAP_TOKENS', '32'))
+# Chunks added to DeepLake (and embedded) per call
+ADD_BATCH_SIZE = int(os.getenv('VECTOR_ADD_BATCH_SIZE', '256'))
+# Embeddings read back from DeepLake per block when writing the chunk store
+STORE_BUILD_ROWS = int(os.getenv('CHUNK_STORE_BUILD_ROWS', '4096'))
+
+
+def _stream_documents(filename, file_path):
+    for text, first_line, last_line in text_chunker.iter_chunks(file_path, STREAM_CHUNK_TOKENS,
+                                                                STREAM_CHUNK_OVERLAP_TOKENS):
+        if text.strip():
+            yield Document(page_content=text, metadata={'source': filename, 'lines': (first_line, last_line)})
+
+
+def load_documents(filename, file_path=None, text=None, sections=None):
+    """
+    Split one file into documents ready for embedding.
+
+    The file is read from `file_path`, or taken from `text` when it is streamed straight
+    from the pack payload without being written to disk. For PDF, DOCX and XLSX documents,
+    `sections` holds the (label, text) pairs extracted by extractors.py.
+
+    Large text files and documents are returned as a generator of chunks, read from disk
+    or from the extraction process as they are consumed, instead of being loaded whole.
+    """
+    if sections is not None:
+        return _section_documents(filename, sections)
+    elif os.path.splitext(filename)[1] == ".csv":
+        logger.debug("Processing CSV file: %s", filename)
+        prepared_csv_data = prepare_csv_for_embedding(file_path or io.StringIO(text))
+        return [Document(page_content=row, metadata={'source': filename}) for row in prepared_csv_data]
+    elif file_path and os.path.getsize(file_path) >= STREAM_CHUNK_MIN_BYTES:
+        logger.info("Streaming %s (%d bytes) through the chunker", filename, os.path.getsize(file_path))
+        return _stream_documents(filename, file_path)
+    elif file_path:
+        documents = TextLoader(file_path).load()
+        for document in documents:
+            document.metadata['source'] = filename
+    else:
+        documents = [Document(page_content=text, metadata={'source': filename})]
+
+    # Split the document respecting token limits
+    chunks = _text_splitter().split_documents(documents)
+
+    # Line range of each chunk in its file, kept by the chunk store
+    source_text = documents[0].page_content if len(documents) == 1 else None
+    for chunk in chunks:
+        start = chunk.metadata.pop('start_index', -1)
+        if source_text is not None and start >= 0:
+            first_line = source_text.count('\n', 0, start) + 1
+            chunk.metadata['lines'] = (first_line, first_line + chunk.page_content.count('\n'))
+    return chunks
+
+
+def _text_splitter():
+    max_chunk_size = 2000  # Adjust chunk size as needed
+    return CharacterTextSplitter(chunk_size=max_chunk_size, chunk_overlap=100, add_start_index=True)
+
+
+def _section_documents(filename, sections):
+    """Chunks of a document's sections, split one section at a time as they are extracted."""
+    text_splitter = _text_splitter()
+    for label, section_text in sections:
+        for chunk in text_splitter.split_documents([Document(page_content=section_text,
+                                                             metadata={'source': filename, 'section': label})]):
+            chunk.metadata.pop('start_index', None)
+            yield chunk
+
+
+def _extracted_sections(extraction, filename):
+    """Sections of a document as its extraction produces them, counting the outcome in extracted_documents."""
+    document_format = os.path.splitext(filename)[1].lower().lstrip('.')
+    count = 0
+    try:
+        for section in extractors.sections(extraction, filename):
+            count += 1
+            yield section
+    except extractors.ExtractionError:
+        metrics.extracted_documents.inc(format=document_format, result='failed')
+        raise
+    if not count:
+        # e.g. a scanned PDF with no text layer
+        metrics.extracted_documents.inc(format=document_format, result='empty')
+        raise extractors.ExtractionError(f"No text found in {filename}")
+    metrics.extracted_documents.inc(format=document_format, result='ok')
+    logger.info("Extracted %d sections from %s", count, filename)
+
+
+def _build_dataset(files, user_id, pack_id, pack_type, access_token):
+    """Embed `files`, an iterable of (filename, file_path, text), into the pack's DeepLake dataset."""
+    # Create a unique dataset path using user_id, pack_id, and pack_type
+    dataset_path = os.path.join("my_deeplake", user_id, pack_type, pack_id, "actual_deeplake_name")
+    logger.info(f"Dataset path: {dataset_path}")
+
+    # Initialize the dataset and the embedding backend configured for the pack type
+    embedding_function = embedding_backends.for_pack_type(pack_type, client)
+    db = DeepLake(dataset_path=dataset_path, embedding=embedding_function, overwrite=True)
+    embedding_backends.write_record(dataset_path, embedding_function)
+    logger.info("DeepLake instance initialized for path: %s (%s embeddings, %d dimensions)",
+                dataset_path, embedding_function.name, embedding_function.dimensions)
+
+    # The previous chunk store and duplicates no longer match the dataset being rebuilt
+    store_path = chunk_store.store_path(dataset_path)
+    chunk_store.remove(store_path)
+    duplicates_path = chunk_store.duplicates_path(dataset_path)
+    if os.path.exists(duplicates_path):
+        os.remove(duplicates_path)
+
+    failed_files = []
+    total_tokens = 0  # Tokens of every chunk added, charged to the user
+    # Chunks added to DeepLake, in row order, for the chunk store (texts spooled to disk)
+    texts, sources, lines = chunk_store.TextSpool(), [], []
+    # Chunks repeating an earlier chunk are not embedded, only recorded against it
+    deduplicator = dedup.Deduplicator() if dedup.DEDUP_ENABLED else None
+    duplicates = []  # (row, source, lines) for the chunk store
+    duplicate_counts = {'exact': 0, 'near': 0}
+    saved_tokens = 0
+
+    # PDF, DOCX and XLSX documents are extracted in worker processes while earlier files are embedded
+    files = list(files)
+    extractions = {}
+    for index, (filename, file_path, text) in enumerate(files):
+        if os.path.splitext(filename)[1] in ALLOWED_EXTENSIONS and extractors.is_document(filename, file_path, text):
+            extractions[index] = extractors.submit(filename, file_path, text)
+    if extractions:
+        logger.info("Extracting text from %d PDF, DOCX and XLSX documents", len(extractions))
+
+    for index, (filename, file_path, text) in enumerate(files):
+        file_extension = os.path.splitext(filename)[1]
+        logger.debug("Processing file: %s, Extension: %s", filename, file_extension)
+
+        if file_extension not in ALLOWED_EXTENSIONS:
+            logger.warning("Skipping unsupported file: %s", filename)
+            continue
+
+        added = 0
+        try:
+            # Documents are chunked and embedded section by section while they are still being extracted
+            sections = _extracted_sections(extractions.pop(index), filename) if index in extractions else None
+            docs = load_documents(filename, file_path, text, sections)
+
+            # CSV rows differing in a single field are different records; only drop exact repeats
+            near = file_extension != '.csv'
+
+            # Add documents to DeepLake a batch at a time, so a large file is never held whole
+            for batch in _batched(docs, ADD_BATCH_SIZE):
+                unique, repeated = _deduplicate(deduplicator, batch, len(texts), near)
+                try:
+                    if unique:
+                        db.add_documents(unique)
+                except Exception:
+                    if deduplicator is not None:
+                        deduplicator.rollback()
+                    raise
+                if deduplicator is not None:
+                    deduplicator.commit()
+                added += len(unique)
+                # Collect text chunks for token counting and the chunk store
+                total_tokens += count_tokens(doc.page_content for doc in unique)
+                texts.extend(doc.page_content for doc in unique)
+                sources.extend(filename for doc in unique)
+                lines.extend(doc.metadata.get('lines', (0, 0)) for doc in unique)
+                for row, kind, doc in repeated:
+                    duplicates.append((row, filename, doc.metadata.get('lines', (0, 0))))
+                    duplicate_counts[kind] += 1
+                saved_tokens += count_tokens(doc.page_content for _, _, doc in repeated)
+            logger.debug("Successfully split document: %s into %d chunks.", filename, added)
 
-    total_tokens = 0
+        except Exception as e:
+            failed_files.append(filename)
+            logger.error(f"Failed to load or split file: {filename}, Error: {e}")
+            if added:
+                logger.error("%d chunks of %s were embedded before it failed", added, filename)
+            continue
+
+    # After processing all files, count the tokens used (local backends use none)
+    if total_tokens and embedding_function.name == 'openai':
+        record_vector_tokens(access_token, total_tokens)
+
+    if duplicates:
+        for kind, count in duplicate_counts.items():
+            metrics.dedup_chunks.inc(count, kind=kind)
+        metrics.dedup_saved_tokens.inc(saved_tokens)
+        logger.info("Deduplication saved %d vectors (%d exact, %d near-duplicate chunks of %d) and %d tokens",
+                    len(duplicates), duplicate_counts['exact'], duplicate_counts['near'],
+                    len(texts) + len(duplicates), saved_tokens)
+
+    if failed_files:
+        logger.error(f"The following files failed to process: {failed_files}")
+    else:
+        logger.info("All files processed successfully.")
 
     try:
-        # Create a unique dataset path using user_id, pack_id, and pack_type
-        dataset_path = os.path.join("my_deeplake", user_id, pack_type, pack_id, "actual_deeplake_name")
-        logging.info(f"Dataset path: {dataset_path}")
-
-        # Initialize the dataset and embedding function
-        db = DeepLake(dataset_path=dataset_path, embedding=embedding_function, overwrite=True)
-        logging.info(f"DeepLake instance initialized for path: {dataset_path}")
-
-        # Define allowed file extensions
-        allowed_extensions = {
-            ".py", ".txt", ".csv", ".json", ".md", ".html", ".xml", ".yaml", ".yml", ".pdf",
-            ".js", ".docx", ".xlsx", "Dockerfile", "Procfile", ".gitignore",
-            ".java", ".rb", ".go", ".sh", ".php", ".cs", ".cpp", ".c", ".ts", ".swift", ".kt", ".rs", ".r", ".scala", ".pl", ".sql"
-        }
-
-        failed_files = []
-        all_chunks = []  # To collect all document chunks for token counting
-
-        # Traverse the user folder and process files
-        for root, dirs, files in os.walk(user_folder_path):
-            logging.info(f"Processing folder: {root}, found {len(files)} files.")
-            
-            for filename in files:
-                file_path = os.path.join(root, filename)
-                file_extension = os.path.splitext(filename)[1]
-                logging.info(f"Processing file: {filename}, Extension: {file_extension}")
-
-                if file_extension not in allowed_extensions:
-                    logging.warning(f"Skipping unsupported file: {filename}")
-                    continue
-
-                if os.path.isfile(file_path):
-                    if file_extension == ".csv":
-                        try:
-                            logging.info(f"Processing CSV file: {filename}")
-                            prepared_csv_data = prepare_csv_for_embedding(file_path)
-                            docs = [Document(page_content=row, metadata={'source': filename}) for row in prepared_csv_data]
-                            db.add_documents(docs)
-
-                            # Collect the CSV rows as text chunks for token counting
-                            all_chunks.extend(prepared_csv_data)
-
-                        except Exception as e:
-                            failed_files.append(file_path)
-                            logging.error(f"Failed to process CSV file: {filename}, Error: {e}")
-                            continue
-                    else:
-                        try:
-                            loader = TextLoader(file_path)
-                            documents = loader.load()
-
-                            # Split the document respecting token limits
-                            max_chunk_size = 2000  # Adjust chunk size as needed
-                            text_splitter = CharacterTextSplitter(chunk_size=max_chunk_size, chunk_overlap=100)
-                            docs = text_splitter.split_documents(documents)
-
-                            # Collect text chunks for token counting
-                            all_chunks.extend([doc.page_content for doc in docs])
-
-                            # Add documents to DeepLake
-                            db.add_documents(docs)
-                            logging.info(f"Successfully split document: {filename} into {len(docs)} chunks.")
-
-                        except Exception as e:
-                            failed_files.append(file_path)
-                            logging.error(f"Failed to load or split file: {filename}, Error: {e}")
-                            continue
-
-        # After processing all files, count the tokens used
-        if all_chunks:
-            count_vector_tokens(access_token, all_chunks)
-
-        if failed_files:
-            logging.error(f"The following files failed to process: {failed_files}")
+        _build_chunk_store(db, store_path, texts, sources, lines, duplicates)
+        if duplicates:
+            # Read when queries fall back to the DeepLake dataset
+            chunk_store.write_duplicates(duplicates_path, texts, duplicates)
+    finally:
+        texts.close()
+    return db
+
+
+def _deduplicate(deduplicator, batch, first_row, near=True):
+    """
+    Split a batch into the documents to add, which will be stored from row `first_row` on,
+    and (canonical row, kind, document) for each one repeating an earlier chunk.
+    """
+    if deduplicator is None:
+        return batch, []
+    unique, repeated = [], []
+    for doc in batch:
+        row, match = deduplicator.find(doc.page_content, near=near)
+        if row is None:
+            deduplicator.add(match, first_row + len(unique))
+            unique.append(doc)
         else:
-            logging.info("All files processed successfully.")
+            repeated.append((row, match, doc))
+    return unique, repeated
+
+
+def _batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _build_chunk_store(db, store_path, texts, sources, lines, duplicates=()):
+    """Write the chunk store queries are served from; without one they fall back to DeepLake."""
+    try:
+        with metrics.span('chunk_store_build'):
+            embeddings = db.vectorstore.dataset.embedding if texts else []
+            if len(embeddings) != len(texts):
+                logger.error("Not building chunk store %s: dataset has %d rows for %d chunks",
+                             store_path, len(embeddings), len(texts))
+                return
+            chunk_store.ChunkStore.build(store_path, texts, sources, lines,
+                                         _embedding_blocks(embeddings, STORE_BUILD_ROWS), duplicates)
+    except Exception as e:
+        logger.error(f"Failed to build chunk store {store_path}: {e}", exc_info=True)
+        chunk_store.remove(store_path)
+
+
+def _embedding_blocks(tensor, size):
+    """The rows of a dataset's embedding tensor, read `size` at a time."""
+    for start in range(0, len(tensor), size):
+        yield tensor[start:start + size].numpy()
+
+
+def _walk_files(folder_path):
+    for root, dirs, files in os.walk(folder_path):
+        logger.debug("Processing folder: %s, found %d files.", root, len(files))
+        for filename in files:
+            file_path = os.path.join(root, filename)
+            if os.path.isfile(file_path):
+                # Files are named as in the pack, not by where they were staged
+                yield os.path.relpath(file_path, folder_path).replace(os.sep, '/'), file_path, None
+
+
+@metrics.timed('project_to_vector')
+def project_to_vector(user_folder_path, user_id, pack_id, pack_type, access_token, cleanup=True):
+    """
+    Process files in the user folder and create a user-specific DeepLake dataset.
+
+    With `cleanup` the folder (and its parent, if left empty) is deleted afterwards; callers
+    that stage files in their own workspace pass cleanup=False and remove it themselves.
+    """
+    logger.info(f"Starting vectorization for user folder: {user_folder_path}")
+    logger.info(f"User ID: {user_id}, Pack ID: {pack_id}, Pack Type: {pack_type}")
+
+    try:
+        db = _build_dataset(_walk_files(user_folder_path), user_id, pack_id, pack_type, access_token)
+
+        if not cleanup:
+            return db
 
         # Clean up the user folder after processing
         try:
             shutil.rmtree(user_folder_path)
-            logging.info(f"Successfully deleted user folder: {user_folder_path}")
+            logger.info(f"Successfully deleted user folder: {user_folder_path}")
 
             # Delete the user_id folder itself (i.e., the folder in 'uploads/{user_id}')
             parent_folder = os.path.dirname(user_folder_path)
             if os.path.exists(parent_folder) and not os.listdir(parent_folder):  # Check if the folder is empty
                 os.rmdir(parent_folder)
-                logging.info(f"Successfully deleted user_id folder: {parent_folder}")
+                logger.info(f"Successfully deleted user_id folder: {parent_folder}")
                 
         except Exception as e:
-            logging.error(f"Failed to delete user folder: {user_folder_path}. Error: {e}")
+            logger.error(f"Failed to delete user folder: {user_folder_path}. Error: {e}")
             raise Exception(f"Error deleting user folder: {e}")
 
         return db
 
     except Exception as e:
-        logging.error(f"Error in vectorization process: {str(e)}", exc_info=True)
+        logger.error(f"Error in vectorization process: {str(e)}", exc_info=True)
+        raise
+
+
+@metrics.timed('project_to_vector')
+def project_contents_to_vector(files, user_id, pack_id, pack_type, access_token):
+    """Like project_to_vector, but for (filename, text) pairs taken from the pack payload in memory."""
+    logger.info(f"Starting in-memory vectorization for user ID: {user_id}, Pack ID: {pack_id}, Pack Type: {pack_type}")
+    try:
+        return _build_dataset(((filename, None, text) for filename, text in files),
+                              user_id, pack_id, pack_type, access_token)
+    except Exception as e:
+        logger.error(f"Error in vectorization process: {str(e)}", exc_info=True)
         raise
 
 if __name__ == "__main__":
+    setup_logging()
+
     # Example test run
     user_folder_path = 'uploads/3c308c688090b826ecd9f454f848ebaebf27e15b4cc757a7b5f39391ed5232d0'
     user_id = "1"  # Replace with actual user_id